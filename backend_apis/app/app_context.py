@@ -0,0 +1,249 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Application context: configuration, credentials and Google Cloud clients.
+
+config.toml is read once per process and every client is built on first
+use from one set of Application Default Credentials, instead of each module
+reading the config, refreshing credentials and calling `vertexai.init` at
+import time. The FastAPI lifespan hook warms the components listed under
+`[startup] eager` concurrently and logs how long each one took.
+
+Client libraries are imported by the components that need them, so that
+importing this module stays cheap, e.g. in the image worker processes.
+"""
+
+import asyncio
+import functools
+import threading
+import time
+import tomllib
+from typing import Any, Callable
+
+from .logger import log
+
+
+# Set when the first module of the app imports this one, to report how much
+# of the cold start is spent importing modules.
+_IMPORT_STARTED = time.perf_counter()
+
+CONFIG_PATH = "/app/config.toml"
+USER_AGENT = "cloud-solutions/genai-for-marketing-backend-v2.0"
+DEFAULT_EAGER = ("vertexai", "image_model", "firestore")
+
+
+@functools.lru_cache(maxsize=None)
+def load_config() -> dict:
+    """Returns config.toml, read on first call and shared afterwards."""
+    with open(CONFIG_PATH, "rb") as f:
+        return tomllib.load(f)
+
+
+class AppContext:
+    """Lazily built credentials and clients shared by the whole process.
+
+    Each component is built once, on first use, under its own lock, so
+    components that do not depend on each other can be built concurrently.
+    The time each one took is kept in `timings`.
+    """
+
+    def __init__(self, config: dict):
+        self.config = config
+        self.backend = config["models"].get("backend", "vertex")
+        self.project_id = config["global"]["project_id"]
+        self.location = config["global"]["location"]
+        self.timings: dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._locks: dict[str, threading.Lock] = {}
+        self._components: dict[str, Any] = {}
+
+    def get(self, name: str) -> Any:
+        """Returns the component `name`, building it on first use.
+
+        Args:
+            name:
+                A component, e.g. `credentials`, `bq_client` or `firestore`.
+
+        Returns:
+            The shared component.
+        """
+        try:
+            return self._components[name]
+        except KeyError:
+            pass
+        factory: Callable[[], Any] = getattr(self, f"_create_{name}")
+        with self._lock:
+            lock = self._locks.setdefault(name, threading.Lock())
+        with lock:
+            if name not in self._components:
+                start = time.perf_counter()
+                self._components[name] = factory()
+                self.timings[name] = time.perf_counter() - start
+        return self._components[name]
+
+    def _create_credentials(self):
+        from google.auth import credentials as auth_credentials
+        if self.backend == "fake":
+            # Local stand-in models: no Vertex AI project or credentials.
+            return auth_credentials.AnonymousCredentials(), self.project_id
+
+        import google.auth
+        import google.auth.transport.requests
+        credentials, project_id = google.auth.default()
+        credentials.refresh(google.auth.transport.requests.Request())
+        return credentials, project_id or self.project_id
+
+    def _create_workspace_credentials(self):
+        import google.auth
+        credentials, _ = google.auth.default(
+            scopes=self.config["global"]["workspace_scopes"])
+        return credentials
+
+    def _create_vertexai(self):
+        if self.backend == "fake":
+            return False
+        import vertexai
+        vertexai.init(
+            project=self.credentials_project_id,
+            location=self.location,
+            credentials=self.credentials)
+        return True
+
+    def _create_search_client(self):
+        from google.cloud import discoveryengine
+        return discoveryengine.SearchServiceClient(
+            credentials=self.credentials)
+
+    def _create_bq_client(self):
+        from google.api_core.client_info import ClientInfo
+        from google.cloud import bigquery
+        return bigquery.Client(
+            project=self.credentials_project_id,
+            credentials=self.credentials,
+            client_info=ClientInfo(user_agent=USER_AGENT))
+
+    def _create_datacatalog_client(self):
+        from google.cloud import datacatalog_v1
+        return datacatalog_v1.DataCatalogClient(credentials=self.credentials)
+
+    def _create_translate_client(self):
+        from google.api_core.client_info import ClientInfo
+        from google.cloud import translate_v2 as translate
+        return translate.Client(
+            credentials=self.credentials,
+            client_info=ClientInfo(user_agent=USER_AGENT))
+
+    def _create_texttospeech_client(self):
+        from google.cloud import texttospeech
+        return texttospeech.TextToSpeechLongAudioSynthesizeClient(
+            credentials=self.credentials)
+
+    def _create_firestore(self):
+        import firebase_admin
+        from firebase_admin import firestore
+        # Application Default credentials are automatically created.
+        firebase_admin.initialize_app()
+        return firestore.client()
+
+    def _create_image_model(self):
+        from .utils_models import get_image_model
+        return get_image_model(self.config["models"]["image_model_name"])
+
+    @property
+    def credentials(self):
+        return self.get("credentials")[0]
+
+    @property
+    def credentials_project_id(self) -> str:
+        """Project of the credentials, or the configured one without it."""
+        return self.get("credentials")[1]
+
+    @property
+    def workspace_credentials(self):
+        return self.get("workspace_credentials")
+
+    @property
+    def search_client(self):
+        return self.get("search_client")
+
+    @property
+    def bq_client(self):
+        return self.get("bq_client")
+
+    @property
+    def datacatalog_client(self):
+        return self.get("datacatalog_client")
+
+    @property
+    def translate_client(self):
+        return self.get("translate_client")
+
+    @property
+    def texttospeech_client(self):
+        return self.get("texttospeech_client")
+
+    @property
+    def firestore(self):
+        return self.get("firestore")
+
+    def init_vertexai(self):
+        """Initializes the Vertex AI SDK once; a no-op on the fake backend."""
+        self.get("vertexai")
+
+    async def startup(self):
+        """Builds the `[startup] eager` components and logs the timings.
+
+        Credentials come first since every client needs them, then the other
+        components are built concurrently on threads. A component that fails
+        is logged and built again on first use.
+        """
+        started = time.perf_counter()
+        self.timings["import"] = started - _IMPORT_STARTED
+        eager = [
+            name
+            for name in self.config.get("startup", {}).get(
+                "eager", DEFAULT_EAGER)
+            if name != "credentials"]
+
+        await asyncio.to_thread(self.get, "credentials")
+        results = await asyncio.gather(
+            *(asyncio.to_thread(self.get, name) for name in eager),
+            return_exceptions=True)
+        for name, result in zip(eager, results):
+            if isinstance(result, Exception):
+                log(f"Failed initializing {name} at startup: {result}")
+
+        self.timings["startup"] = time.perf_counter() - started
+        breakdown = ", ".join(
+            f"{name} {self.timings[name]:.2f}s"
+            for name in ["import", "credentials", *eager]
+            if name in self.timings)
+        log(f"Started in {self.timings['startup']:.2f}s "
+            f"after imports ({breakdown})")
+
+
+_context_lock = threading.Lock()
+_context: AppContext | None = None
+
+
+def get_context() -> AppContext:
+    """Returns the process-wide AppContext."""
+    global _context
+    if _context is None:
+        with _context_lock:
+            if _context is None:
+                _context = AppContext(load_config())
+    return _context
@@ -12,6 +12,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from typing import Literal
+
 from pydantic import BaseModel
 
 
@@ -29,15 +31,28 @@ class TextGenerateResponse(BaseModel):
     safety_attributes: dict
 
 
+# How generated images are returned: inline as base64, or stored in the
+# asset bucket and returned as a GCS URI and a signed URL.
+ImageResponseFormat = Literal["base64", "gcs"]
+
+
 class ImageGenerateRequest(BaseModel):
     prompt: str
     number_of_images: int = 1
     negative_prompt: str | None = None
+    response_format: ImageResponseFormat = "base64"
+    fan_out: bool = False
+    # Reuses earlier images of the exact same prompt, ignoring case and
+    # whitespace.
+    reuse_exact_prompt: bool = False
 
 
 class ImageResponse(BaseModel):
     id: int
-    images_base64_string: str
+    images_base64_string: str | None = None
+    uri: str | None = None
+    url: str | None = None
+    sha256: str | None = None
     image_size: tuple
     images_parameters: dict
 
@@ -48,10 +63,43 @@ class ImageGenerateResponse(BaseModel):
 
 class ImageEditRequest(BaseModel):
     prompt: str
-    base_image_base64: str
+    base_image_base64: str | None = None
+    base_image_uri: str | None = None
     mask_base64: str | None = None
+    mask_uri: str | None = None
     number_of_images: int = 3
     negative_prompt: str | None = None
+    response_format: ImageResponseFormat = "base64"
+    fan_out: bool = False
+    # Reuses earlier edits of the exact same prompt, ignoring case and
+    # whitespace, whose base image is similar to this one.
+    reuse_exact_prompt: bool = False
+
+
+class ImageJobResponse(BaseModel):
+    job_id: str
+    status: str
+
+
+class JobStatusResponse(BaseModel):
+    job_id: str
+    kind: str
+    status: str
+    result: dict | None = None
+    error: str | None = None
+    status_code: int | None = None
+    created: float
+    updated: float
+
+
+class SimilarAssetsRequest(BaseModel):
+    image_base64: str
+    max_distance: int | None = None
+    limit: int = 10
+
+
+class SimilarAssetsResponse(BaseModel):
+    assets: list[dict]
 
 
 class TrendTopRequest(BaseModel):
@@ -132,6 +180,8 @@ class CampaignCreateRequest(BaseModel):
     campaign_name: str
     theme: str
     brief: CampaignBrief
+    nocache: bool = False
+    combined: bool | None = None
     
 class CampaignCreateResponse(BaseModel):
     id:str
@@ -179,6 +229,10 @@ class ContentCreationRequest(BaseModel):
     audience_age_range: str = '20-30'
     audience_gender:str = 'All'
     image_generate: bool = True
+    nocache: bool = False
+    combined: bool | None = None
+    response_format: ImageResponseFormat = "base64"
+    fan_out: bool = False
 
 class ContentCreationResponse(BaseModel):
     generated_content:dict
@@ -193,6 +247,7 @@ class BulkEmailGenRequest(BaseModel):
     audience:list
     image_context:str = None
     no_of_emails:int = 10
+    response_format: ImageResponseFormat = "base64"
 
 class PersionalizedEmail(BaseModel):
     email: str
@@ -201,6 +256,8 @@ class PersionalizedEmail(BaseModel):
     translation: str
     language: str = 'English'
     generated_image: str = None
+    generated_image_uri: str | None = None
+    generated_image_url: str | None = None
 
 class BulkEmailGenResponse(BaseModel):
     persionalized_emails: list[PersionalizedEmail]
@@ -222,4 +279,9 @@ class TexttoSpeechRequest(BaseModel):
     language_name: str = None
 
 class TexttoSpeechResponse(BaseModel):
-    audio_uri: str
\ No newline at end of file
+    audio_uri: str
+
+class SettingsReloadResponse(BaseModel):
+    previous_version: str
+    version: str
+    changed: bool
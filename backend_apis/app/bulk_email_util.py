@@ -21,54 +21,56 @@ Email Generation:
 
 import asyncio
 import functools
+import math
 import numpy as np
 import pandas as pd
 
-import vertexai
-import google.auth
-from google.auth import impersonated_credentials
-import google.auth.transport.requests
-from google.api_core.client_info import ClientInfo
-from google.auth import credentials as auth_credentials
-
-import tomllib
-import io
-import base64
-from PIL import Image
-
-from google.cloud import translate_v2 as translate
-from vertexai.preview.generative_models import GenerativeModel, GenerationConfig
-from vertexai.preview.vision_models import ImageGenerationModel
+from .app_context import get_context, load_config
+from .settings import Settings, get_settings
+from .utils_models import (
+    GENERATION_CONFIGS,
+    get_async_generative_model,
+    get_image_model
+)
+from .utils_ratelimit import RateLimitExceeded, get_limiter
+from .utils_tokens import estimate_tokens
+from .utils_resilience import (
+    GenerationUnavailableError,
+    call_with_deadline,
+    call_with_retry
+)
+from .utils_telemetry import track_call
+from .utils_executors import run_blocking
+from . import utils_gcs
+from . import utils_image
 
 
 # Load configuration file
-with open("/app/config.toml", "rb") as f:
-    config = tomllib.load(f)
+config = load_config()
 project_id = config["global"]["project_id"]
 location = config["global"]["location"]
 
-credentials, _ = google.auth.default()
-request = google.auth.transport.requests.Request()
-credentials.refresh(request)
-credentials.apply(headers = {'user-agent': 'cloud-solutions/genai-for-marketing-backend-v2.0'})
-
-vertexai.init(
-    project=project_id,
-    location=location,
-    credentials=credentials)
-text_llm = GenerativeModel(config["models"]["text_model_name"])
-imagen = ImageGenerationModel.from_pretrained(config["models"]["image_model_name"])
-translate_client = translate.Client(client_info=ClientInfo(user_agent='cloud-solutions/genai-for-marketing-backend-v2.0'))
-
 # Default values
-EMAIL_TEXT_PROMPT = config["prompts"]["prompt_email_text"]
 AGE_BUCKET = config["data_sample"]["age_bucket"]
 MALE_NAMES = config["data_sample"]["male_names"]
 FEMALE_NAMES = config["data_sample"]["female_names"]
 LANGUAGES = config["data_sample"]["languages"]
 LANGUAGES_MAP = config["data_sample"]["languages_map"]
 
-IMAGE_PROMPT = config["prompts"]["prompt_image_generation"]
+IMAGE_STORAGE = config.get("image_storage", {})
+IMAGE_VARIANTS = config.get("bulk_email", {}).get("image_variants", 4)
+EMAIL_CONCURRENCY = config.get("bulk_email", {}).get("concurrency", 8)
+
+
+async def _gather_or_cancel(*aws) -> list:
+    """Like `asyncio.gather`, but cancels the others when one fails."""
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
 
 def generate_information(data : list) -> pd.DataFrame:
     df = pd.DataFrame.from_dict(data)
@@ -86,33 +88,126 @@ def generate_information(data : list) -> pd.DataFrame:
         df['email'], 'New York City') 
     return df
 
-async def email_generate(row: pd.Series, theme: str, image_context: str) -> pd.Series:
-    first_name = row['first_name']
-    
-    email_prompt = EMAIL_TEXT_PROMPT.format(first_name,
-                                            theme)
+async def generate_image_variants(image_context: str,
+                                  number_of_images: int = IMAGE_VARIANTS,
+                                  response_format: str = "base64",
+                                  settings: Settings | None = None) -> list:
+    """Generates the email images shared by every recipient of a bulk run.
+
+    The image prompt does not depend on the recipient, so Imagen is called
+    once for a small pool of variants, and each is resized to a 250x250
+    thumbnail and, with `response_format` `gcs`, stored once.
+
+    Args:
+        image_context:
+            Context inserted into the image prompt.
+        number_of_images:
+            Number of variants, at most 4.
+        response_format:
+            `base64` inlines the thumbnails. `gcs` stores them in the asset
+            bucket and returns their URIs and signed URLs.
+        settings:
+            Prompt and model snapshot of the run, the current one if None.
+
+    Returns:
+        A list of dicts with `generated_image`, `generated_image_uri` and
+        `generated_image_url`. Empty if no image could be generated.
+
+    Raises:
+        RateLimitExceeded or GenerationUnavailableError, so that the run
+        fails with 429 or 503 instead of silently sending no images.
+    """
     loop = asyncio.get_running_loop()
+    settings = settings or get_settings()
+    prompt_image = settings.prompts.prompt_image_generation.format(
+        image_context)
+    image_model_name = settings.models.image_model_name
+
+    with track_call(image_model_name, "email_image") as image_call:
+        async def attempt_image():
+            image_call.queue_wait += await get_limiter(
+                image_model_name).acquire()
+            return await loop.run_in_executor(
+                None,
+                functools.partial(
+                    get_image_model(image_model_name).generate_images,
+                    prompt=prompt_image,
+                    number_of_images=number_of_images))
+
+        try:
+            imagen_responses = await call_with_retry(
+                attempt_image, image_model_name)
+            image_call.response = imagen_responses
+        except (RateLimitExceeded, GenerationUnavailableError):
+            raise
+        except Exception as e:
+            print(prompt_image)
+            print(str(e))
+            imagen_responses = []
+
+    async def thumbnail(image) -> dict:
+        thumbnail = await utils_image.resize(image._image_bytes, (250, 250))
+        if response_format == "gcs":
+            stored_image = await loop.run_in_executor(
+                None,
+                functools.partial(
+                    utils_gcs.store_image,
+                    project_id,
+                    config["global"]["asset_bkt"],
+                    thumbnail,
+                    prefix=IMAGE_STORAGE.get("prefix", "generated-images"),
+                    url_ttl_seconds=IMAGE_STORAGE.get(
+                        "signed_url_ttl_seconds", 3600)))
+            return {
+                "generated_image": '',
+                "generated_image_uri": stored_image["uri"],
+                "generated_image_url": stored_image["url"]}
+        return {
+            "generated_image": await utils_image.to_base64(thumbnail),
+            "generated_image_uri": None,
+            "generated_image_url": None}
+
+    return list(await asyncio.gather(
+        *(thumbnail(image) for image in imagen_responses)))
+
+async def email_generate(row: pd.Series, theme: str,
+                         settings: Settings | None = None) -> pd.Series:
+    first_name = row['first_name']
+    settings = settings or get_settings()
+
+    email_prompt = settings.prompts.prompt_email_text.format(first_name,
+                                                             theme)
     progress_text = f"Generating email text for {first_name}"
     print(progress_text)
     generated_text = ""
-    generated_images = []
 
-    try:
-        generated_response = await loop.run_in_executor(
-            None, 
-            functools.partial(
-                text_llm.generate_content,
-                contents=email_prompt,
-                generation_config=GenerationConfig(temperature=0.2, 
-                                                    top_p=0.8, 
-                                                    top_k=40, 
-                                                    max_output_tokens=1024),
-            )
-        )
-    except Exception as e:
-        generated_response = None
-        print("Error")
-        print(str(e))
+    text_model_name = settings.models.text_model_name
+    text_llm = get_async_generative_model(text_model_name)
+
+    async def generate_text():
+        return await text_llm.generate_content_async(
+            contents=email_prompt,
+            generation_config=GENERATION_CONFIGS["email"])
+
+    with track_call(text_model_name, "email") as text_call:
+        async def attempt_text():
+            # Rows are paced by generate_emails, so they queue for as long
+            # as the limit requires instead of failing the whole run.
+            text_call.queue_wait += await get_limiter(text_model_name).acquire(
+                estimate_tokens(email_prompt), max_wait_seconds=math.inf)
+            return await call_with_deadline(
+                generate_text, text_model_name, "email")
+
+        try:
+            generated_response = await call_with_retry(
+                attempt_text, text_model_name)
+            text_call.response = generated_response
+        except (RateLimitExceeded, GenerationUnavailableError):
+            raise
+        except Exception as e:
+            generated_response = None
+            print("Error")
+            print(str(e))
 
     if generated_response and generated_response.text:
         generated_text = generated_response.text
@@ -120,66 +215,64 @@ async def email_generate(row: pd.Series, theme: str, image_context: str) -> pd.S
         generated_text = "No text was generated for this email."
 
     if "language" in row and row.language != "en":
-        translation = translate_client.translate(
+        translation = (await run_blocking(
+            "translate",
+            get_context().translate_client.translate,
             generated_text,
             source_language="en",
             target_language=row.language,
             format_="text"
-        )['translatedText']
+        ))['translatedText']
     else:
         translation = generated_text
-    if image_context != None and image_context != '':
-        try:
-            prompt_image = IMAGE_PROMPT
-            
-            imagen_responses = await loop.run_in_executor(
-                None,
-                functools.partial(
-                    imagen.generate_images,
-                        prompt=prompt_image.format(
-                            image_context
-                            ), 
-                        number_of_images=1))
-        except Exception as e:
-            print(prompt_image.format(
-                            image_context
-                            ))
-            print(str(e))
-        else:
-            for image in imagen_responses:
-                generated_images.append(
-                    {
-                        "images_base64_string": image._as_base64_string(),
-                    }
-                )
-    if len(generated_images) > 0 :
-        generated_image = generated_images[0]["images_base64_string"]
-        buffer = io.BytesIO()
-        imgdata = base64.b64decode(generated_image)
-        img = Image.open(io.BytesIO(imgdata))
-        new_img = img.resize((250, 250))
-        new_img.save(buffer, format="PNG")
-        generated_image = base64.b64encode(buffer.getvalue())
-    else:
-        generated_image = ''
 
     return pd.Series(
-        [row.first_name, row.email, generated_text, translation,LANGUAGES_MAP[row.language],generated_image],
-        index=["first_name","email","text","translation","language","generated_image"]
+        [row.first_name, row.email, generated_text, translation,LANGUAGES_MAP[row.language],'',None,None],
+        index=["first_name","email","text","translation","language","generated_image","generated_image_uri","generated_image_url"]
     )
 
 async def generate_emails(
         number_of_emails:int,
         theme: str,
         audience_data: list,
-        image_context:str
+        image_context:str,
+        response_format: str = "base64"
     ):
-        audience_dataframe = pd.DataFrame.from_dict(audience_data)
-        async_list = await asyncio.gather(
-        *(email_generate(person[1], theme=str(theme),image_context=image_context
-        ) for person in audience_dataframe.head(number_of_emails).iterrows()))
+        audience_dataframe = pd.DataFrame.from_dict(
+            audience_data).head(number_of_emails)
+        # Every email of the run uses the same prompts and models.
+        settings = get_settings()
+
+        async def no_images():
+            return []
+
+        # Only a few emails hold a rate limiter reservation at a time, so a
+        # large run queues behind the limit without pushing other requests
+        # past their maximum wait.
+        concurrency = asyncio.Semaphore(EMAIL_CONCURRENCY)
+
+        async def paced_email(row: pd.Series) -> pd.Series:
+            async with concurrency:
+                return await email_generate(
+                    row, theme=str(theme), settings=settings)
+
+        if image_context != None and image_context != '':
+            images = generate_image_variants(
+                image_context,
+                number_of_images=min(IMAGE_VARIANTS, len(audience_dataframe)),
+                response_format=response_format,
+                settings=settings)
+        else:
+            images = no_images()
+        images, async_list = await _gather_or_cancel(
+            images,
+            _gather_or_cancel(
+                *(paced_email(person[1])
+                  for person in audience_dataframe.iterrows())))
         #print(async_list)
         df = pd.concat(async_list,axis=1).T.to_dict('records')
+        # Recipients get the image variants round-robin.
+        if images:
+            for i, email in enumerate(df):
+                email.update(images[i % len(images)])
         return df
-
-
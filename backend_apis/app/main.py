@@ -12,9 +12,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import functools
+import math
+import mimetypes
+import secrets
 import time
-import tomllib
+import uuid
 import asyncio
+from contextlib import asynccontextmanager
+from .app_context import get_context, load_config
 from . import utils_codey
 from . import utils_search
 from . import utils_workspace
@@ -22,33 +28,33 @@ from . import utils_gcs
 from . import utils_firebase
 from . import utils_trendspotting as trendspotting
 from . import utils_prompt
+from . import utils_assets
+from . import utils_jobs
+from . import utils_image
 from . import bulk_email_util
+from .utils_models import get_generative_model, get_image_model
+from .utils_ratelimit import RateLimitExceeded, get_limiter
+from .utils_resilience import GenerationUnavailableError, call_with_retry_sync
+from .utils_telemetry import current_route, track_call
+from .utils_executors import run_blocking
+from .settings import SETTINGS_CONFIG, PromptSettings, get_settings, reload_settings, start_watcher
 from .logger import log 
 from datetime import datetime, timedelta
-from fastapi import FastAPI, HTTPException, UploadFile, Request, APIRouter
+from fastapi import FastAPI, HTTPException, UploadFile, Request, APIRouter, Depends, Response, Form, Header
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse, RedirectResponse
 from fastapi.staticfiles import StaticFiles
 from googleapiclient.discovery import build
-from google.cloud import bigquery
-from google.cloud import datacatalog_v1
-from google.cloud import discoveryengine
-from google.cloud import translate_v2 as translate
 from google.cloud import texttospeech
-import google.auth
 from proto import Message
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 
-import vertexai
-import google.auth
-from google.auth import impersonated_credentials
-import google.auth.transport.requests
-from google.api_core.client_info import ClientInfo
-from google.auth import credentials as auth_credentials
+from google.api_core import exceptions as google_exceptions
 
-from vertexai.generative_models import GenerativeModel, Part, FinishReason
+from vertexai.generative_models import Part, FinishReason
 import vertexai.preview.generative_models as generative_models
 
-from vertexai.preview.vision_models import ImageGenerationModel
 from vertexai.vision_models import Image
 
 import json
@@ -60,6 +66,7 @@ from .body_schema import (
     ImageGenerateRequest,
     ImageEditRequest,
     ImageGenerateResponse,
+    ImageResponseFormat,
     TrendTopReponse,
     NewsSummaryRequest,
     NewsSummaryResponse,
@@ -86,49 +93,29 @@ from .body_schema import (
     ExportGoogleDocRequest,
     ExportGoogleDocResponse,
     TexttoSpeechRequest,
-    TexttoSpeechResponse
+    TexttoSpeechResponse,
+    SimilarAssetsRequest,
+    SimilarAssetsResponse,
+    ImageJobResponse,
+    JobStatusResponse,
+    SettingsReloadResponse
 )
 
 # Load configuration file
-with open("/app/config.toml", "rb") as f:
-    config = tomllib.load(f)
+config = load_config()
 project_id = config["global"]["project_id"]
 location = config["global"]["location"]
 bucket_name = config["global"]["asset_bkt"]
 domain = config["global"]["domain"]
 
-credentials, project_id = google.auth.default()
-request = google.auth.transport.requests.Request()
-credentials.refresh(request)
-credentials.apply(headers = {'user-agent': 'cloud-solutions/genai-for-marketing-backend-v2.0'})
-
-vertexai.init(project=project_id, location=location, credentials=credentials)
-# Vertex AI Search Client
-search_client = discoveryengine.SearchServiceClient(credentials=credentials)
 vertexai_search_datastore = config["global"]["vertexai_search_datastore"]
 
 # Audiences
 dataset_id = config["global"]["dataset_id"]
-prompt_nl_sql = config["global"]["prompt_nl_sql"]
 tag_name = config["global"]["tag_name"]
 
-# Trendspotting
-bq_client = bigquery.Client(project=project_id, client_info=ClientInfo(user_agent='cloud-solutions/genai-for-marketing-backend-v2.0'))
-datacatalog_client = datacatalog_v1.DataCatalogClient(credentials=credentials)
-
-# Text models
-code_llm = GenerativeModel(config["models"]["code_model_name"])
-text_llm = GenerativeModel(config["models"]["text_model_name"])
-
-
-#translation
-translate_client = translate.Client(client_info=ClientInfo(user_agent='cloud-solutions/genai-for-marketing-backend-v2.0'))
-
-#texttospeech
-texttospeech_client = texttospeech.TextToSpeechLongAudioSynthesizeClient(credentials=credentials)
-
-# Image models
-imagen = ImageGenerationModel.from_pretrained(config["models"]["image_model_name"])
+# Credentials and clients are built on first use, or warmed by `lifespan`.
+context = get_context()
 
 drive_folder_id = config["global"]["drive_folder_id"]
 slides_template_id = config["global"]["slides_template_id"]
@@ -136,23 +123,51 @@ doc_template_id = config["global"]["doc_template_id"]
 sheet_template_id = config["global"]["sheet_template_id"]
 slide_page_id_list = config["global"]["slide_page_id_list"]
 
-#prompts
-BRAND_OVERVIEW = config["prompts"]["prompt_brand_overview"]
-BRAND_STATEMENT_PROMPT_TEMPLATE =config["prompts"]["prompt_brand_statement_template"]
-PRIMARY_MSG_PROMPT_TEMPLATE = config["prompts"]["prompt_primary_msg_template"]
-COMMS_CHANNEL_PROMPT_TEMPLATE = config["prompts"]["prompt_comms_channel_template"]
-BUSINESS_NAME = config["prompts"]["prompt_business_name"]
-EMAIL_TEXT_PROMPT = config["prompts"]["prompt_email_text"]
-IMAGE_GENERATION_PROMPT = config["prompts"]["prompt_image_generation"]
-WEBSITE_PROMPT_TEMPLATE = config["prompts"]["prompt_website_template"]
-IMAGE_PROMPT_TAMPLATE = config["prompts"]["prompt_image_template"]
-AD_PROMPT_TEMPLATE = config["prompts"]["ad_prompt_template"]
-HEADLINE_PROMPT_TEMPLATE = config["prompts"]["headline_prompt_template"]
-LONG_HEADLINE_PROMPT_TEMPLATE = config["prompts"]["load_headline_prompt_template"]
-DESCRIPTION_PROMPT_TEMPLATE = config["prompts"]["description_prompt_template"]
-
-router = APIRouter(prefix="/marketing-api")
-app = FastAPI(docs_url="/marketing-api/docs")
+COMBINED_GENERATION = config.get("combined_generation", {})
+# Images generated for /generate-content.
+CONTENT_NUMBER_OF_IMAGES = 4
+
+async def label_route(request: Request):
+    """Labels the telemetry of model calls with the route serving them.
+
+    Async so that the context variable is set in the request task and
+    inherited by the threadpool and the event loops the route starts.
+    """
+    route = request.scope.get("route")
+    current_route.set(route.path if route else request.url.path)
+
+
+def require_admin_token(x_admin_token: str | None = Header(default=None)):
+    """Admits requests carrying `[settings] admin_token` in X-Admin-Token.
+
+    Admin routes answer 404 while no token is configured.
+    """
+    admin_token = SETTINGS_CONFIG.get("admin_token", "")
+    if not admin_token:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if x_admin_token is None or not secrets.compare_digest(
+            x_admin_token.encode("utf-8"), admin_token.encode("utf-8")):
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Warms the credentials and clients of the app context before serving.
+
+    Startup only pays for the components under `[startup] eager`, built
+    concurrently; the others are built by the first request that needs them.
+    Also watches config.toml to reload the prompts and model names.
+    """
+    app.state.context = context
+    await context.startup()
+    stop_watcher = start_watcher()
+    yield
+    if stop_watcher is not None:
+        stop_watcher.set()
+
+
+router = APIRouter(prefix="/marketing-api", dependencies=[Depends(label_route)])
+app = FastAPI(docs_url="/marketing-api/docs", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -163,9 +178,109 @@ app.add_middleware(
 )
 
 
+@app.exception_handler(GenerationUnavailableError)
+async def generation_unavailable_handler(
+        request: Request, exc: GenerationUnavailableError):
+    """Upstream model is unhealthy: ask the client to retry later."""
+    log(f"Generation unavailable: {exc}")
+    return JSONResponse(
+        content={"detail": str(exc)},
+        status_code=503,
+        headers={"Retry-After": str(math.ceil(exc.retry_after))})
+
+
+@app.exception_handler(RateLimitExceeded)
+async def rate_limit_exceeded_handler(
+        request: Request, exc: RateLimitExceeded):
+    """Local model quota is exhausted: ask the client to retry later."""
+    return JSONResponse(
+        content={"detail": str(exc)},
+        status_code=429,
+        headers={"Retry-After": str(math.ceil(exc.wait_seconds))})
+
+
+def _use_combined(requested: bool | None, section: str) -> bool:
+    """Whether to generate `section` with one structured call.
+
+    The request flag wins; otherwise `[combined_generation]` decides.
+    """
+    if requested is None:
+        return COMBINED_GENERATION.get(section, False)
+    return requested
+
+
+def _section_text(value) -> str:
+    """Renders one section of a structured response as plain text."""
+    if isinstance(value, list):
+        return "\n".join(str(item) for item in value)
+    return str(value) if value else ""
+
+
+async def _generate_combined(
+        prompt: str,
+        response_schema: dict,
+        text_requests: dict[str, dict],
+        nocache: bool,
+        task: str
+    ) -> dict:
+    """Generates every field of `text_requests` with one structured call.
+
+    Fields missing from the JSON response are generated with their own
+    request from `text_requests`, as in the per-section mode.
+
+    Returns:
+        A dict mapping each field of `text_requests` to its generated text.
+    """
+    sections = await utils_prompt.async_predict_json_gemini(
+        prompt,
+        response_schema,
+        max_output_tokens=COMBINED_GENERATION.get("max_output_tokens", 4096),
+        nocache=nocache,
+        task=task)
+    generated = {
+        field: _section_text(sections.get(field)) for field in text_requests}
+    missing = [field for field, text in generated.items() if not text]
+    if missing:
+        log(f"Combined generation [{task}] missing {missing}, "
+            "generating them separately")
+        texts = await asyncio.gather(
+            *(utils_prompt.async_predict_text_gemini(
+                nocache=nocache,
+                task=task,
+                **text_requests[field])
+                for field in missing))
+        generated.update(zip(missing, texts))
+    return generated
+
+
+def _campaign_text_requests(data: CampaignCreateRequest,
+                            prompts: PromptSettings) -> dict[str, dict]:
+    """Builds the Gemini requests for the sections of the campaign brief.
+
+    Returns:
+        A dict mapping each brief section to the keyword arguments for
+        `utils_prompt.async_predict_text_gemini`.
+    """
+    brief_values = (
+        data.brief.gender_select_theme,
+        data.brief.age_select_theme,
+        data.brief.objective_select_theme,
+        data.brief.competitor_select_theme)
+    return {
+        "brand_statement": {
+            "prompt": prompts.prompt_brand_statement_template.format(
+                *brief_values, prompts.prompt_brand_overview)},
+        "primary_message": {
+            "prompt": prompts.prompt_primary_msg_template.format(
+                *brief_values, prompts.prompt_brand_overview)},
+        "comm_channels": {
+            "prompt": prompts.prompt_comms_channel_template.format(
+                *brief_values)}}
+
+
 # create-campaign
 @router.post("/users/{user_id}/campaigns")
-def create_campaign(user_id: str,data: CampaignCreateRequest
+async def create_campaign(user_id: str,data: CampaignCreateRequest
                     ) -> CampaignCreateResponse:
     """Campaign Creation and content generation with Gemini.
         Parameters:
@@ -178,6 +293,9 @@ def create_campaign(user_id: str,data: CampaignCreateRequest
                 "objective_select_theme":"Drive Awareness",
                 "competitor_select_theme":"Fashion Forward"
                 }
+            nocache: bool = False | Skip the LLM response cache
+            combined: bool | None = None | Generate the brief with one
+                structured call, defaults to [combined_generation]
         Returns:
             id (str): Response of generated Campaign ID
             campaign_name:str
@@ -188,50 +306,52 @@ def create_campaign(user_id: str,data: CampaignCreateRequest
     age_select_theme = data.brief.age_select_theme
     objective_select_theme = data.brief.objective_select_theme
     competitor_select_theme = data.brief.competitor_select_theme
-    async def generate_campaign() -> tuple:
-            return await asyncio.gather(
-                utils_prompt.async_predict_text_gemini(
-                    BRAND_STATEMENT_PROMPT_TEMPLATE.format(
-                        gender_select_theme, 
-                        age_select_theme,
-                        objective_select_theme,
-                        competitor_select_theme,
-                        BRAND_OVERVIEW)
-                        ),
-                utils_prompt.async_predict_text_gemini(
-                    PRIMARY_MSG_PROMPT_TEMPLATE.format(
-                        gender_select_theme, 
-                        age_select_theme,
-                        objective_select_theme,
-                        competitor_select_theme,
-                        BRAND_OVERVIEW)
-                    ),
-                utils_prompt.async_predict_text_gemini(
-                    COMMS_CHANNEL_PROMPT_TEMPLATE.format(
-                        gender_select_theme, 
-                        age_select_theme,
-                        objective_select_theme,
-                        competitor_select_theme)
-                    )) 
+    prompts = get_settings().prompts
+    text_requests = _campaign_text_requests(data, prompts)
+    async def generate_campaign() -> dict:
+        if _use_combined(data.combined, "campaign_brief"):
+            return await _generate_combined(
+                prompts.prompt_campaign_brief_combined_template.format(
+                    gender_select_theme,
+                    age_select_theme,
+                    objective_select_theme,
+                    competitor_select_theme,
+                    prompts.prompt_brand_overview),
+                utils_prompt.CAMPAIGN_BRIEF_SCHEMA,
+                text_requests,
+                nocache=data.nocache,
+                task="campaign_brief")
+        generated_tuple = await asyncio.gather(
+            *(utils_prompt.async_predict_text_gemini(
+                nocache=data.nocache,
+                task="campaign_brief",
+                **text_request)
+                for text_request in text_requests.values()))
+        return dict(zip(text_requests, generated_tuple))
     try:
-        generated_tuple = asyncio.run(generate_campaign())
-        log(generated_tuple)
-        brand_statement = generated_tuple[0] 
-        primary_message = generated_tuple[1]
-        comm_channels = generated_tuple[2]
+        generated_brief = await generate_campaign()
+        log(generated_brief)
+        brand_statement = generated_brief["brand_statement"]
+        primary_message = generated_brief["primary_message"]
+        comm_channels = generated_brief["comm_channels"]
         brief_scenario = (
                     f'Targeting gender: {gender_select_theme}, '
                     f'Age group: {age_select_theme}, '
                     f'Campaign objective: {objective_select_theme}, '
                     f'Competitor: {competitor_select_theme}') 
-        workspace_asset = post_brief_create_upload(BriefCreateRequest(
-            campaign_name=data.campaign_name,
-            business_name=BUSINESS_NAME,
-            brief_scenario=brief_scenario,
-            brand_statement=brand_statement,
-            primary_message=primary_message,
-            comm_channels=comm_channels
-            ))
+        workspace_asset = await run_blocking(
+            "workspace",
+            post_brief_create_upload,
+            BriefCreateRequest(
+                campaign_name=data.campaign_name,
+                business_name=prompts.prompt_business_name,
+                brief_scenario=brief_scenario,
+                brand_statement=brand_statement,
+                primary_message=primary_message,
+                comm_channels=comm_channels
+                ))
+    except (RateLimitExceeded, GenerationUnavailableError):
+        raise
     except Exception as e:
         log("Failed in Creating Content Asset")
         raise HTTPException(status_code=400, detail=str(e))
@@ -242,7 +362,9 @@ def create_campaign(user_id: str,data: CampaignCreateRequest
             brief=data.brief,
             workspace_assets=workspace_asset
             )
-        update_time,campaign_id = utils_firebase.create_campaign(
+        update_time,campaign_id = await run_blocking(
+            "firestore",
+            utils_firebase.create_campaign,
             user_id=user_id,
             campaign=campaign
             )
@@ -260,7 +382,8 @@ async def list_campaigns(user_id: str) -> CampaignListResponse:
     """
     List Existing Campaign for logged in user
     """
-    list_of_campaigns = utils_firebase.list_campaigns(user_id=user_id)
+    list_of_campaigns = await run_blocking(
+        "firestore", utils_firebase.list_campaigns, user_id=user_id)
     log(f"List of campaigns: {list_of_campaigns}")
     return CampaignListResponse(results=list_of_campaigns)
 
@@ -270,7 +393,11 @@ async def get_campaign(user_id: str,campaign_id:str) -> Campaign:
     """
     List Existing Campaign for logged in user
     """
-    campaign_resp = utils_firebase.read_campaign(user_id=user_id,campaign_id=campaign_id)
+    campaign_resp = await run_blocking(
+        "firestore",
+        utils_firebase.read_campaign,
+        user_id=user_id,
+        campaign_id=campaign_id)
     if campaign_resp == {}:
         raise HTTPException(
             status_code=400, 
@@ -284,7 +411,9 @@ async def update_campaign(user_id: str,campaign_id:str,data:Campaign):
     """
     Update Campiagn detail in backend storage
     """
-    response = utils_firebase.update_campaign(
+    response = await run_blocking(
+        "firestore",
+        utils_firebase.update_campaign,
         user_id=user_id,
         campaign_id=campaign_id,
         data=data
@@ -301,7 +430,9 @@ async def delete_campaign(user_id: str,campaign_id:str):
     """
     Delete Campiagn from backend storage
     """
-    response = utils_firebase.delete_campaign(
+    response = await run_blocking(
+        "firestore",
+        utils_firebase.delete_campaign,
         user_id=user_id,
         campaign_id=campaign_id
         )
@@ -317,7 +448,9 @@ async def update_status(user_id: str,campaign_id:str,data:CampaignStatusUpdate):
     """
     Update Campiagn Creative Component Status in backend storage
     """
-    response = utils_firebase.update_status(
+    response = await run_blocking(
+        "firestore",
+        utils_firebase.update_status,
         user_id=user_id,
         campaign_id=campaign_id,
         key=data.key,
@@ -329,93 +462,504 @@ async def update_status(user_id: str,campaign_id:str,data:CampaignStatusUpdate):
         status_code=200
         )
 
+def _wants_multipart(request: Request) -> bool:
+    """Whether the client asked for images as raw `multipart/mixed` parts."""
+    return "multipart/mixed" in request.headers.get("accept", "")
+
+
+def _multipart_part(boundary: str, image_id: int, image) -> bytes:
+    """Encodes one image as a raw image/png part of a multipart body."""
+    image_bytes = image._image_bytes
+    width, height = image._size
+    part_headers = (
+        f"--{boundary}\r\n"
+        "Content-Type: image/png\r\n"
+        f"Content-Length: {len(image_bytes)}\r\n"
+        f"X-Image-Id: {image_id}\r\n"
+        f"X-Image-Size: {width}x{height}\r\n"
+        "X-Image-Parameters: "
+        f"{json.dumps(image.generation_parameters, default=str)}\r\n"
+        "\r\n")
+    return part_headers.encode() + image_bytes + b"\r\n"
+
+
+def _multipart_images(images) -> StreamingResponse:
+    """Streams images as `multipart/mixed`, one raw PNG part per image.
+
+    Args:
+        images: Iterable or async iterable of (id, GeneratedImage) pairs,
+            each streamed as soon as it is produced. If an async iterable
+            fails, an application/json part with the error detail is sent
+            last.
+    """
+    boundary = uuid.uuid4().hex
+
+    async def parts():
+        if hasattr(images, "__aiter__"):
+            try:
+                async for image_id, image in images:
+                    yield _multipart_part(boundary, image_id, image)
+            except Exception as e:
+                log(f"Failed streaming images: {e}")
+                detail = json.dumps({"detail": str(e)})
+                yield (f"--{boundary}\r\n"
+                       "Content-Type: application/json\r\n"
+                       "\r\n"
+                       f"{detail}\r\n").encode()
+        else:
+            for image_id, image in images:
+                yield _multipart_part(boundary, image_id, image)
+        yield f"--{boundary}--\r\n".encode()
+
+    return StreamingResponse(
+        parts(), media_type=f"multipart/mixed; boundary={boundary}")
+
+
+async def _fan_out_images_response(
+        multipart: bool,
+        call_model,
+        number_of_images: int,
+        response_format: str,
+        task: str,
+        model_name: str):
+    """Serves an image route with one concurrent Imagen call per image.
+
+    Multipart responses stream each image as soon as its call completes.
+    They start once the first image is ready, so that a request no image
+    can be made for still fails with 429, 503 or 400 instead of a 200.
+    JSON responses hold the images that succeeded, in completion order.
+    """
+    images = utils_prompt.async_fan_out_images(
+        call_model, number_of_images, task, model_name)
+    try:
+        if multipart:
+            first = await anext(images, None)
+        else:
+            generated = [item async for item in images]
+    except (RateLimitExceeded, GenerationUnavailableError):
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if multipart:
+        if first is None:
+            return _multipart_images([])
+
+        async def streamed():
+            yield first
+            async for item in images:
+                yield item
+
+        return _multipart_images(streamed())
+
+    def response() -> ImageGenerateResponse:
+        # Encoding and uploading the images blocks, it runs on a thread.
+        return ImageGenerateResponse(
+            generated_images=[
+                {"id": image_id,
+                 **utils_prompt.image_payload(image, response_format)}
+                for image_id, image in generated])
+
+    return await asyncio.to_thread(response)
+
+
+def _images_response(multipart: bool, images: list, response_format: str):
+    """Serves the images of an image route as JSON or multipart."""
+    if multipart:
+        return _multipart_images(enumerate(images))
+    return ImageGenerateResponse(
+        generated_images=[
+            {"id": image_id,
+             **utils_prompt.image_payload(image, response_format)}
+            for image_id, image in enumerate(images)])
+
+
 @router.post(path="/generate-image")
-def post_image_generate(data: ImageGenerateRequest,
+async def post_image_generate(data: ImageGenerateRequest,
+                        request: Request
                         ) -> ImageGenerateResponse:
     """Image generation with Imagen
     Parameters:
         prompt: str
         number_of_images: int = 1
+        response_format: str = "base64" | "gcs" to get GCS references
+        fan_out: bool = False | One concurrent call per image; returns the
+            images that succeeded, in completion order
+        reuse_exact_prompt: bool = False | Return earlier images generated
+            with the exact same prompt (ignoring case and whitespace) from
+            the asset index, if it holds enough of them
     Returns:
         List of images with:
             id: image id
-            images_base64_string (str): Image as base64 string
+            images_base64_string (str): Image as base64 string ("base64")
+            uri, url, sha256 (str): GCS URI, signed URL and hash ("gcs")
             image_size (int, int): Size of the image
             images_parameters (dict): Parameters used with the model
+        With "Accept: multipart/mixed", a multipart/mixed stream with one
+        raw image/png part per image instead. Parts carry the X-Image-Id,
+        X-Image-Size and X-Image-Parameters (JSON) headers.
+    """
+    return await _generate_images(data, _wants_multipart(request))
+
+
+async def _generate_images(data: ImageGenerateRequest, multipart: bool):
+    """Serves a generation request as JSON or multipart.
+
+    Fan-out calls are awaited on the event loop; the blocking paths run on
+    a thread.
     """
+    if data.reuse_exact_prompt:
+        reused = await asyncio.to_thread(
+            utils_assets.reusable_images, data.prompt, data.number_of_images)
+        if reused is not None:
+            return await asyncio.to_thread(
+                _images_response, multipart, reused, data.response_format)
+
+    image_model_name = get_settings().models.image_model_name
+    if data.fan_out:
+        def generate_one():
+            response = get_image_model(image_model_name).generate_images(
+                prompt=data.prompt,
+                number_of_images=1,
+                negative_prompt=data.negative_prompt)
+            utils_assets.index_images(response, "generated", data.prompt)
+            return response
+
+        return await _fan_out_images_response(
+            multipart, generate_one, data.number_of_images,
+            data.response_format, "image", image_model_name)
+
+    return await asyncio.to_thread(
+        _generate_images_at_once, data, multipart, image_model_name)
+
+
+def _generate_images_at_once(data: ImageGenerateRequest, multipart: bool,
+                             image_model_name: str):
+    """Generates all the images of a request in one Imagen call."""
+    with track_call(image_model_name, "image") as call:
+        def attempt():
+            call.queue_wait += get_limiter(image_model_name).acquire_sync()
+            return get_image_model(image_model_name).generate_images(
+                prompt=data.prompt,
+                number_of_images=data.number_of_images,
+                negative_prompt=data.negative_prompt)
+
+        try:
+            imagen_responses = call_with_retry_sync(attempt, image_model_name)
+            call.response = imagen_responses
+        except (RateLimitExceeded, GenerationUnavailableError):
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    utils_assets.index_images(imagen_responses, "generated", data.prompt)
+    return _images_response(
+        multipart, imagen_responses, data.response_format)
+
+
+def _edit_input(name: str,
+                image_base64: str | None = None,
+                image_uri: str | None = None,
+                upload: UploadFile | None = None) -> Image | None:
+    """Builds an input image of `/edit-image` from the one form it was sent in.
+
+    A gs:// URI is passed on to Imagen as is, without downloading the image.
+    """
+    sent = [value for value in (image_base64, image_uri, upload) if value]
+    if len(sent) > 1:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Send the {name} as only one of base64, URI or file.")
     try:
-        imagen_responses = imagen.generate_images(
-            prompt=data.prompt,
-            number_of_images=data.number_of_images,
-            negative_prompt=data.negative_prompt)
+        if image_uri:
+            if not image_uri.startswith("gs://"):
+                raise ValueError(f"The {name} URI must start with gs://.")
+            return Image(gcs_uri=image_uri)
+        if upload:
+            return Image(image_bytes=upload.file.read())
+        if image_base64:
+            return Image(image_bytes=base64.b64decode(image_base64))
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
-    else:
-        generated_images = []
-        i=0
-        for image in imagen_responses:
-            generated_images.append(
-                {   
-                    "id": i ,
-                    "images_base64_string": image._as_base64_string(),
-                    "image_size": image._size,
-                    "images_parameters": image.generation_parameters
-                }
-            )
-            i=i+1
-
-    return ImageGenerateResponse(
-        generated_images=generated_images
-    )
+    return None
 
 
 @router.post(path="/edit-image")
-def post_image_edit(data: ImageEditRequest
+async def post_image_edit(data: ImageEditRequest,
+                    request: Request
                     ) -> ImageGenerateResponse:
     """Image editing with Imagen
     Parameters:
         prompt: str
-        base_image_base64: str
+        base_image_base64: str | None = None
+        base_image_uri: str | None = None | gs:// URI of the base image,
+            e.g. the uri of an image generated with "response_format": "gcs"
         mask_base64: str | None = None
+        mask_uri: str | None = None | gs:// URI of the mask
         number_of_images: int = 1
+        response_format: str = "base64" | "gcs" to get GCS references
+        fan_out: bool = False | One concurrent call per image; returns the
+            images that succeeded, in completion order
+        reuse_exact_prompt: bool = False | Return earlier edits made with
+            the exact same prompt (ignoring case and whitespace) of a similar
+            base image from the asset index, if it holds enough of them
+        Send the base image and the mask either as base64 or as URI.
     Returns:
         List of images with:
             id: imageid
-            images_base64_string (str): Image as base64 string
+            images_base64_string (str): Image as base64 string ("base64")
+            uri, url, sha256 (str): GCS URI, signed URL and hash ("gcs")
             image_size (int, int): Size of the image
             images_parameters (dict): Parameters used with the model
+        With "Accept: multipart/mixed", a multipart/mixed stream with one
+        raw image/png part per image instead. Parts carry the X-Image-Id,
+        X-Image-Size and X-Image-Parameters (JSON) headers.
     """
-    if not data.mask_base64:
-        mask = None
-    else:
-        mask = Image(image_bytes=base64.b64decode(data.mask_base64))
+    def read_inputs() -> tuple[Image | None, Image | None]:
+        # Decoding multi-MB base64 images blocks, it runs on a thread.
+        return (_edit_input(
+                    "base image", data.base_image_base64, data.base_image_uri),
+                _edit_input("mask", data.mask_base64, data.mask_uri))
+
+    base_image, mask = await asyncio.to_thread(read_inputs)
+    return await _edit_image(data, base_image, mask, _wants_multipart(request))
+
+
+@router.post(path="/edit-image/upload")
+async def post_image_edit_upload(
+        request: Request,
+        prompt: str = Form(),
+        base_image: UploadFile | None = None,
+        base_image_uri: str | None = Form(None),
+        mask: UploadFile | None = None,
+        mask_uri: str | None = Form(None),
+        number_of_images: int = Form(3),
+        negative_prompt: str | None = Form(None),
+        response_format: ImageResponseFormat = Form("base64"),
+        fan_out: bool = Form(False),
+        reuse_exact_prompt: bool = Form(False)
+        ) -> ImageGenerateResponse:
+    """Image editing with Imagen, from a multipart/form-data request
+    Parameters:
+        Same as /edit-image, as form fields, except that the base image and
+        the mask are sent as binary file parts `base_image` and `mask`, or
+        as gs:// URIs in `base_image_uri` and `mask_uri`.
+    Returns:
+        Same as /edit-image.
+    """
+    def read_inputs() -> tuple[Image | None, Image | None]:
+        try:
+            return (_edit_input("base image", image_uri=base_image_uri,
+                                upload=base_image),
+                    _edit_input("mask", image_uri=mask_uri, upload=mask))
+        finally:
+            for upload in (base_image, mask):
+                if upload:
+                    upload.file.close()
+
+    base, mask_image = await asyncio.to_thread(read_inputs)
+    data = ImageEditRequest(
+        prompt=prompt,
+        number_of_images=number_of_images,
+        negative_prompt=negative_prompt,
+        response_format=response_format,
+        fan_out=fan_out,
+        reuse_exact_prompt=reuse_exact_prompt)
+    return await _edit_image(
+        data, base, mask_image, _wants_multipart(request))
+
+
+async def _edit_image(data: ImageEditRequest, base_image: Image | None,
+                      mask: Image | None, multipart: bool):
+    """Serves an edit request, once its input images are built, as JSON or
+    multipart.
+
+    Fan-out calls are awaited on the event loop; the blocking paths run on
+    a thread.
+    """
+    if base_image is None:
+        raise HTTPException(status_code=400, detail="A base image is required.")
+
+    if data.reuse_exact_prompt:
+        reused = await asyncio.to_thread(
+            utils_assets.reusable_images,
+            data.prompt, data.number_of_images, base_image)
+        if reused is not None:
+            return await asyncio.to_thread(
+                _images_response, multipart, reused, data.response_format)
+
+    image_model_name = get_settings().models.image_model_name
+    if data.fan_out:
+        def edit_one():
+            response = get_image_model(image_model_name).edit_image(
+                prompt=data.prompt,
+                base_image=base_image,
+                mask=mask,
+                number_of_images=1,
+                negative_prompt=data.negative_prompt)
+            utils_assets.index_images(
+                response, "edited", data.prompt, base_image)
+            return response
+
+        return await _fan_out_images_response(
+            multipart, edit_one, data.number_of_images,
+            data.response_format, "image_edit", image_model_name)
+
+    return await asyncio.to_thread(
+        _edit_image_at_once, data, base_image, mask, multipart,
+        image_model_name)
+
+
+def _edit_image_at_once(data: ImageEditRequest, base_image: Image,
+                        mask: Image | None, multipart: bool,
+                        image_model_name: str):
+    """Edits all the images of a request in one Imagen call."""
+    with track_call(image_model_name, "image_edit") as call:
+        def attempt():
+            call.queue_wait += get_limiter(image_model_name).acquire_sync()
+            return get_image_model(image_model_name).edit_image(
+                prompt=data.prompt,
+                base_image=base_image,
+                mask=mask,
+                number_of_images=data.number_of_images,
+                negative_prompt=data.negative_prompt)
+
+        try:
+            imagen_responses = call_with_retry_sync(attempt, image_model_name)
+            call.response = imagen_responses
+        except (RateLimitExceeded, GenerationUnavailableError):
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    utils_assets.index_images(
+        imagen_responses, "edited", data.prompt, base_image)
+    return _images_response(
+        multipart, imagen_responses, data.response_format)
+
+
+def _submit_image_job(kind: str, serve) -> str:
+    """Runs an image route in the background and returns the job id.
+
+    `serve` is a coroutine function; the job thread runs it on its own event
+    loop.
+    """
+    def work() -> dict:
+        try:
+            return jsonable_encoder(asyncio.run(serve()))
+        except HTTPException as e:
+            raise utils_jobs.JobFailed(e.status_code, str(e.detail))
+        except RateLimitExceeded as e:
+            raise utils_jobs.JobFailed(429, str(e))
+        except GenerationUnavailableError as e:
+            raise utils_jobs.JobFailed(503, str(e))
+
+    return utils_jobs.submit(kind, work)
+
+
+def _job_accepted(response: Response, job_id: str) -> ImageJobResponse:
+    response.headers["Location"] = f"{router.prefix}/jobs/{job_id}"
+    return ImageJobResponse(job_id=job_id, status="pending")
+
+
+@router.post(path="/generate-image/jobs", status_code=202)
+def post_image_generate_job(data: ImageGenerateRequest,
+                            response: Response
+                            ) -> ImageJobResponse:
+    """Image generation with Imagen, as a background job
+    Parameters:
+        Same as /generate-image.
+    Returns:
+        202 Accepted with:
+            job_id: str | Poll GET /jobs/{job_id} (also in the Location
+                header) for the status and, once succeeded, the
+                /generate-image response as result
+            status: str = "pending"
+    """
+    job_id = _submit_image_job(
+        "generate_image",
+        functools.partial(_generate_images, data, False))
+    return _job_accepted(response, job_id)
+
+
+@router.post(path="/edit-image/jobs", status_code=202)
+def post_image_edit_job(data: ImageEditRequest,
+                        response: Response
+                        ) -> ImageJobResponse:
+    """Image editing with Imagen, as a background job
+    Parameters:
+        Same as /edit-image.
+    Returns:
+        202 Accepted with:
+            job_id: str | Poll GET /jobs/{job_id} (also in the Location
+                header) for the status and, once succeeded, the
+                /edit-image response as result
+            status: str = "pending"
+    """
+    base_image = _edit_input(
+        "base image", data.base_image_base64, data.base_image_uri)
+    if base_image is None:
+        raise HTTPException(status_code=400, detail="A base image is required.")
+    mask = _edit_input("mask", data.mask_base64, data.mask_uri)
+    job_id = _submit_image_job(
+        "edit_image",
+        functools.partial(_edit_image, data, base_image, mask, False))
+    return _job_accepted(response, job_id)
+
+
+@router.get(path="/jobs/{job_id}")
+def get_job(job_id: str) -> JobStatusResponse:
+    """Status of a background job
+    Parameters:
+        job_id: str
+    Returns:
+        job_id: str
+        kind: str | "generate_image" or "edit_image"
+        status: str | "pending", "running", "succeeded" or "failed"
+        result: dict | None | Response of the route, once succeeded
+        error: str | None | Error detail, once failed
+        status_code: int | None | HTTP status of the error, once failed
+        created, updated: float | Unix timestamps
+    """
+    job = utils_jobs.job_store.get(job_id)
+    if job is None:
+        raise HTTPException(
+            status_code=404, detail=f"Job {job_id} does not exist.")
+    return JobStatusResponse(**job)
 
+
+@router.post(path="/find-similar-assets")
+def post_find_similar_assets(data: SimilarAssetsRequest
+                             ) -> SimilarAssetsResponse:
+    """Find generated or uploaded images that look like an image
+    Parameters:
+        image_base64: str
+        max_distance: int | None = None | Largest perceptual hash distance
+            (0 to 7) that counts as similar, [asset_index] max_distance if
+            unset
+        limit: int = 10
+    Returns:
+        assets: list of dict, closest first, with:
+            uri (str): GCS URI of the image
+            source (str): "generated", "edited" or "uploaded"
+            prompt (str | None): Prompt the image was made with
+            dhash (str): Perceptual hash, hex
+            distance (int): Hamming distance to the given image
+    """
+    if utils_assets.asset_index is None:
+        raise HTTPException(
+            status_code=400, detail="The asset index is not enabled.")
     try:
-        imagen_responses = imagen.edit_image(
-            prompt=data.prompt,
-            base_image=Image(image_bytes=base64.b64decode(data.base_image_base64)),
-            mask=mask,
-            number_of_images=data.number_of_images,
-            negative_prompt=data.negative_prompt)
+        image_hash = utils_image.dhash_sync(
+            base64.b64decode(data.image_base64))
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
-    else:
-        generated_images = []
-        i = 0
-        for image in imagen_responses:
-            generated_images.append(
-                {   
-                    "id" : i,
-                    "images_base64_string": image._as_base64_string(),
-                    "image_size": image._size,
-                    "images_parameters": image.generation_parameters
-                }
-            )
-            i=i+1
 
-    return ImageGenerateResponse(
-        generated_images=generated_images
-    )
+    assets = utils_assets.asset_index.find_similar(
+        image_hash, limit=data.limit, max_distance=data.max_distance)
+    return SimilarAssetsResponse(
+        assets=[
+            {**asset, "dhash": f"{asset['dhash']:016x}"} for asset in assets])
 
 
 @router.get(path="/get-top-search-terms/{trends_date}")
@@ -436,7 +980,7 @@ def get_top_search_term(trends_date: str
             "GROUP BY 1,2 "
             "ORDER by rank ASC"
         )
-        query_job = bq_client.query(query, location="US")
+        query_job = context.bq_client.query(query, location="US")
         trends = [
             {"rank": i[1], "term":i[0]}
                 for i in query_job.result()
@@ -478,17 +1022,21 @@ def post_summarize_news(data: NewsSummaryRequest,request: Request
             status_code=400, 
             detail="No articles found. Try different keywords.")
 
+    text_model_name = get_settings().models.text_model_name
     try:
         summaries = []
         for doc in documents:
             summary = trendspotting.summarize_news_article(
                 doc["page_content"],
-                text_llm)
+                get_generative_model(text_model_name),
+                text_model_name)
             summaries.append({
                 "original_headline": doc["title"],
                 "summary":summary,
                 "url": doc["url"]
             })
+    except (RateLimitExceeded, GenerationUnavailableError):
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=400, 
@@ -509,6 +1057,7 @@ def post_audiences(data: AudiencesRequest) -> AudiencesResponse:
         gen_code: SQL code
     """
     # Audiences
+    settings = get_settings()
     tag_template_name = (f'projects/{project_id}/locations/'
                         f'{location}/tagTemplates/{config["global"]["tag_name"]}')
     query_metadata = (
@@ -517,17 +1066,20 @@ def post_audiences(data: AudiencesRequest) -> AudiencesResponse:
 
     try:
         audiences, gen_code, prompt = utils_codey.generate_sql_and_query(
-            llm=code_llm,
-            datacatalog_client=datacatalog_client,
-            prompt_template=prompt_nl_sql,
+            llm=get_generative_model(settings.models.code_model_name),
+            datacatalog_client=context.datacatalog_client,
+            prompt_template=settings.prompt_nl_sql,
             query_metadata=query_metadata,
             question=data.question,
             project_id=project_id,
             dataset_id=dataset_id,
             tag_template_name=tag_template_name,
-            bqclient=bq_client
+            bqclient=context.bq_client,
+            model_name=settings.models.code_model_name
         )
         crm_data = bulk_email_util.generate_information(audiences).to_dict('records')
+    except (RateLimitExceeded, GenerationUnavailableError):
+        raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
     
@@ -555,7 +1107,7 @@ def get_dataset_sample(table_name: str
         )
 
     query = f"SELECT * FROM `{project_id}.{dataset_id}.{table_name}` LIMIT 3"
-    result_job = bq_client.query(query=query)
+    result_job = context.bq_client.query(query=query)
     result = []
     for row in result_job:
         result.append(dict(row.items()))
@@ -585,7 +1137,7 @@ def post_consumer_insights(data: ConsumerInsightsRequest
             location=datastore_location,
             search_engine_id=vertexai_search_datastore,
             serving_config_id="default_config",
-            search_client=search_client)
+            search_client=context.search_client)
     except Exception as e:
         raise HTTPException(
             status_code=400, 
@@ -657,6 +1209,9 @@ def post_upload_file_gcs(folder_id: str,file: UploadFile):
             file=file.file,
             destination_blob_name=f"{folder_id}/{file.filename}"
         )
+        if (file.content_type or "").startswith("image/"):
+            file.file.seek(0)
+            utils_assets.index_upload(file.file.read(), f"gs://{file_path}")
     except Exception as e:
         raise HTTPException(
             status_code=400,
@@ -665,6 +1220,69 @@ def post_upload_file_gcs(folder_id: str,file: UploadFile):
         file.file.close()
     return file_path
 
+def _rendition_source(object_path: str, renditions_prefix: str) -> str:
+    """Returns the blob name of the image that `/image-renditions` serves.
+
+    Only images of the asset bucket are served, and never a rendition
+    itself, so the route cannot sign URLs to, or write into, other buckets.
+
+    Raises:
+        HTTPException: 404 if `object_path` names anything else.
+    """
+    bucket, _, blob_name = object_path.removeprefix("gs://").partition("/")
+    content_type, _ = mimetypes.guess_type(blob_name)
+    if (bucket != bucket_name
+            or not blob_name
+            or blob_name.startswith(f"{renditions_prefix}/")
+            or ".." in blob_name.split("/")
+            or not (content_type or "").startswith("image/")):
+        raise HTTPException(
+            status_code=404, detail=f"No asset image at {object_path}.")
+    return blob_name
+
+
+@router.get(path="/image-renditions/{object_path:path}")
+def get_image_rendition(object_path: str, size: str = "thumbnail"):
+    """Serve a downsized WebP copy of a stored image
+    Parameters:
+        object_path: str | "<bucket>/<object>", as returned by
+            post-upload-file-gcs and saved in campaigns. Only images of
+            the asset bucket are served.
+        size: str = "thumbnail" | A size name from [renditions] sizes, or
+            "original" for the image itself
+    Returns:
+        A redirect to a signed URL of the rendition. The rendition is made
+        on first request and cached in the bucket.
+    """
+    renditions = config.get("renditions", {})
+    sizes = renditions.get("sizes", {"thumbnail": 256, "preview": 1024})
+    if size != "original" and size not in sizes:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown size {size}. Use one of: original, "
+                   + ", ".join(sizes))
+    prefix = renditions.get("prefix", "renditions")
+    blob_name = _rendition_source(object_path, prefix)
+
+    try:
+        rendition = utils_gcs.get_rendition(
+            project_id,
+            bucket_name,
+            blob_name,
+            sizes.get(size),
+            image_format=renditions.get("format", "WEBP"),
+            quality=renditions.get("quality", 80),
+            prefix=prefix,
+            url_ttl_seconds=config.get("image_storage", {}).get(
+                "signed_url_ttl_seconds", 3600))
+    except google_exceptions.NotFound as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        raise HTTPException(
+            status_code=400,
+            detail="Something went wrong. Please try again." + str(e))
+    return RedirectResponse(rendition["url"])
+
 @router.post(path="/creative-brief-create-upload")
 def post_brief_create_upload(data: BriefCreateRequest) -> BriefCreateResponse:
     """Create a creative brief document and upload to Google Drive
@@ -781,12 +1399,12 @@ def translate_text(data: TranslateRequest
         i = 0
         while i*128 < len(text):
             if data.source_language_code == None:
-                result = translate_client.translate(
+                result = context.translate_client.translate(
                     text[i*128:i*128+128],
                     target_language=data.target_language_code
                     )['translatedText']
             else:
-                result = translate_client.translate(
+                result = context.translate_client.translate(
                     text[i*128:i*128+128],
                     source_language=data.source_language_code,
                     target_language=data.target_language_code,
@@ -803,8 +1421,68 @@ def translate_text(data: TranslateRequest
         translated_text=translated_text
     )
 
+def _content_text_requests(data: ContentCreationRequest,
+                           prompts: PromptSettings) -> dict[str, dict]:
+    """Builds the Gemini requests for the text fields of a content type.
+
+    Returns:
+        A dict mapping each field of `generated_content` to the keyword
+        arguments for `utils_prompt.async_predict_text_gemini`.
+    """
+    if data.type == 'Email':
+        return {
+            "text": {
+                "prompt": prompts.prompt_email_text.format(
+                    data.context,
+                    data.theme)}}
+    if data.type == 'Webpost':
+        return {
+            "text": {
+                "prompt": prompts.prompt_website_template.format(
+                    data.theme,
+                    data.context)}}
+    if data.type == 'SocialMedia':
+        return {
+            "text": {
+                "prompt": prompts.ad_prompt_template.format(
+                    prompts.prompt_business_name,
+                    data.no_of_char,
+                    data.audience_age_range,
+                    data.audience_gender,
+                    data.theme,
+                    data.context)}}
+    if data.type == 'AssetGroup':
+        return {
+            "headlines": {
+                "prompt": prompts.headline_prompt_template.format(
+                    data.theme,
+                    prompts.prompt_brand_overview),
+                "max_output_tokens": 256},
+            "long_headlines": {
+                "prompt": prompts.load_headline_prompt_template.format(
+                    data.theme,
+                    prompts.prompt_brand_overview)},
+            "description": {
+                "prompt": prompts.description_prompt_template.format(
+                    data.theme,
+                    prompts.prompt_brand_overview,
+                    data.context)}}
+    return {}
+
+
+def _content_static_fields(data: ContentCreationRequest,
+                           prompts: PromptSettings) -> dict:
+    """Fields of `generated_content` that do not need the LLM."""
+    if data.type == 'AssetGroup':
+        return {
+            "scenario": data.theme,
+            "business_name": prompts.prompt_business_name,
+            "call_to_action": "Shop Now"}
+    return {}
+
+
 @router.post(path="/generate-content")
-def generate_content(data: ContentCreationRequest
+async def generate_content(data: ContentCreationRequest
                      ) -> ContentCreationResponse:
     """Generate Content like Media , Ad or Emails
     Body:
@@ -815,6 +1493,11 @@ def generate_content(data: ContentCreationRequest
         audience_age_range: str = '20-30'
         audience_gender:str = 'All'
         image_generate: bool = True
+        nocache: bool = False | Skip the LLM response cache
+        combined: bool | None = None | AssetGroup only: generate all texts
+            with one structured call, defaults to [combined_generation]
+        response_format: str = "base64" | "gcs" to get GCS references
+        fan_out: bool = False | One concurrent Imagen call per image
     Returns:
         text_content :str
         images : list
@@ -822,68 +1505,45 @@ def generate_content(data: ContentCreationRequest
     
     images = []
     generated_content = {}
+    prompts = get_settings().prompts
+    text_requests = _content_text_requests(data, prompts)
     try:
-        if data.type == 'Email':
-            log("Generating Email..")
-            generated_content["text"]=asyncio.run(utils_prompt.async_predict_text_gemini(
-                        EMAIL_TEXT_PROMPT.format(
-                            data.context,
-                            data.theme
-                        )
-                        )
-                    )
-        elif data.type == 'Webpost':
-            generated_content["text"]=asyncio.run(utils_prompt.async_predict_text_gemini(
-                        WEBSITE_PROMPT_TEMPLATE.format(
-                            data.theme,
-                            data.context)))
-        elif data.type == 'SocialMedia':
-            generated_content["text"]=asyncio.run(utils_prompt.async_predict_text_gemini(
-                        AD_PROMPT_TEMPLATE.format(
-                            BUSINESS_NAME,
-                            data.no_of_char,
-                            data.audience_age_range,
-                            data.audience_gender,
-                            data.theme,
-                            data.context,
-                            )))
-        elif data.type == 'AssetGroup':
-            async def generate_brief() -> tuple:
-                return await asyncio.gather(
-                    utils_prompt.async_predict_text_gemini(
-                        prompt=HEADLINE_PROMPT_TEMPLATE.format(
-                            data.theme,
-                            BRAND_OVERVIEW),
-                        
-                        max_output_tokens=256
-                    ),
-                    utils_prompt.async_predict_text_gemini(
-                        prompt=LONG_HEADLINE_PROMPT_TEMPLATE.format(
-                            data.theme,
-                            BRAND_OVERVIEW)
-                        
-                    ),
-                    utils_prompt.async_predict_text_gemini(
-                        prompt=DESCRIPTION_PROMPT_TEMPLATE.format(
-                            data.theme,
-                            BRAND_OVERVIEW,
-                            data.context))) 
-    
-            generated_tuple = asyncio.run(generate_brief())
-            
-            generated_content["headlines"] = generated_tuple[0] 
-            generated_content["long_headlines"] = generated_tuple[1] 
-            generated_content["description"] = generated_tuple[2]
-            generated_content["scenario"] = data.theme
-            generated_content["business_name"] = BUSINESS_NAME
-            generated_content["call_to_action"] = "Shop Now"
+        log(f"Generating {data.type}..")
+        async def generate_text() -> tuple:
+            return await asyncio.gather(
+                *(utils_prompt.async_predict_text_gemini(
+                    nocache=data.nocache,
+                    task="content",
+                    **text_request)
+                    for text_request in text_requests.values()))
+
+        if (data.type == 'AssetGroup'
+                and _use_combined(data.combined, "asset_group")):
+            generated_content = await _generate_combined(
+                prompts.asset_group_combined_prompt_template.format(
+                    data.theme,
+                    prompts.prompt_brand_overview,
+                    data.context),
+                utils_prompt.ASSET_GROUP_SCHEMA,
+                text_requests,
+                nocache=data.nocache,
+                task="content")
+        else:
+            generated_tuple = await generate_text()
+            generated_content = dict(zip(text_requests, generated_tuple))
+        generated_content.update(_content_static_fields(data, prompts))
             
         if data.image_generate == True:
-            images = asyncio.run(utils_prompt.async_generate_image(
-                    prompt=IMAGE_PROMPT_TAMPLATE.format(
-                            data.theme,)
-            ))
+            images = await utils_prompt.async_generate_image(
+                    prompt=prompts.prompt_image_template.format(
+                            data.theme,),
+                    number_of_images=CONTENT_NUMBER_OF_IMAGES,
+                    response_format=data.response_format,
+                    fan_out=data.fan_out
+            )
              
+    except (RateLimitExceeded, GenerationUnavailableError):
+        raise
     except Exception as e:
             raise HTTPException(
             status_code=400, 
@@ -896,23 +1556,131 @@ def generate_content(data: ContentCreationRequest
     )
 
 
+def _sse_event(event: str, payload: dict) -> str:
+    """Formats one Server-Sent Events message."""
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+
+@router.post(path="/generate-content/stream")
+async def generate_content_stream(data: ContentCreationRequest
+                                  ) -> StreamingResponse:
+    """Generate Content like /generate-content, streamed as Server-Sent Events
+    Body:
+        Same as /generate-content
+    Returns:
+        text/event-stream with the events:
+            text: {"field": str, "delta": str} | next chunk of a text field
+            image: {"id": int, "images_base64_string": str, ...} | one image
+            error: {"detail": str} | a text field or the images failed
+            done: {"generated_content": dict} | full text, sent last
+    """
+    prompts = get_settings().prompts
+    text_requests = _content_text_requests(data, prompts)
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def stream_text(field: str, text_request: dict):
+        chunks = []
+        try:
+            async for chunk in utils_prompt.async_stream_text_gemini(
+                    nocache=data.nocache,
+                    task="content",
+                    **text_request):
+                chunks.append(chunk)
+                await queue.put(
+                    _sse_event("text", {"field": field, "delta": chunk}))
+        except Exception as e:
+            log(f"Failed streaming {field}: {e}")
+            await queue.put(
+                _sse_event("error", {"field": field, "detail": str(e)}))
+        return field, "".join(chunks)
+
+    async def stream_images_fan_out():
+        loop = asyncio.get_running_loop()
+        image_model_name = get_settings().models.image_model_name
+        generate_one = functools.partial(
+            get_image_model(image_model_name).generate_images,
+            prompt=prompts.prompt_image_template.format(data.theme),
+            number_of_images=1)
+        try:
+            async for image_id, image in utils_prompt.async_fan_out_images(
+                    generate_one, CONTENT_NUMBER_OF_IMAGES,
+                    model_name=image_model_name):
+                payload = await loop.run_in_executor(
+                    None, utils_prompt.image_payload,
+                    image, data.response_format)
+                await queue.put(
+                    _sse_event("image", {"id": image_id, **payload}))
+        except Exception as e:
+            log(f"Failed generating images: {e}")
+            await queue.put(
+                _sse_event("error", {"field": "images",
+                                     "detail": "Image generation failed."}))
+
+    async def stream_images():
+        if data.fan_out:
+            return await stream_images_fan_out()
+        try:
+            images = await utils_prompt.async_generate_image(
+                prompt=prompts.prompt_image_template.format(data.theme),
+                number_of_images=CONTENT_NUMBER_OF_IMAGES,
+                response_format=data.response_format)
+        except Exception as e:
+            log(f"Failed generating images: {e}")
+            images = None
+        if images is None:
+            await queue.put(
+                _sse_event("error", {"field": "images",
+                                     "detail": "Image generation failed."}))
+            return
+        for i, image in enumerate(images):
+            await queue.put(_sse_event("image", {"id": i, **image}))
+
+    async def event_stream():
+        tasks = [
+            asyncio.create_task(stream_text(field, text_request))
+            for field, text_request in text_requests.items()]
+        if data.image_generate:
+            tasks.append(asyncio.create_task(stream_images()))
+        all_done = asyncio.gather(*tasks)
+        all_done.add_done_callback(lambda _: queue.put_nowait(None))
+        try:
+            while (event := await queue.get()) is not None:
+                yield event
+            generated_content = dict(
+                result for result in all_done.result() if result)
+            generated_content.update(_content_static_fields(data, prompts))
+            yield _sse_event("done", {"generated_content": generated_content})
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
 @router.post(path="/bulk-email-generate")
-def post_bulk_email_generate(data: BulkEmailGenRequest) -> BulkEmailGenResponse:
+async def post_bulk_email_generate(data: BulkEmailGenRequest) -> BulkEmailGenResponse:
     """
     Parameters:
         audience : list[dict]
         theme : str
         image_context: str
+        response_format: str = "base64" | "gcs" to get GCS references
     Returns:
         persionlized_emails : list[dict]
     """
     
     try:
-        emails = asyncio.run(bulk_email_util.generate_emails(number_of_emails=data.no_of_emails,
+        emails = await bulk_email_util.generate_emails(number_of_emails=data.no_of_emails,
                                     theme=data.theme,
                                     audience_data=data.audience,
-                                    image_context = data.image_context))
+                                    image_context = data.image_context,
+                                    response_format=data.response_format)
         
+    except (RateLimitExceeded, GenerationUnavailableError):
+        raise
     except Exception as e:
             raise HTTPException(
             status_code=400, 
@@ -1006,7 +1774,7 @@ def text_to_speech(data: TexttoSpeechRequest
             output_gcs_uri=output_gcs_uri,
         )
 
-        operation = texttospeech_client.synthesize_long_audio(request=request)
+        operation = context.texttospeech_client.synthesize_long_audio(request=request)
         # Set a deadline for your LRO to finish. 300 seconds is reasonable, 
         # but can be adjusted depending on the length of the input.
         # If the operation times out, that likely means there was an error. 
@@ -1022,4 +1790,41 @@ def text_to_speech(data: TexttoSpeechRequest
     )
 
 
+@router.post(
+    path="/admin/reload-settings",
+    dependencies=[Depends(require_admin_token)])
+def post_reload_settings() -> SettingsReloadResponse:
+    """Reloads the prompt templates and model names from config.toml.
+    Requests in flight finish with the settings they started with. Only the
+    process serving this request reloads; the others pick the change up
+    within [settings] watch_interval_seconds. Disabled (404) unless
+    [settings] admin_token is set.
+    Headers:
+        X-Admin-Token (str): Must match [settings] admin_token
+    Returns:
+        previous_version (str): Settings version before the reload
+        version (str): Settings version now in use
+        changed (bool): Whether the prompts or model names changed
+    """
+    try:
+        previous, current = reload_settings()
+    except Exception as e:
+        log(f"Failed reloading settings: {e}")
+        raise HTTPException(
+            status_code=400,
+            detail="Invalid config.toml, settings not reloaded.")
+    return SettingsReloadResponse(
+        previous_version=previous.version,
+        version=current.version,
+        changed=current is not previous)
+
+
+@router.get(path="/metrics")
+def get_metrics() -> Response:
+    """Prometheus metrics: per-call model latency, queue wait and tokens,
+    response cache, request coalescing and hedging counters.
+    """
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
 app.include_router(router=router)
@@ -0,0 +1,198 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Typed, hot-reloadable settings: the prompt templates and model names.
+
+`get_settings()` returns the current Settings, an immutable snapshot of
+config.toml. A reload, triggered by the file watcher or the admin route,
+parses and validates the file and then swaps the snapshot in one
+assignment. Requests that already took a snapshot finish with it, and new
+requests see the new one. An invalid file is logged and the current
+settings are kept.
+
+Only `[prompts]`, the model names of `[models]` and `prompt_nl_sql` are
+reloaded. The other sections, and `[models] backend`, are read once at
+startup.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import tomllib
+from typing import Callable
+
+from pydantic import BaseModel, ConfigDict
+
+from .app_context import CONFIG_PATH, load_config
+from .logger import log
+
+
+class PromptSettings(BaseModel):
+    """Prompt templates of `[prompts]`."""
+
+    model_config = ConfigDict(frozen=True)
+
+    prompt_brand_overview: str
+    prompt_brand_statement_template: str
+    prompt_primary_msg_template: str
+    prompt_comms_channel_template: str
+    prompt_campaign_brief_combined_template: str
+    prompt_business_name: str
+    prompt_email_text: str
+    prompt_image_generation: str
+    prompt_website_template: str
+    prompt_image_template: str
+    ad_prompt_template: str
+    headline_prompt_template: str
+    load_headline_prompt_template: str
+    description_prompt_template: str
+    asset_group_combined_prompt_template: str
+
+
+class ModelSettings(BaseModel):
+    """Model names of `[models]`."""
+
+    model_config = ConfigDict(frozen=True)
+
+    text_model_name: str
+    image_model_name: str
+    code_model_name: str
+
+
+class Settings(BaseModel):
+    """Snapshot of the reloadable settings.
+
+    `version` is a short hash of the prompts and model names. It changes
+    whenever one of them does.
+    """
+
+    model_config = ConfigDict(frozen=True)
+
+    prompts: PromptSettings
+    models: ModelSettings
+    prompt_nl_sql: str
+    version: str
+
+    @classmethod
+    def from_config(cls, config: dict) -> "Settings":
+        """Validates the reloadable sections of a parsed config.toml."""
+        prompts = PromptSettings.model_validate(
+            {name: config["prompts"][name]
+             for name in PromptSettings.model_fields})
+        models = ModelSettings.model_validate(
+            {name: config["models"][name]
+             for name in ModelSettings.model_fields})
+        prompt_nl_sql = config["global"]["prompt_nl_sql"]
+        payload = json.dumps(
+            {"prompts": prompts.model_dump(), "models": models.model_dump(),
+             "prompt_nl_sql": prompt_nl_sql},
+            sort_keys=True,
+            ensure_ascii=False)
+        return cls(
+            prompts=prompts,
+            models=models,
+            prompt_nl_sql=prompt_nl_sql,
+            version=hashlib.sha256(payload.encode("utf-8")).hexdigest()[:12])
+
+
+SETTINGS_CONFIG = load_config().get("settings", {})
+
+_lock = threading.Lock()
+_loaded_mtime_ns = os.stat(CONFIG_PATH).st_mtime_ns
+_settings = Settings.from_config(load_config())
+_listeners: list[Callable[[Settings, Settings], None]] = []
+
+
+def get_settings() -> Settings:
+    """Returns the current settings.
+
+    Read it once per request and use that snapshot throughout, so that a
+    reload does not mix templates within a request.
+    """
+    return _settings
+
+
+def on_change(listener: Callable[[Settings, Settings], None]):
+    """Calls `listener(old, new)` after each reload that changes `version`."""
+    with _lock:
+        _listeners.append(listener)
+
+
+def reload_settings() -> tuple[Settings, Settings]:
+    """Reads config.toml again and swaps the settings if they changed.
+
+    Returns:
+        The previous and the current settings, the same object if nothing
+        changed.
+
+    Raises:
+        tomllib.TOMLDecodeError, KeyError or pydantic.ValidationError:
+            config.toml is invalid. The current settings are kept.
+    """
+    global _settings
+    with _lock:
+        with open(CONFIG_PATH, "rb") as f:
+            settings = Settings.from_config(tomllib.load(f))
+        previous = _settings
+        if settings.version == previous.version:
+            return previous, previous
+        _settings = settings
+        listeners = list(_listeners)
+
+    log(f"Settings reloaded: version {previous.version} -> {settings.version}")
+    for listener in listeners:
+        try:
+            listener(previous, settings)
+        except Exception as e:
+            log(f"Settings reload listener failed: {e}")
+    return previous, settings
+
+
+def _watch(interval_seconds: float, stop: threading.Event):
+    # An invalid file is reported once, not on every poll.
+    seen_mtime_ns = _loaded_mtime_ns
+    while not stop.wait(interval_seconds):
+        try:
+            mtime_ns = os.stat(CONFIG_PATH).st_mtime_ns
+            if mtime_ns == seen_mtime_ns:
+                continue
+            seen_mtime_ns = mtime_ns
+            reload_settings()
+        except Exception as e:
+            log(f"Failed reloading settings, keeping version "
+                f"{_settings.version}: {e}")
+
+
+def start_watcher() -> threading.Event | None:
+    """Reloads the settings whenever config.toml changes on disk.
+
+    Polls the file every `[settings] watch_interval_seconds`, so that each
+    worker process reloads on its own. Set the interval to 0 to disable.
+
+    Returns:
+        An Event that stops the watcher when set, or None if disabled.
+    """
+    interval_seconds = SETTINGS_CONFIG.get("watch_interval_seconds", 30)
+    if interval_seconds <= 0:
+        return None
+    stop = threading.Event()
+    threading.Thread(
+        target=_watch,
+        args=(interval_seconds, stop),
+        name="settings-watcher",
+        daemon=True).start()
+    return stop
@@ -0,0 +1,330 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Index of the images uploaded to or generated by the image routes.
+
+Each asset is recorded with its GCS URI, the prompt that produced it, a key
+of the normalized prompt and a 64-bit perceptual difference hash (dHash).
+The image routes use it to serve earlier images for a repeated prompt
+instead of calling Imagen, and to find assets that look like a given image.
+
+Near-duplicate lookups split the hash into 8-bit bands stored in their own
+indexed table: two hashes at most 7 bits apart share at least one band, so
+only assets sharing a band need their full distance computed.
+"""
+
+import concurrent.futures
+import hashlib
+import sqlite3
+import threading
+import time
+
+from vertexai.preview.vision_models import GeneratedImage
+
+from .app_context import load_config
+from . import utils_gcs
+from . import utils_image
+from .logger import log
+
+
+# Load configuration file
+config = load_config()
+
+ASSET_INDEX = config.get("asset_index", {})
+IMAGE_STORAGE = config.get("image_storage", {})
+
+_BANDS = 8
+_BAND_BITS = 64 // _BANDS
+
+
+def prompt_key(prompt: str) -> str:
+    """Key of a prompt, insensitive to case and whitespace."""
+    normalized = " ".join(prompt.lower().split())
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+def distance(hash_a: int, hash_b: int) -> int:
+    """Hamming distance between two perceptual hashes."""
+    return (hash_a ^ hash_b).bit_count()
+
+
+def _bands(image_hash: int) -> list[tuple[int, int]]:
+    mask = (1 << _BAND_BITS) - 1
+    return [
+        (band, (image_hash >> (band * _BAND_BITS)) & mask)
+        for band in range(_BANDS)]
+
+
+class AssetIndex:
+    """SQLite index of image assets by prompt and perceptual hash.
+
+    Thread-safe, so it can be shared by every request of the process.
+    """
+
+    def __init__(self, sqlite_path: str, max_distance: int=6):
+        self.max_distance = min(max_distance, _BANDS - 1)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(sqlite_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        # Hashes are stored as hex: SQLite integers are signed 64-bit.
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS assets ("
+            "uri TEXT PRIMARY KEY, source TEXT NOT NULL, prompt TEXT, "
+            "prompt_key TEXT, dhash TEXT NOT NULL, base_dhash TEXT, "
+            "created REAL NOT NULL)")
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS assets_prompt_key "
+            "ON assets (prompt_key, created)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS asset_bands ("
+            "band INTEGER NOT NULL, value INTEGER NOT NULL, uri TEXT NOT NULL, "
+            "PRIMARY KEY (band, value, uri)) WITHOUT ROWID")
+        self._db.commit()
+
+    def add(self, uri: str, source: str, image_hash: int,
+            prompt: str | None=None, base_hash: int | None=None):
+        """Records an asset, replacing any earlier entry for `uri`.
+
+        Args:
+            uri:
+                gs:// URI of the image.
+            source:
+                `generated`, `edited` or `uploaded`.
+            image_hash:
+                dHash of the image.
+            prompt:
+                Prompt the image was generated or edited with, if any.
+            base_hash:
+                dHash of the base image of an edit.
+        """
+        with self._lock:
+            self._db.execute("DELETE FROM asset_bands WHERE uri = ?", (uri,))
+            self._db.execute(
+                "INSERT OR REPLACE INTO assets (uri, source, prompt, "
+                "prompt_key, dhash, base_dhash, created) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (uri, source, prompt,
+                 prompt_key(prompt) if prompt is not None else None,
+                 f"{image_hash:016x}",
+                 f"{base_hash:016x}" if base_hash is not None else None,
+                 time.time()))
+            self._db.executemany(
+                "INSERT INTO asset_bands (band, value, uri) VALUES (?, ?, ?)",
+                [(band, value, uri) for band, value in _bands(image_hash)])
+            self._db.commit()
+
+    def find_by_prompt(self, prompt: str, limit: int,
+                       base_hash: int | None=None) -> list[dict]:
+        """Returns distinct-looking assets made with the same prompt.
+
+        Args:
+            prompt:
+                The generation or edit prompt.
+            limit:
+                Maximum number of assets.
+            base_hash:
+                For edits, the dHash of the base image. Only edits of a
+                similar base image match. Without it, only generated images
+                match.
+
+        Returns:
+            Newest first, dicts with `uri`, `source`, `prompt` and `dhash`.
+            Assets within `max_distance` of one already returned are skipped.
+        """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT uri, source, prompt, dhash, base_dhash FROM assets "
+                "WHERE prompt_key = ? ORDER BY created DESC",
+                (prompt_key(prompt),)).fetchall()
+
+        assets = []
+        for uri, source, asset_prompt, image_hash, asset_base in rows:
+            if base_hash is None:
+                if asset_base is not None:
+                    continue
+            elif (asset_base is None
+                  or distance(int(asset_base, 16), base_hash)
+                  > self.max_distance):
+                continue
+            image_hash = int(image_hash, 16)
+            if any(distance(image_hash, asset["dhash"]) <= self.max_distance
+                   for asset in assets):
+                continue
+            assets.append({
+                "uri": uri, "source": source, "prompt": asset_prompt,
+                "dhash": image_hash})
+            if len(assets) == limit:
+                break
+        return assets
+
+    def find_similar(self, image_hash: int, limit: int=10,
+                     max_distance: int | None=None) -> list[dict]:
+        """Returns the assets that look like an image.
+
+        Args:
+            image_hash:
+                dHash of the image.
+            limit:
+                Maximum number of assets.
+            max_distance:
+                Largest Hamming distance that counts as similar, at most 7.
+                Defaults to the index's `max_distance`.
+
+        Returns:
+            Closest first, dicts with `uri`, `source`, `prompt`, `dhash` and
+            `distance`.
+        """
+        if max_distance is None:
+            max_distance = self.max_distance
+        max_distance = min(max_distance, _BANDS - 1)
+        bands = _bands(image_hash)
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT uri, source, prompt, dhash FROM assets WHERE uri IN ("
+                "SELECT uri FROM asset_bands WHERE "
+                + " OR ".join(["(band = ? AND value = ?)"] * len(bands))
+                + ")",
+                [item for band in bands for item in band]).fetchall()
+
+        assets = []
+        for uri, source, prompt, asset_hash in rows:
+            asset_hash = int(asset_hash, 16)
+            asset_distance = distance(asset_hash, image_hash)
+            if asset_distance <= max_distance:
+                assets.append({
+                    "uri": uri, "source": source, "prompt": prompt,
+                    "dhash": asset_hash, "distance": asset_distance})
+        assets.sort(key=lambda asset: asset["distance"])
+        return assets[:limit]
+
+
+# Shared asset index, or None when disabled in config.toml.
+asset_index = None
+if ASSET_INDEX.get("enabled", False):
+    asset_index = AssetIndex(
+        ASSET_INDEX.get("sqlite_path", "/tmp/asset_index.sqlite3"),
+        max_distance=ASSET_INDEX.get("max_distance", 6))
+
+# Indexing uploads the image and hashes it, so it runs in the background
+# rather than on the request path.
+_indexer = concurrent.futures.ThreadPoolExecutor(
+    max_workers=2, thread_name_prefix="asset-index")
+
+
+def _index_image(image_bytes: bytes, source: str, prompt: str | None,
+                 uri: str | None, base_image):
+    try:
+        if uri is None:
+            uri = utils_gcs.store_image(
+                config["global"]["project_id"],
+                config["global"]["asset_bkt"],
+                image_bytes,
+                prefix=IMAGE_STORAGE.get("prefix", "generated-images"))["uri"]
+        asset_index.add(
+            uri, source, utils_image.dhash_sync(image_bytes), prompt=prompt,
+            base_hash=(utils_image.dhash_sync(base_image._image_bytes)
+                       if base_image is not None else None))
+    except Exception as e:
+        log(f"Failed indexing image asset {uri or ''}: {e}")
+
+
+def index_images(images, source: str="generated", prompt: str | None=None,
+                 base_image=None):
+    """Adds generated images to the asset index in the background.
+
+    Images are stored in the asset bucket under their content hash, like
+    images returned with `"response_format": "gcs"`, so only the routes that
+    can reuse them, /generate-image and /edit-image, index their images.
+    Does nothing when the index is disabled.
+
+    Args:
+        images:
+            Iterable of GeneratedImage, e.g. an ImageGenerationResponse.
+        source:
+            `generated` or `edited`.
+        prompt:
+            Prompt the images were made with.
+        base_image:
+            Base image of an edit, an Image. One given by GCS URI is only
+            downloaded in the background.
+    """
+    if asset_index is None:
+        return
+    for image in images:
+        _indexer.submit(
+            _index_image, image._image_bytes, source, prompt, None,
+            base_image)
+
+
+def index_upload(image_bytes: bytes, uri: str):
+    """Adds an uploaded image, already stored at `uri`, in the background."""
+    if asset_index is None:
+        return
+    _indexer.submit(_index_image, image_bytes, "uploaded", None, uri, None)
+
+
+def _load(uri: str) -> bytes:
+    bucket_name, _, blob_name = uri.removeprefix("gs://").partition("/")
+    return utils_gcs.download_from_gcs(
+        config["global"]["project_id"], bucket_name, blob_name).getvalue()
+
+
+def reusable_images(prompt: str, number_of_images: int, base_image=None
+                    ) -> list[GeneratedImage] | None:
+    """Returns earlier images made with the same prompt, if there are enough.
+
+    Prompts match exactly, up to case and whitespace; only the base images
+    of edits are compared for similarity.
+
+    Args:
+        prompt:
+            The generation or edit prompt.
+        number_of_images:
+            Number of images requested.
+        base_image:
+            For edits, the base Image. Only edits of a similar image match.
+
+    Returns:
+        `number_of_images` images whose generation parameters name the
+        reused asset, or None if the index holds fewer matching assets.
+    """
+    if asset_index is None:
+        return None
+    base_hash = None
+    if base_image is not None:
+        try:
+            base_hash = utils_image.dhash_sync(base_image._image_bytes)
+        except Exception as e:
+            log(f"Failed hashing base image: {e}")
+            return None
+    assets = asset_index.find_by_prompt(prompt, number_of_images, base_hash)
+    if not assets or len(assets) < number_of_images:
+        return None
+    try:
+        with concurrent.futures.ThreadPoolExecutor(len(assets)) as executor:
+            loaded = list(executor.map(
+                _load, [asset["uri"] for asset in assets]))
+    except Exception as e:
+        log(f"Failed loading image assets: {e}")
+        return None
+    images = [
+        GeneratedImage(
+            image_bytes=image_bytes,
+            generation_parameters={
+                "prompt": asset["prompt"], "reused_asset_uri": asset["uri"]})
+        for asset, image_bytes in zip(assets, loaded)]
+    log(f"Reusing {len(images)} indexed image assets")
+    return images
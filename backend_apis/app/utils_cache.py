@@ -0,0 +1,229 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Content-addressed cache for LLM responses.
+
+Entries are keyed by a hash of the model name, the prompt and the generation
+parameters. Lookups go to an in-memory LRU first and then, if configured, to
+a local SQLite file that survives restarts. Async callers use the `*_async`
+methods, which keep the SQLite tier off the event loop.
+"""
+
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from . import settings
+from .app_context import load_config
+from .logger import log
+
+
+# Load configuration file
+config = load_config()
+
+CACHE_CONFIG = config.get("cache", {})
+
+
+def make_key(model_name: str, prompt: str, generation_params: dict) -> str:
+    """Builds the cache key for a generation request.
+
+    Args:
+        model_name:
+            Name of the model that serves the request.
+        prompt:
+            The full prompt sent to the model.
+        generation_params:
+            Generation parameters such as temperature and max_output_tokens.
+
+    Returns:
+        A hex SHA-256 digest identifying the request.
+    """
+    payload = json.dumps(
+        {"model": model_name, "prompt": prompt, "params": generation_params},
+        sort_keys=True,
+        ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """In-memory LRU with TTL and an optional SQLite tier.
+
+    Thread-safe, so it can be shared by every request of the process. The
+    `*_async` methods serve the LRU on the event loop and run the SQLite
+    tier on a thread, so queries and commits never block the loop.
+    """
+
+    def __init__(
+            self,
+            max_entries: int=1024,
+            ttl_seconds: float=86400,
+            sqlite_path: str | None=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self._entries: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self._lock = threading.Lock()
+        # Separate from `_lock`, so that the LRU is not held up by SQLite.
+        self._db_lock = threading.Lock()
+        self._db = None
+        if sqlite_path:
+            self._db = sqlite3.connect(sqlite_path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL)")
+            self._db.commit()
+
+    def _remember(self, key: str, expires: float, value: str):
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _get_memory(self, key: str, now: float) -> str | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            if self._db is None:
+                self.misses += 1
+            return None
+
+    def _get_disk(self, key: str, now: float) -> str | None:
+        with self._db_lock:
+            row = self._db.execute(
+                "SELECT value, expires FROM responses WHERE key = ?",
+                (key,)).fetchone()
+            if row is not None and row[1] <= now:
+                self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._db.commit()
+                row = None
+        if row is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        self._remember(key, row[1], row[0])
+        with self._lock:
+            self.hits += 1
+            self.disk_hits += 1
+        return row[0]
+
+    def _set_disk(self, key: str, value: str, expires: float):
+        with self._db_lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, value, expires) "
+                "VALUES (?, ?, ?)",
+                (key, value, expires))
+            self._db.commit()
+
+    def _delete_disk(self, key: str):
+        with self._db_lock:
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._db.commit()
+
+    def get(self, key: str) -> str | None:
+        """Returns the cached value for `key`, or None if absent or expired."""
+        now = time.time()
+        value = self._get_memory(key, now)
+        if value is None and self._db is not None:
+            value = self._get_disk(key, now)
+        return value
+
+    async def get_async(self, key: str) -> str | None:
+        """Like `get`, with the SQLite lookup run on a thread."""
+        now = time.time()
+        value = self._get_memory(key, now)
+        if value is None and self._db is not None:
+            value = await asyncio.to_thread(self._get_disk, key, now)
+        return value
+
+    def set(self, key: str, value: str):
+        """Stores `value` under `key` in every tier."""
+        expires = time.time() + self.ttl_seconds
+        self._remember(key, expires, value)
+        if self._db is not None:
+            self._set_disk(key, value, expires)
+
+    async def set_async(self, key: str, value: str):
+        """Like `set`, with the SQLite write run on a thread."""
+        expires = time.time() + self.ttl_seconds
+        self._remember(key, expires, value)
+        if self._db is not None:
+            await asyncio.to_thread(self._set_disk, key, value, expires)
+
+    def delete(self, key: str):
+        """Drops `key` from every tier."""
+        with self._lock:
+            self._entries.pop(key, None)
+        if self._db is not None:
+            self._delete_disk(key)
+
+    async def delete_async(self, key: str):
+        """Like `delete`, with the SQLite delete run on a thread."""
+        with self._lock:
+            self._entries.pop(key, None)
+        if self._db is not None:
+            await asyncio.to_thread(self._delete_disk, key)
+
+    def clear(self):
+        """Drops every entry from every tier."""
+        with self._lock:
+            self._entries.clear()
+        if self._db is not None:
+            with self._db_lock:
+                self._db.execute("DELETE FROM responses")
+                self._db.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "disk_hits": self.disk_hits,
+                "entries": len(self._entries),
+            }
+
+
+# Shared response cache, or None when caching is disabled in config.toml.
+response_cache = None
+if CACHE_CONFIG.get("enabled", False):
+    response_cache = ResponseCache(
+        max_entries=CACHE_CONFIG.get("max_entries", 1024),
+        ttl_seconds=CACHE_CONFIG.get("ttl_seconds", 86400),
+        sqlite_path=CACHE_CONFIG.get("sqlite_path") or None)
+
+
+def _clear_on_settings_change(previous: settings.Settings,
+                              current: settings.Settings):
+    # Keys hash the full prompt, so entries made with the previous prompts
+    # can no longer be hit. Drop them now instead of at the end of their TTL.
+    response_cache.clear()
+    log(f"Response cache cleared for settings version {current.version}")
+
+
+if response_cache is not None:
+    settings.on_change(_clear_on_settings_change)
@@ -19,6 +19,17 @@ Utility module for Codey releated demo.
 
 from google.cloud import bigquery
 
+from .utils_models import GENERATION_CONFIGS
+from .utils_ratelimit import get_limiter
+from .utils_resilience import call_with_deadline_sync, call_with_retry_sync
+from .utils_telemetry import track_call
+from .utils_tokens import (
+    estimate_tokens,
+    fit_sections,
+    get_budget,
+    log_trim_stats
+)
+
 
 def get_tags_from_table(
         datacatalog_client,
@@ -154,10 +165,16 @@ def generate_prompt(
         state_key: 
             The key to use to store the prompt in the session state.
 
+    The schema context is capped at the `sql_schema` input budget from
+    `[prompt_budgets]` in config.toml.
+
     Returns:
         The prompt.
     """
     PROMPT_PROJECT_ID = [project_id]*7
+    metadata, trim_stats = fit_sections(
+        metadata, get_budget("sql_schema", 8000))
+    log_trim_stats("sql_schema", trim_stats)
     context = ''
     for i in metadata:
         context += i
@@ -176,7 +193,8 @@ def generate_sql_and_query(
         project_id: str,
         dataset_id: str,
         tag_template_name: str,
-        bqclient: bigquery.Client):
+        bqclient: bigquery.Client,
+        model_name: str | None = None):
     """Generates a GoogleSQL query and executes it against a BigQuery dataset.
 
     Args:
@@ -190,6 +208,8 @@ def generate_sql_and_query(
             The name of the tag template to use for the query.
         bqclient: 
             A BigQuery client object.
+        model_name:
+            Name of `llm`, used to pick its rate limiter.
 
     Returns:
         A DataFrame containing the results of the query.
@@ -213,10 +233,26 @@ def generate_sql_and_query(
         prompt_template,
         project_id)
 
-    gen_code = llm.generate_content(
-        prompt,
-        generation_config={ "temperature": 0.3,"max_output_tokens": 1024}
-    ).text.replace("```","")
+    limiter = get_limiter(model_name)
+    prompt_tokens = estimate_tokens(prompt)
+
+    def generate():
+        return llm.generate_content(
+            prompt,
+            generation_config=GENERATION_CONFIGS["sql"])
+
+    def hedge():
+        limiter.acquire_sync(prompt_tokens)
+        return generate()
+
+    with track_call(model_name, "sql") as call:
+        def attempt():
+            call.queue_wait += limiter.acquire_sync(prompt_tokens)
+            return call_with_deadline_sync(
+                generate, model_name, "sql", hedge_fn=hedge)
+
+        call.response = call_with_retry_sync(attempt, model_name)
+    gen_code = call.response.text.replace("```","")
     
     gen_code = gen_code[gen_code.find("SELECT"):]
     result = []
@@ -0,0 +1,72 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Bounded thread pools for blocking client libraries.
+
+Async routes hand their blocking Firestore, Google Workspace and Translation
+calls to one pool per service. The event loop keeps serving other requests
+meanwhile, and a slow service can hold at most its own pool's threads.
+"""
+
+import asyncio
+import concurrent.futures
+import contextvars
+import functools
+import threading
+from typing import Any, Callable
+from .app_context import load_config
+
+
+# Load configuration file
+config = load_config()
+
+EXECUTORS = config.get("executors", {})
+_DEFAULT_WORKERS = {"firestore": 8, "workspace": 8, "translate": 8}
+
+_executors_lock = threading.Lock()
+_executors: dict[str, concurrent.futures.ThreadPoolExecutor] = {}
+
+
+def get_executor(name: str) -> concurrent.futures.ThreadPoolExecutor:
+    """Returns the pool for a service, sized by `[executors] <name>`."""
+    with _executors_lock:
+        executor = _executors.get(name)
+        if executor is None:
+            executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=EXECUTORS.get(name, _DEFAULT_WORKERS.get(name, 4)),
+                thread_name_prefix=name)
+            _executors[name] = executor
+        return executor
+
+
+async def run_blocking(name: str, fn: Callable[..., Any], *args, **kwargs):
+    """Runs a blocking call on the pool of a service and awaits its result.
+
+    Args:
+        name:
+            The service, e.g. `firestore`, `workspace` or `translate`.
+        fn:
+            The blocking function, called with `args` and `kwargs`.
+
+    Returns:
+        The result of `fn`.
+    """
+    loop = asyncio.get_running_loop()
+    # Keep the route label for telemetry in the pool thread.
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(
+        get_executor(name),
+        functools.partial(context.run, fn, *args, **kwargs))
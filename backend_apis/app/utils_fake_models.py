@@ -0,0 +1,339 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Local stand-ins for the Gemini and Imagen models.
+
+Selected with `backend = "fake"` under `[models]` in config.toml, so the
+backend can be load-tested and profiled without credentials or quota.
+Texts are deterministic for a given seed, model and prompt. Like Imagen,
+image calls without a `seed` argument return new images every time, drawn
+from one seeded sequence per process. Latency, token counts and error rates
+are drawn from the `[fake_models]` settings.
+"""
+
+import asyncio
+import hashlib
+import io
+import json
+import random
+import threading
+import time
+from typing import Any, AsyncIterator, Iterator
+
+from google.api_core import exceptions as google_exceptions
+from PIL import Image as PIL_Image
+from PIL import ImageDraw
+from vertexai.generative_models import GenerationConfig, GenerationResponse
+from vertexai.preview.vision_models import (
+    GeneratedImage,
+    ImageGenerationResponse
+)
+
+from .app_context import load_config
+from .utils_tokens import estimate_tokens
+
+
+# Load configuration file
+config = load_config()
+
+FAKE_MODELS = config.get("fake_models", {})
+SEED = FAKE_MODELS.get("seed", 0)
+TEXT = FAKE_MODELS.get("text", {})
+IMAGE = FAKE_MODELS.get("image", {})
+
+_LOREM = (
+    "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod "
+    "tempor incididunt ut labore et dolore magna aliqua ut enim ad minim "
+    "veniam quis nostrud exercitation ullamco laboris nisi aliquip ex ea "
+    "commodo consequat duis aute irure in reprehenderit voluptate velit esse "
+    "cillum fugiat nulla pariatur excepteur sint occaecat cupidatat non "
+    "proident sunt culpa qui officia deserunt mollit anim id est laborum"
+).split()
+
+_ASPECT_RATIOS = {
+    "1:1": (1, 1), "9:16": (9, 16), "16:9": (16, 9), "4:3": (4, 3),
+    "3:4": (3, 4)}
+
+# Latency and errors vary from call to call but follow one seeded sequence
+# per process. Shared across threads, hence the lock.
+_rng_lock = threading.Lock()
+_rng = random.Random(SEED)
+
+
+def _output_rng(*parts: Any) -> random.Random:
+    """Returns a generator seeded by the request, for deterministic outputs."""
+    digest = hashlib.sha256(
+        json.dumps([SEED, *parts], sort_keys=True, default=str).encode())
+    return random.Random(digest.hexdigest())
+
+
+def _draw_call(settings: dict) -> tuple[float, bool]:
+    """Draws the base latency of one call and whether it fails."""
+    with _rng_lock:
+        latency = _rng.lognormvariate(0, settings.get("latency_sigma", 0.0))
+        failed = _rng.random() < settings.get("error_rate", 0.0)
+    return settings.get("latency_median_seconds", 0.0) * latency, failed
+
+
+def _unavailable(model_name: str) -> google_exceptions.ServiceUnavailable:
+    return google_exceptions.ServiceUnavailable(
+        f"Fake model {model_name} is unavailable (injected error).")
+
+
+def _lorem(rng: random.Random, words: int) -> str:
+    """Returns `words` words of lorem ipsum split into sentences."""
+    sentences = []
+    while words > 0:
+        length = min(words, rng.randint(6, 16))
+        sentence = [rng.choice(_LOREM) for _ in range(length)]
+        sentences.append(" ".join(sentence).capitalize() + ".")
+        words -= length
+    return " ".join(sentences)
+
+
+def _fake_value(rng: random.Random, schema: dict, words: int) -> Any:
+    """Builds a value matching an OpenAPI response schema."""
+    schema_type = str(schema.get("type", "STRING")).upper()
+    if schema_type == "OBJECT":
+        properties = schema.get("properties", {})
+        share = max(words // max(len(properties), 1), 1)
+        return {
+            name: _fake_value(rng, child, share)
+            for name, child in properties.items()}
+    if schema_type == "ARRAY":
+        count = 5
+        return [
+            _fake_value(rng, schema.get("items", {}), max(words // count, 1))
+            for _ in range(count)]
+    if schema_type in ("INTEGER", "NUMBER"):
+        return rng.randint(0, 100)
+    if schema_type == "BOOLEAN":
+        return rng.random() < 0.5
+    return _lorem(rng, words)
+
+
+def _prompt_text(contents: Any) -> str:
+    if isinstance(contents, str):
+        return contents
+    if isinstance(contents, (list, tuple)):
+        return "\n".join(_prompt_text(part) for part in contents)
+    return str(contents)
+
+
+def _response(text: str, prompt_tokens: int, output_tokens: int | None
+              ) -> GenerationResponse:
+    """Builds a response, or a stream chunk when `output_tokens` is None."""
+    candidate = {"content": {"role": "model", "parts": [{"text": text}]}}
+    response = {"candidates": [candidate]}
+    if output_tokens is not None:
+        candidate["finish_reason"] = "STOP"
+        response["usage_metadata"] = {
+            "prompt_token_count": prompt_tokens,
+            "candidates_token_count": output_tokens,
+            "total_token_count": prompt_tokens + output_tokens,
+        }
+    return GenerationResponse.from_dict(response)
+
+
+class FakeGenerativeModel:
+    """Drop-in for `GenerativeModel` returning lorem ipsum.
+
+    Supports `generate_content` and `generate_content_async`, streamed or
+    not. With a JSON `response_schema` in the generation config, the text is
+    a JSON document matching the schema.
+    """
+
+    def __init__(self, model_name: str):
+        self._model_name = model_name
+
+    def _plan(self, contents: Any, generation_config: GenerationConfig | None
+              ) -> tuple[float, float, bool, list[str], int, int]:
+        """Decides the latency, outcome and output chunks of one call."""
+        prompt = _prompt_text(contents)
+        settings = (generation_config.to_dict()
+                    if generation_config is not None else {})
+        rng = _output_rng(self._model_name, prompt, settings)
+        max_tokens = settings.get("max_output_tokens") or 8192
+        output_tokens = min(
+            rng.randint(
+                TEXT.get("output_tokens_min", 100),
+                TEXT.get("output_tokens_max", 500)),
+            max_tokens)
+        words = max(output_tokens * 3 // 4, 1)
+
+        if settings.get("response_mime_type") == "application/json":
+            text = json.dumps(_fake_value(
+                rng, settings.get("response_schema") or {}, words))
+            chunks = [text]
+        else:
+            text = _lorem(rng, words)
+            chunk_words = TEXT.get("stream_chunk_tokens", 20) * 3 // 4 or 1
+            text_words = text.split(" ")
+            chunks = [
+                " ".join(text_words[i:i + chunk_words]) + " "
+                for i in range(0, len(text_words), chunk_words)]
+            chunks[-1] = chunks[-1].rstrip()
+
+        first_token, failed = _draw_call(TEXT)
+        per_chunk = (
+            TEXT.get("seconds_per_output_token", 0.0)
+            * output_tokens / len(chunks))
+        return (first_token, per_chunk, failed, chunks,
+                estimate_tokens(prompt), output_tokens)
+
+    def generate_content(
+            self,
+            contents: Any,
+            *,
+            generation_config: GenerationConfig | None=None,
+            stream: bool=False,
+            **kwargs):
+        first_token, per_chunk, failed, chunks, prompt_tokens, output_tokens = (
+            self._plan(contents, generation_config))
+        time.sleep(first_token)
+        if failed:
+            raise _unavailable(self._model_name)
+        if stream:
+            return self._stream(chunks, per_chunk, prompt_tokens, output_tokens)
+        time.sleep(per_chunk * len(chunks))
+        return _response("".join(chunks), prompt_tokens, output_tokens)
+
+    def _stream(self, chunks: list[str], per_chunk: float,
+                prompt_tokens: int, output_tokens: int
+                ) -> Iterator[GenerationResponse]:
+        for i, chunk in enumerate(chunks):
+            time.sleep(per_chunk)
+            last = i == len(chunks) - 1
+            yield _response(
+                chunk, prompt_tokens, output_tokens if last else None)
+
+    async def generate_content_async(
+            self,
+            contents: Any,
+            *,
+            generation_config: GenerationConfig | None=None,
+            stream: bool=False,
+            **kwargs):
+        first_token, per_chunk, failed, chunks, prompt_tokens, output_tokens = (
+            self._plan(contents, generation_config))
+        await asyncio.sleep(first_token)
+        if failed:
+            raise _unavailable(self._model_name)
+        if stream:
+            return self._stream_async(
+                chunks, per_chunk, prompt_tokens, output_tokens)
+        await asyncio.sleep(per_chunk * len(chunks))
+        return _response("".join(chunks), prompt_tokens, output_tokens)
+
+    async def _stream_async(self, chunks: list[str], per_chunk: float,
+                            prompt_tokens: int, output_tokens: int
+                            ) -> AsyncIterator[GenerationResponse]:
+        for i, chunk in enumerate(chunks):
+            await asyncio.sleep(per_chunk)
+            last = i == len(chunks) - 1
+            yield _response(
+                chunk, prompt_tokens, output_tokens if last else None)
+
+
+def _fake_png(rng: random.Random, size: tuple[int, int]) -> bytes:
+    """Draws a deterministic abstract PNG of the given size."""
+    width, height = size
+    image = PIL_Image.new(
+        "RGB", size, tuple(rng.randrange(256) for _ in range(3)))
+    draw = ImageDraw.Draw(image)
+    for _ in range(8):
+        x0, y0 = rng.randrange(width), rng.randrange(height)
+        x1, y1 = rng.randrange(x0, width + 1), rng.randrange(y0, height + 1)
+        draw.rectangle(
+            (x0, y0, x1, y1), fill=tuple(rng.randrange(256) for _ in range(3)))
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+class FakeImageGenerationModel:
+    """Drop-in for `ImageGenerationModel` returning generated PNGs.
+
+    Images are square `[fake_models.image] size` pixels, or follow
+    `aspect_ratio`. Edited images keep the size of the base image.
+    """
+
+    def __init__(self, model_name: str):
+        self._model_name = model_name
+
+    def _generate(self, prompt: str, number_of_images: int,
+                  size: tuple[int, int], parameters: dict
+                  ) -> ImageGenerationResponse:
+        latency, failed = _draw_call(IMAGE)
+        time.sleep(
+            latency
+            + IMAGE.get("seconds_per_image", 0.0) * number_of_images)
+        if failed:
+            raise _unavailable(self._model_name)
+        seed = parameters.get("seed")
+        if seed is None:
+            # Otherwise the concurrent one-image calls of a fan-out would all
+            # return the same image.
+            with _rng_lock:
+                seed = _rng.getrandbits(32)
+        rng = _output_rng(self._model_name, prompt, parameters, seed)
+        images = [
+            GeneratedImage(
+                image_bytes=_fake_png(rng, size),
+                generation_parameters={**parameters, "index_of_image_in_batch": i})
+            for i in range(number_of_images)]
+        return ImageGenerationResponse(images=images)
+
+    def generate_images(
+            self,
+            prompt: str,
+            number_of_images: int=1,
+            negative_prompt: str | None=None,
+            aspect_ratio: str | None=None,
+            seed: int | None=None,
+            **kwargs) -> ImageGenerationResponse:
+        side = IMAGE.get("size", 1024)
+        ratio_w, ratio_h = _ASPECT_RATIOS.get(aspect_ratio or "1:1", (1, 1))
+        scale = side / max(ratio_w, ratio_h)
+        size = (round(ratio_w * scale), round(ratio_h * scale))
+        return self._generate(
+            prompt, number_of_images, size,
+            {"prompt": prompt,
+             "negative_prompt": negative_prompt,
+             "aspect_ratio": aspect_ratio,
+             "number_of_images_in_batch": number_of_images,
+             "seed": seed})
+
+    def edit_image(
+            self,
+            *,
+            prompt: str,
+            base_image,
+            mask=None,
+            number_of_images: int=1,
+            negative_prompt: str | None=None,
+            seed: int | None=None,
+            **kwargs) -> ImageGenerationResponse:
+        side = IMAGE.get("size", 1024)
+        size = getattr(base_image, "_size", None) or (side, side)
+        return self._generate(
+            prompt, number_of_images, tuple(size),
+            {"prompt": prompt,
+             "negative_prompt": negative_prompt,
+             "base_image_hash": hashlib.sha256(
+                 getattr(base_image, "_image_bytes", b"") or b"").hexdigest(),
+             "number_of_images_in_batch": number_of_images,
+             "seed": seed})
@@ -17,12 +17,10 @@
 Utility module for Firestore.
 """
 
-import firebase_admin
-from firebase_admin import firestore,credentials, auth
 import os
+from .app_context import get_context, load_config
 from .body_schema import Campaign, CampaignList
 import json
-import tomllib
 import google.auth
 import google.oauth2.id_token
 import google.auth.transport.requests
@@ -31,12 +29,8 @@ import google.auth.transport.requests
 HTTP_REQUEST = google.auth.transport.requests.Request()
 
 # Load configuration file
-with open("/app/config.toml", "rb") as f:
-    config = tomllib.load(f)
+config = load_config()
 
-# Application Default credentials are automatically created.
-app = firebase_admin.initialize_app()
-db = firestore.client()
 
 def to_serializable(val):
     if hasattr(val, '__dict__'):
@@ -45,7 +39,7 @@ def to_serializable(val):
 
 def verify_auth_token(id_token):
     # Verify Firebase auth.
-    _, project_id = google.auth.default()
+    project_id = get_context().credentials_project_id
     claims = google.oauth2.id_token.verify_firebase_token(
         id_token, HTTP_REQUEST, audience=project_id
     )
@@ -58,7 +52,7 @@ def verify_auth_token(id_token):
     return user_id
 
 def create_campaign(user_id,campaign:Campaign):
-    user_ref = db.collection("users").document(user_id)
+    user_ref = get_context().firestore.collection("users").document(user_id)
     if user_ref.get().exists:
         print("Found user")
     print(json.dumps(campaign.__dict__,default=to_serializable))
@@ -68,7 +62,7 @@ def create_campaign(user_id,campaign:Campaign):
 
 
 def read_campaign(user_id,campaign_id):
-    campaign_ref = db.collection("users").document(user_id).collection("campaigns").document(campaign_id)
+    campaign_ref = get_context().firestore.collection("users").document(user_id).collection("campaigns").document(campaign_id)
     camp = campaign_ref.get()
     if camp.exists:
         return camp.to_dict()
@@ -76,7 +70,7 @@ def read_campaign(user_id,campaign_id):
         return {}
 
 def list_campaigns(user_id):
-    campaign_col = db.collection("users").document(user_id).collection("campaigns").stream()
+    campaign_col = get_context().firestore.collection("users").document(user_id).collection("campaigns").stream()
     list_campaigns = []
     for campaign in campaign_col:
         camp_dict = campaign.to_dict()
@@ -85,14 +79,14 @@ def list_campaigns(user_id):
     return list_campaigns
 
 def update_campaign(user_id,campaign_id,data:Campaign):
-    camp_ref = db.collection("users").document(user_id).collection("campaigns").document(campaign_id)
+    camp_ref = get_context().firestore.collection("users").document(user_id).collection("campaigns").document(campaign_id)
     if camp_ref.get().exists:
         print("Updating Campaign")
         camp_ref.set(json.loads(json.dumps(data.__dict__,default=to_serializable)))
         return f"{campaign_id} Campaign is updated."
 
 def update_status(user_id,campaign_id,key,status):
-    camp_ref = db.collection("users").document(user_id).collection("campaigns").document(campaign_id)
+    camp_ref = get_context().firestore.collection("users").document(user_id).collection("campaigns").document(campaign_id)
     if camp_ref.get().exists:
         if key == "":
             camp_ref.update({"status" : status})
@@ -103,7 +97,7 @@ def update_status(user_id,campaign_id,key,status):
     
         
 def delete_campaign(user_id,campaign_id):
-    camp_ref = db.collection("users").document(user_id).collection("campaigns").document(campaign_id)
+    camp_ref = get_context().firestore.collection("users").document(user_id).collection("campaigns").document(campaign_id)
     if camp_ref.get().exists:
         print("Deleting Campaign")
         camp_ref.delete()
@@ -14,7 +14,17 @@
 
 from google.cloud import storage
 from google.api_core.client_info import ClientInfo
+from google.api_core import exceptions as google_exceptions
+import google.auth.credentials
+import google.auth.transport.requests
+from datetime import timedelta
+import functools
+import hashlib
 import io
+import mimetypes
+
+from . import utils_image
+
 
 def upload_to_gcs(project_id, bucket_name, file, destination_blob_name):
     """Uploads a file to Google Cloud Storage
@@ -51,4 +61,142 @@ def download_from_gcs(project_id,bucket_name,source_blob_name):
     blob.download_to_file(buffer)
 
     print(f"File gs://{bucket_name}/{source_blob_name} downloaded ")
-    return buffer
\ No newline at end of file
+    return buffer
+
+
+@functools.lru_cache(maxsize=None)
+def _storage_client(project_id: str) -> storage.Client:
+    return storage.Client(project=project_id, client_info=ClientInfo(user_agent='cloud-solutions/genai-for-marketing-backend-v2.0'))
+
+
+def _signing_kwargs(client: storage.Client) -> dict:
+    """Arguments to sign URLs with credentials that hold no private key.
+
+    On Cloud Run the service account credentials cannot sign locally, so
+    the URL is signed through the IAM signBlob API with an access token.
+    """
+    credentials = client._credentials
+    if isinstance(credentials, google.auth.credentials.Signing):
+        return {}
+    if not credentials.valid:
+        credentials.refresh(google.auth.transport.requests.Request())
+    return {
+        "service_account_email": credentials.service_account_email,
+        "access_token": credentials.token,
+    }
+
+
+def store_image(
+        project_id: str,
+        bucket_name: str,
+        image_bytes: bytes,
+        prefix: str = "generated-images",
+        url_ttl_seconds: int = 3600,
+        content_type: str = "image/png") -> dict:
+    """Stores an image under its content hash and returns a signed URL to it.
+
+    Identical images map to the same object, so each one is written once.
+
+    Args:
+        image_bytes (bytes): Encoded image.
+        prefix (str): Folder of the object in the GCS bucket.
+        url_ttl_seconds (int): Lifetime of the signed URL.
+
+    Returns:
+        dict with `uri` (gs:// URI of the object), `url` (signed HTTPS URL)
+        and `sha256` (hex digest of the image bytes).
+    """
+    sha256 = hashlib.sha256(image_bytes).hexdigest()
+    extension = mimetypes.guess_extension(content_type) or ""
+    blob_name = f"{prefix}/{sha256}{extension}"
+
+    client = _storage_client(project_id)
+    blob = client.bucket(bucket_name).blob(blob_name)
+    try:
+        blob.upload_from_string(
+            image_bytes, content_type=content_type, if_generation_match=0)
+    except google_exceptions.PreconditionFailed:
+        # Already stored by an earlier request with the same image.
+        pass
+
+    url = blob.generate_signed_url(
+        version="v4",
+        expiration=timedelta(seconds=url_ttl_seconds),
+        method="GET",
+        **_signing_kwargs(client))
+    return {
+        "uri": f"gs://{bucket_name}/{blob_name}",
+        "url": url,
+        "sha256": sha256,
+    }
+
+
+def get_rendition(
+        project_id: str,
+        bucket_name: str,
+        blob_name: str,
+        max_side: int | None,
+        image_format: str = "WEBP",
+        quality: int = 80,
+        prefix: str = "renditions",
+        url_ttl_seconds: int = 3600) -> dict:
+    """Returns a signed URL to a downsized copy of a stored image.
+
+    The copy is made on first request and kept in the bucket under a name
+    derived from the source object, its generation and the size, so it is
+    made once per version of the image.
+
+    Args:
+        blob_name (str): Name of the source image in the GCS bucket.
+        max_side (int | None): Largest width or height of the rendition,
+            or None for the source image itself.
+        image_format (str): PIL format of the rendition.
+        quality (int): Encoder quality of the rendition.
+        prefix (str): Folder of the renditions in the GCS bucket.
+        url_ttl_seconds (int): Lifetime of the signed URL.
+
+    Returns:
+        dict with `uri` (gs:// URI of the rendition) and `url` (signed HTTPS
+        URL).
+
+    Raises:
+        google.api_core.exceptions.NotFound: If the source image does not
+            exist.
+    """
+    client = _storage_client(project_id)
+    bucket = client.bucket(bucket_name)
+    source = bucket.get_blob(blob_name)
+    if source is None:
+        raise google_exceptions.NotFound(
+            f"gs://{bucket_name}/{blob_name} does not exist.")
+
+    if max_side is None:
+        blob = source
+    else:
+        extension = image_format.lower()
+        rendition_name = (
+            f"{prefix}/{max_side}/{blob_name}.{source.generation}.{extension}")
+        blob = bucket.get_blob(rendition_name)
+        if blob is None:
+            blob = bucket.blob(rendition_name)
+            rendition = utils_image.thumbnail_sync(
+                source.download_as_bytes(), max_side, image_format, quality)
+            try:
+                blob.upload_from_string(
+                    rendition,
+                    content_type=f"image/{extension}",
+                    if_generation_match=0)
+            except google_exceptions.PreconditionFailed:
+                # Made concurrently by another request.
+                pass
+            print(f"Rendition gs://{bucket_name}/{blob.name} created")
+
+    url = blob.generate_signed_url(
+        version="v4",
+        expiration=timedelta(seconds=url_ttl_seconds),
+        method="GET",
+        **_signing_kwargs(client))
+    return {
+        "uri": f"gs://{bucket_name}/{blob.name}",
+        "url": url,
+    }
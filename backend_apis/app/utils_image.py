@@ -0,0 +1,178 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Shared worker pool for CPU-bound image processing.
+
+Decoding, resizing and re-encoding of generated images run in a process
+pool, so they neither block the event loop nor hold the GIL of the process
+serving requests. Base64 encoding is a linear copy, cheaper than shipping
+the bytes to a worker, so it runs in the calling thread, or on a thread for
+coroutines. Async functions are for coroutines, `_sync` variants for the
+synchronous routes.
+"""
+
+import asyncio
+import base64
+import concurrent.futures
+import io
+import multiprocessing
+import threading
+
+from PIL import Image
+from .app_context import load_config
+
+
+# Load configuration file
+config = load_config()
+
+IMAGE_PROCESSING = config.get("image_processing", {})
+
+_pool_lock = threading.Lock()
+_pool: concurrent.futures.ProcessPoolExecutor | None = None
+
+
+def _get_pool() -> concurrent.futures.ProcessPoolExecutor:
+    """Returns the process pool, started on first use.
+
+    Workers are spawned rather than forked: forking a process that already
+    runs gRPC threads can deadlock the child.
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=IMAGE_PROCESSING.get("workers", 2),
+                    mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+
+def _to_base64(image_bytes: bytes) -> str:
+    return base64.b64encode(image_bytes).decode("ascii")
+
+
+# Worker functions. They run in the pool processes, so they must be
+# importable module-level functions.
+
+def _resize(image_bytes: bytes, size: tuple[int, int],
+            image_format: str="PNG") -> bytes:
+    image = Image.open(io.BytesIO(image_bytes))
+    buffer = io.BytesIO()
+    image.resize(size).save(buffer, format=image_format)
+    return buffer.getvalue()
+
+
+def _thumbnail(image_bytes: bytes, max_side: int, image_format: str,
+               quality: int) -> bytes:
+    image = Image.open(io.BytesIO(image_bytes))
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA")
+    image.thumbnail((max_side, max_side))
+    buffer = io.BytesIO()
+    image.save(buffer, format=image_format, quality=quality)
+    return buffer.getvalue()
+
+
+def _dhash(image_bytes: bytes, hash_size: int=8) -> int:
+    """Difference hash: compares adjacent pixels of a small grayscale copy."""
+    image = Image.open(io.BytesIO(image_bytes)).convert("L").resize(
+        (hash_size + 1, hash_size), Image.Resampling.LANCZOS)
+    pixels = list(image.getdata())
+    value = 0
+    for row in range(hash_size):
+        start = row * (hash_size + 1)
+        for col in range(start, start + hash_size):
+            value = (value << 1) | (pixels[col] > pixels[col + 1])
+    return value
+
+
+async def _run(fn, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_pool(), fn, *args)
+
+
+async def to_base64(image_bytes: bytes) -> str:
+    """Encodes image bytes as a base64 string, off the event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, _to_base64, image_bytes)
+
+
+async def resize(image_bytes: bytes, size: tuple[int, int],
+                 image_format: str="PNG") -> bytes:
+    """Decodes an image, resizes it to `size` and re-encodes it.
+
+    Args:
+        image_bytes:
+            The encoded image.
+        size:
+            Target (width, height) in pixels.
+        image_format:
+            PIL format of the result, e.g. `PNG` or `WEBP`.
+
+    Returns:
+        The encoded, resized image.
+    """
+    return await _run(_resize, image_bytes, size, image_format)
+
+
+def to_base64_sync(image_bytes: bytes) -> str:
+    """Variant of `to_base64` for synchronous code paths, in the calling
+    thread."""
+    return _to_base64(image_bytes)
+
+
+def resize_sync(image_bytes: bytes, size: tuple[int, int],
+                image_format: str="PNG") -> bytes:
+    """Blocking variant of `resize` for synchronous code paths."""
+    return _get_pool().submit(
+        _resize, image_bytes, size, image_format).result()
+
+
+async def dhash(image_bytes: bytes) -> int:
+    """Computes the 64-bit perceptual difference hash of an image.
+
+    Near-identical images, e.g. re-encoded or resized copies, have hashes a
+    small Hamming distance apart.
+    """
+    return await _run(_dhash, image_bytes)
+
+
+def thumbnail_sync(image_bytes: bytes, max_side: int,
+                   image_format: str="WEBP", quality: int=80) -> bytes:
+    """Shrinks an image to fit in a `max_side` square, keeping its aspect.
+
+    Images already smaller keep their size but are still re-encoded.
+
+    Args:
+        image_bytes:
+            The encoded image.
+        max_side:
+            Largest width or height of the result, in pixels.
+        image_format:
+            PIL format of the result.
+        quality:
+            Encoder quality, for lossy formats.
+
+    Returns:
+        The encoded thumbnail.
+    """
+    return _get_pool().submit(
+        _thumbnail, image_bytes, max_side, image_format, quality).result()
+
+
+def dhash_sync(image_bytes: bytes) -> int:
+    """Blocking variant of `dhash` for synchronous code paths."""
+    return _get_pool().submit(_dhash, image_bytes).result()
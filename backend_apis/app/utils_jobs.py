@@ -0,0 +1,177 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Background jobs for long-running generations.
+
+A job route stores a pending job, runs the work on a small thread pool of
+its own and answers `202 Accepted` with the job id right away, so a slow
+Imagen call no longer holds one of the server's request threads. Jobs live
+in a local SQLite file: every worker process on the host sees every job,
+whichever process runs it.
+"""
+
+import concurrent.futures
+import contextvars
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Callable
+
+from .app_context import load_config
+from .logger import log
+
+
+# Load configuration file
+config = load_config()
+
+JOBS_CONFIG = config.get("jobs", {})
+
+
+class JobFailed(Exception):
+    """Raised by a job to fail with a given HTTP status code."""
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+class JobStore:
+    """SQLite table of jobs, shared by the processes of the host.
+
+    Thread-safe, so it can be shared by every request of the process.
+    Finished jobs are purged `ttl_seconds` after they were created. Jobs
+    left pending or running for `stale_seconds`, e.g. by a process that
+    was restarted, are marked failed as interrupted.
+    """
+
+    def __init__(self, sqlite_path: str, ttl_seconds: float=3600,
+                 stale_seconds: float=900):
+        self.ttl_seconds = ttl_seconds
+        self.stale_seconds = stale_seconds
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            sqlite_path, timeout=30, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id TEXT PRIMARY KEY, kind TEXT NOT NULL, status TEXT NOT NULL, "
+            "result TEXT, error TEXT, status_code INTEGER, "
+            "created REAL NOT NULL, updated REAL NOT NULL)")
+        self._fail_stale(time.time())
+        self._db.commit()
+
+    def _fail_stale(self, now: float):
+        interrupted = self._db.execute(
+            "UPDATE jobs SET status = 'failed', error = ?, status_code = 500, "
+            "updated = ? WHERE updated < ? AND status IN ('pending', 'running')",
+            ("The job was interrupted before it finished.", now,
+             now - self.stale_seconds)).rowcount
+        if interrupted:
+            log(f"Marked {interrupted} interrupted jobs as failed")
+
+    def create(self, kind: str) -> str:
+        """Stores a new pending job and returns its id."""
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "DELETE FROM jobs WHERE created < ? "
+                "AND status IN ('succeeded', 'failed')",
+                (now - self.ttl_seconds,))
+            self._fail_stale(now)
+            self._db.execute(
+                "INSERT INTO jobs (id, kind, status, created, updated) "
+                "VALUES (?, ?, 'pending', ?, ?)",
+                (job_id, kind, now, now))
+            self._db.commit()
+        return job_id
+
+    def update(self, job_id: str, status: str, result: Any=None,
+               error: str | None=None, status_code: int | None=None):
+        """Sets the status of a job and, once finished, its outcome."""
+        with self._lock:
+            self._db.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, "
+                "status_code = ?, updated = ? WHERE id = ?",
+                (status,
+                 json.dumps(result) if result is not None else None,
+                 error, status_code, time.time(), job_id))
+            self._db.commit()
+
+    def get(self, job_id: str) -> dict | None:
+        """Returns the job as a dict, or None if unknown or purged."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT id, kind, status, result, error, status_code, "
+                "created, updated FROM jobs WHERE id = ?",
+                (job_id,)).fetchone()
+        if row is None:
+            return None
+        return {
+            "job_id": row[0],
+            "kind": row[1],
+            "status": row[2],
+            "result": json.loads(row[3]) if row[3] is not None else None,
+            "error": row[4],
+            "status_code": row[5],
+            "created": row[6],
+            "updated": row[7],
+        }
+
+
+job_store = JobStore(
+    JOBS_CONFIG.get("sqlite_path", "/tmp/jobs.sqlite3"),
+    ttl_seconds=JOBS_CONFIG.get("ttl_seconds", 3600),
+    stale_seconds=JOBS_CONFIG.get("stale_seconds", 900))
+
+_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=JOBS_CONFIG.get("workers", 4), thread_name_prefix="job")
+
+
+def _run(job_id: str, work: Callable[[], Any]):
+    job_store.update(job_id, "running")
+    try:
+        result = work()
+    except JobFailed as e:
+        job_store.update(
+            job_id, "failed", error=e.detail, status_code=e.status_code)
+    except Exception as e:
+        log(f"Job {job_id} failed: {e}")
+        job_store.update(job_id, "failed", error=str(e), status_code=500)
+    else:
+        job_store.update(job_id, "succeeded", result=result)
+
+
+def submit(kind: str, work: Callable[[], Any]) -> str:
+    """Runs `work` as a background job.
+
+    Args:
+        kind:
+            Label of the job, e.g. `generate_image`.
+        work:
+            Blocking function returning the JSON-serializable result. It may
+            raise JobFailed to set the HTTP status code of the failure.
+
+    Returns:
+        The job id.
+    """
+    job_id = job_store.create(kind)
+    # Keep the route label for telemetry in the job thread.
+    _executor.submit(contextvars.copy_context().run, _run, job_id, work)
+    return job_id
@@ -0,0 +1,195 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Process-wide registry of Vertex AI model handles and generation configs.
+
+Every code path that talks to Gemini gets its model from here, so a model
+is constructed once per process instead of once per call. With
+`backend = "fake"` under `[models]` in config.toml, the handles are local
+stand-ins from `utils_fake_models` instead of Vertex AI models.
+"""
+
+import asyncio
+import functools
+import json
+import threading
+import weakref
+
+from vertexai.generative_models import GenerativeModel, GenerationConfig
+from vertexai.preview.vision_models import ImageGenerationModel
+
+from .app_context import get_context, load_config
+from .utils_fake_models import FakeGenerativeModel, FakeImageGenerationModel
+
+
+# Load configuration file
+config = load_config()
+
+# "vertex" (default) or "fake".
+MODEL_BACKEND = config["models"].get("backend", "vertex")
+
+
+_models_lock = threading.Lock()
+_generative_models: dict[str, GenerativeModel] = {}
+_image_models: dict[str, ImageGenerationModel] = {}
+# The SDK binds its async gRPC channel to the event loop that first uses it,
+# so handles used with `generate_content_async` are kept per running loop.
+_async_generative_models: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict[str, GenerativeModel]]" = (
+    weakref.WeakKeyDictionary())
+
+
+def _new_generative_model(model_name: str) -> GenerativeModel:
+    if MODEL_BACKEND == "fake":
+        return FakeGenerativeModel(model_name)
+    get_context().init_vertexai()
+    return GenerativeModel(model_name)
+
+
+def load_image_model(model_name: str) -> ImageGenerationModel:
+    """Loads the Imagen model `model_name` from the configured backend."""
+    if MODEL_BACKEND == "fake":
+        return FakeImageGenerationModel(model_name)
+    get_context().init_vertexai()
+    return ImageGenerationModel.from_pretrained(model_name)
+
+
+def get_generative_model(model_name: str) -> GenerativeModel:
+    """Returns the shared GenerativeModel handle for `model_name`.
+
+    Args:
+        model_name:
+            Name of the Gemini model, e.g. `gemini-1.5-pro`.
+
+    Returns:
+        A GenerativeModel that is created on first use and reused afterwards.
+    """
+    llm = _generative_models.get(model_name)
+    if llm is None:
+        with _models_lock:
+            llm = _generative_models.get(model_name)
+            if llm is None:
+                llm = _new_generative_model(model_name)
+                _generative_models[model_name] = llm
+    return llm
+
+
+def get_image_model(model_name: str) -> ImageGenerationModel:
+    """Returns the shared ImageGenerationModel handle for `model_name`.
+
+    `from_pretrained` looks up the model metadata, so it runs once per model
+    on first use instead of on every image request.
+
+    Args:
+        model_name:
+            Name of the Imagen model, e.g. `imagen-3.0-generate-001`.
+
+    Returns:
+        An ImageGenerationModel that is loaded on first use and reused
+        afterwards.
+    """
+    imagen = _image_models.get(model_name)
+    if imagen is None:
+        with _models_lock:
+            imagen = _image_models.get(model_name)
+            if imagen is None:
+                imagen = load_image_model(model_name)
+                _image_models[model_name] = imagen
+    return imagen
+
+
+def get_async_generative_model(model_name: str) -> GenerativeModel:
+    """Returns the GenerativeModel handle to use with the SDK async methods.
+
+    Must be called from a coroutine. Handles are shared by every coroutine
+    running on the same event loop and released when the loop is discarded.
+
+    Args:
+        model_name:
+            Name of the Gemini model, e.g. `gemini-1.5-pro`.
+
+    Returns:
+        A GenerativeModel whose async client belongs to the running loop.
+    """
+    loop = asyncio.get_running_loop()
+    with _models_lock:
+        loop_models = _async_generative_models.setdefault(loop, {})
+        llm = loop_models.get(model_name)
+        if llm is None:
+            llm = _new_generative_model(model_name)
+            loop_models[model_name] = llm
+    return llm
+
+
+@functools.lru_cache(maxsize=64)
+def get_generation_config(
+        temperature: float=0.4,
+        top_p: float | None=0.8,
+        top_k: int | None=40,
+        max_output_tokens: int=2048,
+        candidate_count: int=1
+    ) -> GenerationConfig:
+    """Returns a shared GenerationConfig for the given parameters.
+
+    Configs are immutable once built, so one instance per distinct set of
+    parameters is reused by every caller.
+    """
+    return GenerationConfig(
+        temperature=temperature,
+        top_p=top_p,
+        top_k=top_k,
+        candidate_count=candidate_count,
+        max_output_tokens=max_output_tokens)
+
+
+
+@functools.lru_cache(maxsize=16)
+def get_json_generation_config(
+        response_schema_json: str,
+        temperature: float=0.4,
+        top_p: float | None=0.8,
+        top_k: int | None=40,
+        max_output_tokens: int=2048
+    ) -> GenerationConfig:
+    """Returns a shared GenerationConfig for structured JSON output.
+
+    Args:
+        response_schema_json:
+            The OpenAPI response schema serialized with
+            `json.dumps(schema, sort_keys=True)`, so that it can be memoised.
+
+    Returns:
+        A GenerationConfig with `response_mime_type="application/json"`.
+    """
+    return GenerationConfig(
+        temperature=temperature,
+        top_p=top_p,
+        top_k=top_k,
+        candidate_count=1,
+        max_output_tokens=max_output_tokens,
+        response_mime_type="application/json",
+        response_schema=json.loads(response_schema_json))
+
+
+# Preset generation configs used across the backend.
+GENERATION_CONFIGS = {
+    "default": get_generation_config(),
+    "email": get_generation_config(
+        temperature=0.2, top_p=0.8, top_k=40, max_output_tokens=1024),
+    "sql": get_generation_config(
+        temperature=0.3, top_p=None, top_k=None, max_output_tokens=1024),
+    "summary": get_generation_config(
+        temperature=0.8, top_p=0.8, top_k=None, max_output_tokens=2048),
+}
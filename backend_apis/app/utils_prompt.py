@@ -20,89 +20,468 @@ A utility module for performing prompt engineering with the Vertex Gemini.
 
 import asyncio
 import functools
+import json
+from typing import Any, AsyncIterator, Callable
 
-import vertexai
-import google.auth
-from google.auth import impersonated_credentials
-import google.auth.transport.requests
-from google.api_core.client_info import ClientInfo
-from google.auth import credentials as auth_credentials
+from vertexai.generative_models import GenerationConfig
 
-import tomllib
-from vertexai.preview.vision_models import ImageGenerationModel
-from vertexai.generative_models import GenerativeModel , GenerationConfig
+from .app_context import load_config
+from .settings import get_settings
+from .utils_models import (
+    get_async_generative_model,
+    get_generation_config,
+    get_json_generation_config,
+    get_image_model
+)
+from .utils_ratelimit import get_limiter
+from .utils_tokens import estimate_tokens
+from .utils_cache import make_key, response_cache
+from .utils_singleflight import image_flights, text_flights
+from .utils_telemetry import track_call
+from . import utils_gcs
+from . import utils_image
+from .utils_ratelimit import RateLimitExceeded
+from .utils_resilience import (
+    GenerationUnavailableError,
+    call_with_deadline,
+    call_with_retry,
+    wait_with_deadline
+)
 
 # Load configuration file
-with open("/app/config.toml", "rb") as f:
-    config = tomllib.load(f)
+config = load_config()
 project_id = config["global"]["project_id"]
 location = config["global"]["location"]
+IMAGE_STORAGE = config.get("image_storage", {})
 
-credentials, project_id = google.auth.default()
-request = google.auth.transport.requests.Request()
-credentials.refresh(request)
-credentials.apply(headers = {'user-agent': 'cloud-solutions/genai-for-marketing-backend-v2.0'})
-
-vertexai.init(project=project_id, location=location, credentials=credentials)
+# Response schemas for the combined (one call, JSON output) generation mode.
+# Property names match the fields of the responses they are split into.
+CAMPAIGN_BRIEF_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "brand_statement": {"type": "STRING"},
+        "primary_message": {"type": "STRING"},
+        "comm_channels": {"type": "ARRAY", "items": {"type": "STRING"}},
+    },
+    "required": ["brand_statement", "primary_message", "comm_channels"],
+}
+ASSET_GROUP_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "headlines": {"type": "ARRAY", "items": {"type": "STRING"}},
+        "long_headlines": {"type": "ARRAY", "items": {"type": "STRING"}},
+        "description": {"type": "STRING"},
+    },
+    "required": ["headlines", "long_headlines", "description"],
+}
 
 
+def _text_request_key(
+        prompt: str,
+        model_name: str,
+        max_output_tokens: int,
+        temperature: float,
+        top_k: int,
+        top_p: float
+    ) -> str:
+    """Returns the key identifying a text request in the cache and flights."""
+    return make_key(
+        model_name,
+        prompt,
+        {"max_output_tokens": max_output_tokens,
+         "temperature": temperature,
+         "top_k": top_k,
+         "top_p": top_p})
 
 
 async def async_predict_text_gemini(
         prompt: str,
-        model_name: str=config["models"]["text_model_name"],
+        model_name: str | None=None,
         max_output_tokens: int=2048,
         temperature: float=0.4,
         top_k: int=40,
-        top_p: float=0.8
+        top_p: float=0.8,
+        nocache: bool=False,
+        task: str="default"
     )-> str:
-    loop = asyncio.get_running_loop()
-    llm = GenerativeModel(model_name)
+    """Generates text with Gemini.
+
+    When the response cache is enabled in config.toml, identical requests are
+    answered from the cache. `nocache` skips the lookup and refreshes the
+    cached entry with the new generation. `task` selects the deadline and
+    hedging statistics from `[deadlines]` and `[hedging]`.
+    """
+    model_name = model_name or get_settings().models.text_model_name
+    request_key = _text_request_key(
+        prompt, model_name, max_output_tokens, temperature, top_k, top_p)
+    if response_cache is not None and not nocache:
+        cached_text = await response_cache.get_async(request_key)
+        if cached_text is not None:
+            return cached_text
+
+    generation_config = get_generation_config(
+        temperature=temperature,
+        top_p=top_p,
+        top_k=top_k,
+        max_output_tokens=max_output_tokens)
+    return await text_flights.do(
+        request_key,
+        functools.partial(
+            _generate_text,
+            prompt,
+            model_name,
+            generation_config,
+            request_key,
+            task))
+
+
+async def _generate_text(
+        prompt: str,
+        model_name: str,
+        generation_config: GenerationConfig,
+        request_key: str,
+        task: str
+    ) -> str:
+    """Performs one upstream Gemini call and caches its text."""
+    llm = get_async_generative_model(model_name)
+    limiter = get_limiter(model_name)
+    prompt_tokens = estimate_tokens(prompt)
     generated_response = None
-    generation_config = GenerationConfig(
-    temperature=temperature,
-    top_p=top_p,
-    top_k=top_k,
-    candidate_count=1,
-    max_output_tokens=max_output_tokens,
-)
-    try:
-        generated_response = await loop.run_in_executor(
-            None,
-            functools.partial(
-                llm.generate_content,
-                    prompt, 
-                    generation_config=generation_config))
-    except Exception as e:
-        print(e)
+
+    async def generate():
+        return await llm.generate_content_async(
+            prompt,
+            generation_config=generation_config)
+
+    async def hedge():
+        await limiter.acquire(prompt_tokens)
+        return await generate()
+
+    with track_call(model_name, task) as call:
+        async def attempt():
+            call.queue_wait += await limiter.acquire(prompt_tokens)
+            return await call_with_deadline(
+                generate, model_name, task, hedge_fn=hedge)
+
+        try:
+            generated_response = await call_with_retry(attempt, model_name)
+            call.response = generated_response
+        except (GenerationUnavailableError, RateLimitExceeded):
+            raise
+        except Exception as e:
+            print(e)
 
     if generated_response and generated_response.text:
+        if response_cache is not None:
+            await response_cache.set_async(
+                request_key, generated_response.text)
         return generated_response.text
     return ""
 
 
-async def async_generate_image(prompt,number_of_images=4):
+async def async_predict_json_gemini(
+        prompt: str,
+        response_schema: dict,
+        model_name: str | None=None,
+        max_output_tokens: int=2048,
+        temperature: float=0.4,
+        top_k: int=40,
+        top_p: float=0.8,
+        nocache: bool=False,
+        task: str="default"
+    ) -> dict:
+    """Generates a JSON object matching `response_schema` with Gemini.
+
+    Shares the cache, request coalescing, rate limiting, deadlines and retries
+    of `async_predict_text_gemini`.
+
+    Returns:
+        The decoded object, or an empty dict if nothing valid was generated.
+    """
+    model_name = model_name or get_settings().models.text_model_name
+    schema_json = json.dumps(response_schema, sort_keys=True)
+    request_key = make_key(
+        model_name,
+        prompt,
+        {"max_output_tokens": max_output_tokens,
+         "temperature": temperature,
+         "top_k": top_k,
+         "top_p": top_p,
+         "response_schema": schema_json})
+    generated_text = None
+    if response_cache is not None and not nocache:
+        generated_text = await response_cache.get_async(request_key)
+
+    if generated_text is None:
+        generation_config = get_json_generation_config(
+            schema_json,
+            temperature=temperature,
+            top_p=top_p,
+            top_k=top_k,
+            max_output_tokens=max_output_tokens)
+        generated_text = await text_flights.do(
+            request_key,
+            functools.partial(
+                _generate_text,
+                prompt,
+                model_name,
+                generation_config,
+                request_key,
+                task))
+
+    try:
+        generated_object = json.loads(generated_text) if generated_text else {}
+    except ValueError as e:
+        print(f"Invalid JSON from {model_name}: {e}")
+        if response_cache is not None:
+            await response_cache.delete_async(request_key)
+        return {}
+    if not isinstance(generated_object, dict):
+        return {}
+    return generated_object
+
+
+async def async_stream_text_gemini(
+        prompt: str,
+        model_name: str | None=None,
+        max_output_tokens: int=2048,
+        temperature: float=0.4,
+        top_k: int=40,
+        top_p: float=0.8,
+        nocache: bool=False,
+        task: str="default"
+    ) -> AsyncIterator[str]:
+    """Streams text from Gemini as it is generated.
+
+    Yields the same text as `async_predict_text_gemini`, split into the chunks
+    returned by `generate_content(stream=True)`. A cached response is yielded
+    as a single chunk. `task` labels the call telemetry.
+    """
+    model_name = model_name or get_settings().models.text_model_name
+    request_key = _text_request_key(
+        prompt, model_name, max_output_tokens, temperature, top_k, top_p)
+    if response_cache is not None and not nocache:
+        cached_text = await response_cache.get_async(request_key)
+        if cached_text is not None:
+            yield cached_text
+            return
+
+    llm = get_async_generative_model(model_name)
+    generation_config = get_generation_config(
+        temperature=temperature,
+        top_p=top_p,
+        top_k=top_k,
+        max_output_tokens=max_output_tokens)
+    limiter = get_limiter(model_name)
+    prompt_tokens = estimate_tokens(prompt)
+
+    with track_call(model_name, task) as call:
+        async def open_stream():
+            responses = await llm.generate_content_async(
+                prompt,
+                generation_config=generation_config,
+                stream=True)
+            chunks = aiter(responses)
+            return chunks, await anext(chunks, None)
+
+        async def attempt():
+            call.queue_wait += await limiter.acquire(prompt_tokens)
+            # A stream that does not start within the task deadline is
+            # retried like any other call.
+            return await wait_with_deadline(open_stream(), task)
+
+        chunks, response = await call_with_retry(attempt, model_name)
+
+        generated_text = []
+        while response is not None:
+            # The last chunk carries the usage for the whole stream.
+            call.response = response
+            try:
+                text = response.text
+            except ValueError:
+                # Chunks without candidates text, e.g. the final usage chunk.
+                text = None
+            if text:
+                generated_text.append(text)
+                yield text
+            # A stream that stalls mid-way cannot be retried, it fails.
+            response = await wait_with_deadline(
+                anext(chunks, None), "stream_idle")
+
+    if response_cache is not None and generated_text:
+        await response_cache.set_async(request_key, "".join(generated_text))
+
+
+def image_payload(image, response_format: str="base64") -> dict:
+    """Describes a generated image for an API response.
+
+    Args:
+        image:
+            A GeneratedImage returned by Imagen.
+        response_format:
+            `base64` inlines the image. `gcs` stores it in the asset bucket
+            under its content hash and returns its URI and a signed URL.
+
+    Returns:
+        A dict with the image, its size and its generation parameters.
+    """
+    payload = {
+        "image_size": image._size,
+        "images_parameters": image.generation_parameters
+    }
+    if response_format == "gcs":
+        payload.update(utils_gcs.store_image(
+            config["global"]["project_id"],
+            config["global"]["asset_bkt"],
+            image._image_bytes,
+            prefix=IMAGE_STORAGE.get("prefix", "generated-images"),
+            url_ttl_seconds=IMAGE_STORAGE.get("signed_url_ttl_seconds", 3600)))
+    else:
+        payload["images_base64_string"] = utils_image.to_base64_sync(
+            image._image_bytes)
+    return payload
+
+
+async def async_generate_image(prompt, number_of_images=4,
+                               response_format="base64", fan_out=False):
+    """Generates images with Imagen.
+
+    Concurrent calls with the same arguments share a single upstream
+    request. See `image_payload` for `response_format`. With `fan_out`, each
+    image is requested separately and concurrently, and the images that
+    succeeded are returned in completion order.
+    """
+    image_model_name = get_settings().models.image_model_name
+    request_key = make_key(
+        image_model_name,
+        prompt,
+        {"number_of_images": number_of_images,
+         "response_format": response_format,
+         "fan_out": fan_out})
+    return await image_flights.do(
+        request_key,
+        functools.partial(
+            _generate_image_fan_out if fan_out else _generate_image,
+            image_model_name,
+            prompt,
+            number_of_images,
+            response_format))
+
+
+async def _generate_image(image_model_name, prompt, number_of_images,
+                          response_format):
+    loop = asyncio.get_running_loop()
+    imagen = get_image_model(image_model_name)
+
+    with track_call(image_model_name, "image") as call:
+        async def attempt():
+            call.queue_wait += await get_limiter(image_model_name).acquire()
+            return await loop.run_in_executor(
+                None,
+                functools.partial(
+                    imagen.generate_images,
+                        prompt=prompt, 
+                        number_of_images=number_of_images))
+
+        try:
+            imagen_responses = await call_with_retry(attempt, image_model_name)
+            call.response = imagen_responses
+        except (GenerationUnavailableError, RateLimitExceeded):
+            raise
+        except Exception as e:
+            print(str(e))
+            return None
+
+    # Encoding and uploads block, keep them off the event loop.
+    return await asyncio.gather(
+        *(loop.run_in_executor(
+            None, image_payload, image, response_format)
+          for image in imagen_responses))
+
+
+async def _generate_image_fan_out(image_model_name, prompt, number_of_images,
+                                  response_format):
     loop = asyncio.get_running_loop()
-    # Image models
-    imagen = ImageGenerationModel.from_pretrained(config["models"]["image_model_name"])
+    imagen = get_image_model(image_model_name)
+    images = async_fan_out_images(
+        functools.partial(
+            imagen.generate_images, prompt=prompt, number_of_images=1),
+        number_of_images,
+        model_name=image_model_name)
+    generated_images = []
     try:
-        imagen_responses = await loop.run_in_executor(
-            None,
-            functools.partial(
-                imagen.generate_images,
-                    prompt=prompt, 
-                    number_of_images=number_of_images))
+        async for _, image in images:
+            generated_images.append(await loop.run_in_executor(
+                None, image_payload, image, response_format))
+    except (GenerationUnavailableError, RateLimitExceeded):
+        raise
     except Exception as e:
         print(str(e))
-    else:
-        generated_images = []
-        for image in imagen_responses:
-            generated_images.append(
-                {
-                    "images_base64_string": image._as_base64_string(),
-                    "image_size": image._size,
-                    "images_parameters": image.generation_parameters
-                }
-            )
-        return generated_images
+        return None
+    return generated_images
+
+
+async def async_fan_out_images(
+        call_model: Callable[[], Any],
+        number_of_images: int,
+        task: str="image",
+        model_name: str | None=None
+    ) -> AsyncIterator[tuple[int, Any]]:
+    """Runs one Imagen call per image concurrently, yielding images as they
+    complete.
 
+    Every call goes through the shared rate limiter and retry policy. A call
+    that still fails is logged and skipped, so the images that did succeed
+    are returned.
+
+    Args:
+        call_model:
+            Blocking function that requests a single image, e.g.
+            `functools.partial(imagen.generate_images, prompt=..., number_of_images=1)`.
+        number_of_images:
+            How many concurrent calls to make.
+        task:
+            Telemetry label of the calls.
+        model_name:
+            Imagen model of `call_model`, for rate limiting and telemetry.
+            Defaults to the current image model.
+
+    Yields:
+        (id, GeneratedImage) pairs in completion order, ids counting from 0.
+
+    Raises:
+        The error of the first failed call, if no call produced an image.
+    """
+    loop = asyncio.get_running_loop()
+    image_model_name = model_name or get_settings().models.image_model_name
+    limiter = get_limiter(image_model_name)
+
+    async def generate_one():
+        with track_call(image_model_name, task) as call:
+            async def attempt():
+                call.queue_wait += await limiter.acquire()
+                return await loop.run_in_executor(None, call_model)
+
+            call.response = await call_with_retry(attempt, image_model_name)
+        return call.response.images
+
+    tasks = [
+        asyncio.create_task(generate_one()) for _ in range(number_of_images)]
+    errors = []
+    image_id = 0
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            try:
+                images = await next_done
+            except Exception as e:
+                print(f"Image generation failed: {e}")
+                errors.append(e)
+                continue
+            for image in images:
+                yield image_id, image
+                image_id += 1
+        if image_id == 0 and errors:
+            raise errors[0]
+    finally:
+        for pending in tasks:
+            pending.cancel()
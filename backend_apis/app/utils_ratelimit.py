@@ -0,0 +1,173 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Quota-aware rate limiting for Vertex AI calls.
+
+Each model gets one limiter per process with a requests-per-minute and a
+tokens-per-minute bucket. Callers reserve capacity before calling the model
+and sleep until the reservation is due, so bursts queue up instead of
+hitting the project quota and failing with 429.
+"""
+
+import asyncio
+import threading
+import time
+from .app_context import load_config
+
+
+# Load configuration file
+config = load_config()
+
+RATE_LIMITS = config.get("rate_limits", {})
+DEFAULT_RPM = RATE_LIMITS.get("default_rpm", 60)
+DEFAULT_TPM = RATE_LIMITS.get("default_tpm", 1_000_000)
+MAX_WAIT_SECONDS = RATE_LIMITS.get("max_wait_seconds", 30)
+MODEL_LIMITS = RATE_LIMITS.get("models", {})
+
+
+class RateLimitExceeded(Exception):
+    """Raised when a call would have to queue longer than allowed."""
+
+    def __init__(self, model_name: str, wait_seconds: float):
+        super().__init__(
+            f"Rate limit for {model_name} exceeded. "
+            f"Retry in {wait_seconds:.1f} seconds.")
+        self.model_name = model_name
+        self.wait_seconds = wait_seconds
+
+
+class TokenBucket:
+    """A token bucket refilled continuously at `capacity` per minute.
+
+    The balance may go negative: a reservation always succeeds and the
+    caller is told how long to wait until its share has been refilled.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.rate = capacity / 60.0
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        elapsed = now - self.updated
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.updated = now
+
+    def reserve(self, amount: float, now: float) -> float:
+        """Takes `amount` tokens and returns the seconds to wait for them."""
+        self._refill(now)
+        self.tokens -= min(amount, self.capacity)
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+    def refund(self, amount: float):
+        self.tokens += min(amount, self.capacity)
+
+
+class ModelRateLimiter:
+    """Requests-per-minute and tokens-per-minute limiter for one model.
+
+    State is guarded by a thread lock rather than an asyncio lock so that the
+    same limiter can be shared by coroutines on different event loops and by
+    the synchronous routes running in the threadpool.
+    """
+
+    def __init__(
+            self,
+            model_name: str,
+            rpm: int=DEFAULT_RPM,
+            tpm: int=DEFAULT_TPM,
+            max_wait_seconds: float=MAX_WAIT_SECONDS):
+        self.model_name = model_name
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_wait_seconds = max_wait_seconds
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens: int=0,
+                max_wait_seconds: float | None=None) -> float:
+        """Reserves one request and `tokens` tokens.
+
+        Args:
+            tokens:
+                Estimated tokens of the call.
+            max_wait_seconds:
+                Overrides the limiter's `max_wait_seconds`, e.g. `math.inf`
+                for batch work that would rather queue than fail.
+
+        Returns:
+            The number of seconds the caller must wait before calling.
+
+        Raises:
+            RateLimitExceeded: If the wait would exceed `max_wait_seconds`.
+        """
+        if max_wait_seconds is None:
+            max_wait_seconds = self.max_wait_seconds
+        with self._lock:
+            now = time.monotonic()
+            wait = max(
+                self.requests.reserve(1, now),
+                self.tokens.reserve(tokens, now))
+            if wait > max_wait_seconds:
+                self.requests.refund(1)
+                self.tokens.refund(tokens)
+                raise RateLimitExceeded(self.model_name, wait)
+        return wait
+
+    async def acquire(self, tokens: int=0,
+                      max_wait_seconds: float | None=None) -> float:
+        """Waits asynchronously until the call is allowed.
+
+        Returns:
+            The time spent queueing, in seconds.
+        """
+        wait = self.reserve(tokens, max_wait_seconds)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+    def acquire_sync(self, tokens: int=0,
+                     max_wait_seconds: float | None=None) -> float:
+        """Blocking variant of `acquire` for synchronous code paths."""
+        wait = self.reserve(tokens, max_wait_seconds)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+_limiters_lock = threading.Lock()
+_limiters: dict[str, ModelRateLimiter] = {}
+
+
+def get_limiter(model_name: str | None) -> ModelRateLimiter:
+    """Returns the process-wide limiter for `model_name`.
+
+    Limits come from `[rate_limits.models."<model_name>"]` in config.toml and
+    fall back to `default_rpm` / `default_tpm`.
+    """
+    model_name = model_name or "default"
+    with _limiters_lock:
+        limiter = _limiters.get(model_name)
+        if limiter is None:
+            limits = MODEL_LIMITS.get(model_name, {})
+            limiter = ModelRateLimiter(
+                model_name,
+                rpm=limits.get("rpm", DEFAULT_RPM),
+                tpm=limits.get("tpm", DEFAULT_TPM))
+            _limiters[model_name] = limiter
+    return limiter
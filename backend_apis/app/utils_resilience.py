@@ -0,0 +1,556 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Resilience policies for model calls.
+
+- Deadlines: every call gets a per-task deadline. Under `call_with_retry`
+  it bounds all the attempts of the call together, backoff included.
+- Hedging: a call still running after the observed p95 latency for its model
+  and task gets a duplicate request, and whichever finishes first wins. A
+  budget caps the share of calls that may be hedged.
+- Retries: retryable upstream errors (429, 5xx, deadlines) are retried with
+  exponential backoff and full jitter.
+- Circuit breaking: a model whose calls keep failing after their retries is
+  short-circuited for a while so callers fail fast instead of piling onto an
+  unhealthy upstream.
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import contextvars
+import math
+import random
+import threading
+import time
+from typing import Any, Awaitable, Callable
+
+from google.api_core import exceptions as google_exceptions
+from .app_context import load_config
+
+
+# Load configuration file
+config = load_config()
+
+DEADLINES = config.get("deadlines", {})
+HEDGING = config.get("hedging", {})
+RETRY = config.get("retry", {})
+CIRCUIT_BREAKER = config.get("circuit_breaker", {})
+RETRYABLE_STATUS_CODES = frozenset(
+    RETRY.get("retryable_status_codes", [429, 500, 503, 504]))
+
+
+class DeadlineExceeded(TimeoutError):
+    """Raised when a model call does not finish before its deadline."""
+
+    def __init__(self, task: str, deadline: float):
+        super().__init__(
+            f"The {task} generation did not finish within {deadline} seconds.")
+        self.task = task
+        self.deadline = deadline
+
+
+class GenerationUnavailableError(Exception):
+    """Raised when a model cannot serve a request right now.
+
+    Either retries were exhausted on retryable errors or the circuit breaker
+    of the model is open. Endpoints turn it into 503 with Retry-After.
+    """
+
+    def __init__(
+            self,
+            model_name: str,
+            retry_after: float,
+            cause: BaseException | None=None):
+        message = f"{model_name} is temporarily unavailable."
+        if cause is not None:
+            message += f" Last error: {cause}"
+        super().__init__(message)
+        self.model_name = model_name
+        self.retry_after = retry_after
+        self.cause = cause
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Returns whether `error` is a transient upstream failure."""
+    if isinstance(error, DeadlineExceeded):
+        return True
+    if isinstance(error, google_exceptions.GoogleAPICallError):
+        return error.code in RETRYABLE_STATUS_CODES
+    return False
+
+
+def get_deadline(task: str) -> float:
+    """Returns the deadline in seconds configured for `task`."""
+    return DEADLINES.get(task, DEADLINES.get("default", 60))
+
+
+# Time budget of the `call_with_retry` call in progress, if any. The first
+# deadline-bound attempt fixes when the budget runs out.
+_retry_budget: contextvars.ContextVar[dict | None] = contextvars.ContextVar(
+    "retry_budget", default=None)
+
+
+def _attempt_deadline(task: str) -> float:
+    """Returns the seconds an attempt of `task` may take.
+
+    That is the task deadline, or what is left of it when the attempt is a
+    retry: the deadline bounds the whole call, not each attempt.
+    """
+    deadline = get_deadline(task)
+    budget = _retry_budget.get()
+    if budget is None:
+        return deadline
+    now = time.monotonic()
+    if budget["expires"] is None:
+        budget["expires"] = now + deadline
+    return min(deadline, budget["expires"] - now)
+
+
+def _budget_allows(budget: dict, delay: float) -> bool:
+    """Returns whether a retry after `delay` seconds is still in budget."""
+    return (budget["expires"] is None
+            or time.monotonic() + delay < budget["expires"])
+
+
+async def wait_with_deadline(
+        awaitable: Awaitable[Any],
+        task: str,
+        timeout: float | None=None
+    ) -> Any:
+    """Awaits `awaitable` within the deadline of `task`, without hedging.
+
+    Args:
+        awaitable:
+            E.g. opening a stream and reading its first chunk.
+        task:
+            Name of the task, used to pick the deadline.
+        timeout:
+            Seconds to use instead of the task deadline.
+
+    Raises:
+        DeadlineExceeded: If `awaitable` did not finish in time.
+    """
+    deadline = timeout if timeout is not None else _attempt_deadline(task)
+    try:
+        return await asyncio.wait_for(awaitable, max(deadline, 0))
+    except asyncio.TimeoutError:
+        raise DeadlineExceeded(task, get_deadline(task)
+                               if timeout is None else timeout)
+
+
+class LatencyTracker:
+    """Rolling window of successful call latencies per model and task."""
+
+    def __init__(self, window: int=200):
+        self.window = window
+        self._samples: dict[tuple, collections.deque] = {}
+        self._lock = threading.Lock()
+
+    def record(self, key: tuple, seconds: float):
+        with self._lock:
+            samples = self._samples.get(key)
+            if samples is None:
+                samples = collections.deque(maxlen=self.window)
+                self._samples[key] = samples
+            samples.append(seconds)
+
+    def percentile(self, key: tuple, q: float, min_samples: int) -> float | None:
+        """Returns the `q` quantile, or None until `min_samples` are seen."""
+        with self._lock:
+            samples = self._samples.get(key)
+            if samples is None or len(samples) < min_samples:
+                return None
+            ordered = sorted(samples)
+        index = min(len(ordered) - 1, math.ceil(q * len(ordered)) - 1)
+        return ordered[max(index, 0)]
+
+
+class HedgePolicy:
+    """Decides when to send a duplicate request, within a hedge budget."""
+
+    def __init__(
+            self,
+            enabled: bool=False,
+            percentile: float=0.95,
+            min_samples: int=20,
+            window: int=200,
+            budget_ratio: float=0.05):
+        self.enabled = enabled
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.budget_ratio = budget_ratio
+        self.latencies = LatencyTracker(window)
+        self.calls = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self._lock = threading.Lock()
+
+    def hedge_delay(self, key: tuple) -> float | None:
+        """Returns how long to wait before hedging, or None to never hedge."""
+        with self._lock:
+            self.calls += 1
+        if not self.enabled:
+            return None
+        return self.latencies.percentile(
+            key, self.percentile, self.min_samples)
+
+    def try_spend(self) -> bool:
+        """Takes one hedge from the budget if it is not exhausted."""
+        with self._lock:
+            if self.hedges + 1 > self.budget_ratio * self.calls:
+                return False
+            self.hedges += 1
+            return True
+
+    def record_success(self, key: tuple, seconds: float, hedged: bool):
+        """Records the latency of a successful call and who won the race."""
+        self.latencies.record(key, seconds)
+        if hedged:
+            with self._lock:
+                self.hedge_wins += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins,
+            }
+
+
+hedge_policy = HedgePolicy(
+    enabled=HEDGING.get("enabled", False),
+    percentile=HEDGING.get("percentile", 0.95),
+    min_samples=HEDGING.get("min_samples", 20),
+    window=HEDGING.get("window", 200),
+    budget_ratio=HEDGING.get("budget_ratio", 0.05))
+
+
+async def call_with_deadline(
+        fn: Callable[[], Awaitable[Any]],
+        model_name: str | None,
+        task: str,
+        hedge_fn: Callable[[], Awaitable[Any]] | None=None
+    ) -> Any:
+    """Awaits `fn()` with the deadline of `task`, hedging if it runs long.
+
+    Args:
+        fn:
+            Coroutine function that performs the model call.
+        model_name:
+            Name of the model, used to track latencies.
+        task:
+            Name of the task, used to pick the deadline and track latencies.
+        hedge_fn:
+            Coroutine function for the duplicate request. Defaults to `fn`.
+
+    Returns:
+        The result of the first call to succeed.
+
+    Raises:
+        DeadlineExceeded: If no call succeeded before the deadline.
+    """
+    deadline = _attempt_deadline(task)
+    if deadline <= 0:
+        raise DeadlineExceeded(task, get_deadline(task))
+    key = (model_name or "default", task)
+    start = time.monotonic()
+    primary = asyncio.ensure_future(fn())
+    pending = {primary}
+    error = None
+    try:
+        delay = hedge_policy.hedge_delay(key)
+        if delay is not None and delay < deadline:
+            done, _ = await asyncio.wait(pending, timeout=delay)
+            if not done and hedge_policy.try_spend():
+                pending.add(asyncio.ensure_future((hedge_fn or fn)()))
+
+        while pending:
+            remaining = deadline - (time.monotonic() - start)
+            if remaining <= 0:
+                break
+            done, pending = await asyncio.wait(
+                pending,
+                timeout=remaining,
+                return_when=asyncio.FIRST_COMPLETED)
+            for completed in done:
+                if completed.exception() is None:
+                    hedge_policy.record_success(
+                        key, time.monotonic() - start, completed is not primary)
+                    return completed.result()
+                error = completed.exception()
+            if not done:
+                break
+    finally:
+        for call in pending:
+            call.cancel()
+
+    if error is not None and not pending:
+        raise error
+    raise DeadlineExceeded(task, get_deadline(task))
+
+
+# Worker threads for synchronous calls that need a deadline.
+_sync_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=HEDGING.get("sync_workers", 16),
+    thread_name_prefix="model-call")
+
+
+def call_with_deadline_sync(
+        fn: Callable[[], Any],
+        model_name: str | None,
+        task: str,
+        hedge_fn: Callable[[], Any] | None=None
+    ) -> Any:
+    """Blocking variant of `call_with_deadline` for synchronous code paths.
+
+    A call that misses its deadline cannot be interrupted; its worker thread
+    finishes in the background and the result is discarded.
+    """
+    deadline = _attempt_deadline(task)
+    if deadline <= 0:
+        raise DeadlineExceeded(task, get_deadline(task))
+    key = (model_name or "default", task)
+    start = time.monotonic()
+    primary = _sync_executor.submit(fn)
+    pending = {primary}
+    error = None
+
+    delay = hedge_policy.hedge_delay(key)
+    if delay is not None and delay < deadline:
+        done, _ = concurrent.futures.wait(pending, timeout=delay)
+        if not done and hedge_policy.try_spend():
+            pending.add(_sync_executor.submit(hedge_fn or fn))
+
+    while pending:
+        remaining = deadline - (time.monotonic() - start)
+        if remaining <= 0:
+            break
+        done, pending = concurrent.futures.wait(
+            pending,
+            timeout=remaining,
+            return_when=concurrent.futures.FIRST_COMPLETED)
+        for completed in done:
+            if completed.exception() is None:
+                hedge_policy.record_success(
+                    key, time.monotonic() - start, completed is not primary)
+                return completed.result()
+            error = completed.exception()
+        if not done:
+            break
+
+    for call in pending:
+        call.cancel()
+    if error is not None and not pending:
+        raise error
+    raise DeadlineExceeded(task, get_deadline(task))
+
+
+class RetryPolicy:
+    """Exponential backoff with full jitter."""
+
+    def __init__(
+            self,
+            max_attempts: int=3,
+            base_delay: float=0.5,
+            max_delay: float=8.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def backoff(self, attempt: int) -> float:
+        """Returns the delay before retry number `attempt` (0-based)."""
+        return random.uniform(
+            0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+retry_policy = RetryPolicy(
+    max_attempts=RETRY.get("max_attempts", 3),
+    base_delay=RETRY.get("base_delay_seconds", 0.5),
+    max_delay=RETRY.get("max_delay_seconds", 8.0))
+
+
+class CircuitBreaker:
+    """Per-model circuit breaker.
+
+    Opens after `failure_threshold` consecutive calls that failed with
+    retryable errors on every attempt; the attempts of one call count once.
+    While open, calls fail fast with GenerationUnavailableError. After
+    `reset_timeout` seconds one probe call, retries included, is let
+    through: success closes the breaker, failure opens it again.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+            self,
+            model_name: str,
+            failure_threshold: int=5,
+            reset_timeout: float=30.0):
+        self.model_name = model_name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """Raises GenerationUnavailableError if the call must fail fast."""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            elapsed = time.monotonic() - self.opened_at
+            if self.state == self.OPEN and elapsed >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self._probing = False
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return
+            retry_after = max(self.reset_timeout - elapsed, 1.0)
+        raise GenerationUnavailableError(self.model_name, retry_after)
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if (self.state == self.HALF_OPEN
+                    or self.failures >= self.failure_threshold):
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self._probing = False
+
+    def release_probe(self):
+        """Lets another probe through after a non-retryable error."""
+        with self._lock:
+            self._probing = False
+
+
+_breakers_lock = threading.Lock()
+_breakers: dict[str, CircuitBreaker] = {}
+
+
+def get_breaker(model_name: str | None) -> CircuitBreaker:
+    """Returns the process-wide circuit breaker for `model_name`."""
+    model_name = model_name or "default"
+    with _breakers_lock:
+        breaker = _breakers.get(model_name)
+        if breaker is None:
+            breaker = CircuitBreaker(
+                model_name,
+                failure_threshold=CIRCUIT_BREAKER.get("failure_threshold", 5),
+                reset_timeout=CIRCUIT_BREAKER.get("reset_timeout_seconds", 30))
+            _breakers[model_name] = breaker
+    return breaker
+
+
+async def call_with_retry(
+        fn: Callable[[], Awaitable[Any]],
+        model_name: str | None
+    ) -> Any:
+    """Awaits `fn()`, retrying retryable errors behind the model's breaker.
+
+    When `fn` uses `call_with_deadline`, the task deadline bounds all the
+    attempts together: no retry starts once it would run past it.
+
+    Args:
+        fn:
+            Coroutine function that performs one attempt of the call.
+        model_name:
+            Name of the model, used to pick its circuit breaker.
+
+    Returns:
+        The result of the first successful attempt.
+
+    Raises:
+        GenerationUnavailableError: If the breaker is open or every attempt
+            failed with a retryable error.
+    """
+    breaker = get_breaker(model_name)
+    breaker.before_call()
+    budget = {"expires": None}
+    token = _retry_budget.set(budget)
+    last_error = None
+    try:
+        for attempt in range(retry_policy.max_attempts):
+            try:
+                result = await fn()
+            except asyncio.CancelledError:
+                breaker.release_probe()
+                raise
+            except Exception as e:
+                if not is_retryable(e):
+                    breaker.release_probe()
+                    raise
+                last_error = e
+                if attempt + 1 == retry_policy.max_attempts:
+                    break
+                delay = retry_policy.backoff(attempt)
+                if not _budget_allows(budget, delay):
+                    break
+                await asyncio.sleep(delay)
+            else:
+                breaker.record_success()
+                return result
+    finally:
+        _retry_budget.reset(token)
+    breaker.record_failure()
+    raise GenerationUnavailableError(
+        breaker.model_name, retry_policy.max_delay, cause=last_error)
+
+
+def call_with_retry_sync(
+        fn: Callable[[], Any],
+        model_name: str | None
+    ) -> Any:
+    """Blocking variant of `call_with_retry` for synchronous code paths."""
+    breaker = get_breaker(model_name)
+    breaker.before_call()
+    budget = {"expires": None}
+    token = _retry_budget.set(budget)
+    last_error = None
+    try:
+        for attempt in range(retry_policy.max_attempts):
+            try:
+                result = fn()
+            except Exception as e:
+                if not is_retryable(e):
+                    breaker.release_probe()
+                    raise
+                last_error = e
+                if attempt + 1 == retry_policy.max_attempts:
+                    break
+                delay = retry_policy.backoff(attempt)
+                if not _budget_allows(budget, delay):
+                    break
+                time.sleep(delay)
+            else:
+                breaker.record_success()
+                return result
+    finally:
+        _retry_budget.reset(token)
+    breaker.record_failure()
+    raise GenerationUnavailableError(
+        breaker.model_name, retry_policy.max_delay, cause=last_error)
@@ -0,0 +1,104 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Single-flight coalescing of identical in-flight requests.
+
+The first caller for a key runs the upstream call; callers that arrive with
+the same key while it is running await its result instead of making their
+own call.
+"""
+
+import asyncio
+import concurrent.futures
+import threading
+from typing import Any, Awaitable, Callable
+
+
+class SingleFlight:
+    """Deduplicates concurrent calls that share a request key.
+
+    The shared result is held in a `concurrent.futures.Future`, so followers
+    may await it from any event loop. This matters while the sync routes still
+    run each request on its own loop with `asyncio.run`.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.leaders = 0
+        self.coalesced = 0
+        self._calls: dict[str, concurrent.futures.Future] = {}
+        self._lock = threading.Lock()
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """Runs `fn` once for all concurrent callers with the same `key`.
+
+        Args:
+            key:
+                Identifies the upstream request, e.g. a hash of model, prompt
+                and generation parameters.
+            fn:
+                Coroutine function that performs the upstream call.
+
+        Returns:
+            The result of the single upstream call.
+        """
+        while True:
+            with self._lock:
+                future = self._calls.get(key)
+                leader = future is None
+                if leader:
+                    future = concurrent.futures.Future()
+                    self._calls[key] = future
+                    self.leaders += 1
+                else:
+                    self.coalesced += 1
+            if leader:
+                break
+            try:
+                # Shielded, so that a follower being cancelled does not
+                # cancel the call shared with the others.
+                return await asyncio.shield(asyncio.wrap_future(future))
+            except asyncio.CancelledError:
+                # The leader was cancelled, not us: take over the call.
+                if not future.cancelled() or asyncio.current_task().cancelling():
+                    raise
+
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "leaders": self.leaders,
+                "coalesced": self.coalesced,
+                "in_flight": len(self._calls),
+            }
+
+
+text_flights = SingleFlight("text")
+image_flights = SingleFlight("image")
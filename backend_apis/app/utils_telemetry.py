@@ -0,0 +1,206 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Per-call telemetry for Gemini and Imagen generations.
+
+Every generation records its model, task, calling route, wall time, time
+spent queueing in the rate limiter and the token counts from
+`usage_metadata`. The numbers are exported as Prometheus histograms and
+counters on `/marketing-api/metrics`, together with the response cache,
+request coalescing and hedging stats and the startup timings.
+"""
+
+import contextlib
+import contextvars
+import time
+from typing import Iterator
+
+from prometheus_client import REGISTRY, Counter, Histogram
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+from .app_context import get_context
+from .logger import log
+from .utils_cache import response_cache
+from .utils_resilience import hedge_policy
+from .utils_singleflight import image_flights, text_flights
+
+
+# Route template of the API call being served, e.g.
+# `/marketing-api/users/{user_id}/campaigns`. Set by a router dependency and
+# inherited by the threads and event loops the route starts.
+current_route: contextvars.ContextVar[str] = contextvars.ContextVar(
+    "current_route", default="none")
+
+_LABELS = ("model", "task", "route")
+
+CALLS = Counter(
+    "genai_llm_calls",
+    "Model generations, by outcome.",
+    _LABELS + ("outcome",))
+DURATION = Histogram(
+    "genai_llm_call_duration_seconds",
+    "Wall time of a generation, including queueing and retries.",
+    _LABELS,
+    buckets=(0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 120))
+QUEUE_WAIT = Histogram(
+    "genai_llm_queue_wait_seconds",
+    "Time a generation waited in the rate limiter.",
+    _LABELS,
+    buckets=(0, 0.1, 0.5, 1, 2, 5, 10, 30))
+TOKENS = Counter(
+    "genai_llm_tokens",
+    "Tokens billed by the model, by kind (prompt or output).",
+    _LABELS + ("kind",))
+PROMPT_TOKENS = Histogram(
+    "genai_llm_prompt_tokens",
+    "Prompt tokens per generation.",
+    _LABELS,
+    buckets=(64, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768))
+OUTPUT_TOKENS = Histogram(
+    "genai_llm_output_tokens",
+    "Output tokens per generation.",
+    _LABELS,
+    buckets=(16, 64, 128, 256, 512, 1024, 2048, 4096, 8192))
+
+
+class CallRecord:
+    """Measurements of one generation, filled in by the caller.
+
+    Attributes:
+        queue_wait:
+            Seconds spent in the rate limiter, summed over every attempt.
+        response:
+            The model response. Its `usage_metadata`, when present, provides
+            the token counts. Left as None when the generation failed.
+    """
+
+    def __init__(self, model_name: str, task: str):
+        self.model_name = model_name
+        self.task = task
+        self.route = current_route.get()
+        self.queue_wait = 0.0
+        self.response = None
+        self.started = time.perf_counter()
+
+    def usage(self) -> tuple[int, int] | None:
+        """Returns the prompt and output token counts, if reported."""
+        metadata = getattr(self.response, "usage_metadata", None)
+        if metadata is None:
+            return None
+        return (
+            metadata.prompt_token_count or 0,
+            metadata.candidates_token_count or 0)
+
+    def finish(self, outcome: str):
+        duration = time.perf_counter() - self.started
+        labels = (self.model_name or "default", self.task, self.route)
+        CALLS.labels(*labels, outcome).inc()
+        DURATION.labels(*labels).observe(duration)
+        QUEUE_WAIT.labels(*labels).observe(self.queue_wait)
+        usage = self.usage()
+        if usage is not None:
+            prompt_tokens, output_tokens = usage
+            TOKENS.labels(*labels, "prompt").inc(prompt_tokens)
+            TOKENS.labels(*labels, "output").inc(output_tokens)
+            PROMPT_TOKENS.labels(*labels).observe(prompt_tokens)
+            OUTPUT_TOKENS.labels(*labels).observe(output_tokens)
+        log(f"LLM call [{self.route} {self.task}] {labels[0]} {outcome}: "
+            f"{duration:.2f}s, queued {self.queue_wait:.2f}s, "
+            f"tokens {usage or 'n/a'}")
+
+
+@contextlib.contextmanager
+def track_call(model_name: str | None, task: str="default") -> Iterator[CallRecord]:
+    """Records the telemetry of the generation run inside the block.
+
+    The generation counts as failed if the block raises or leaves
+    `record.response` unset.
+
+    Args:
+        model_name:
+            Name of the model being called.
+        task:
+            The kind of generation, e.g. `campaign_brief` or `sql`.
+
+    Yields:
+        The CallRecord to fill in with the queue wait and the response.
+    """
+    record = CallRecord(model_name, task)
+    try:
+        yield record
+    except BaseException:
+        record.finish("error")
+        raise
+    record.finish("ok" if record.response is not None else "error")
+
+
+class _StatsCollector:
+    """Exports the in-process cache, coalescing, hedging and startup stats."""
+
+    def collect(self):
+        if response_cache is not None:
+            cache_stats = response_cache.stats()
+            requests = CounterMetricFamily(
+                "genai_response_cache_requests",
+                "Response cache lookups, by result.",
+                labels=["result"])
+            requests.add_metric(["hit"], cache_stats["hits"])
+            requests.add_metric(["miss"], cache_stats["misses"])
+            requests.add_metric(["disk_hit"], cache_stats["disk_hits"])
+            yield requests
+            yield GaugeMetricFamily(
+                "genai_response_cache_entries",
+                "Entries held in the in-memory response cache.",
+                value=cache_stats["entries"])
+
+        calls = CounterMetricFamily(
+            "genai_singleflight_calls",
+            "Requests that led an upstream call or joined one in flight.",
+            labels=["flight", "role"])
+        in_flight = GaugeMetricFamily(
+            "genai_singleflight_in_flight",
+            "Upstream calls currently in flight.",
+            labels=["flight"])
+        for flights in (text_flights, image_flights):
+            flight_stats = flights.stats()
+            calls.add_metric([flights.name, "leader"], flight_stats["leaders"])
+            calls.add_metric(
+                [flights.name, "coalesced"], flight_stats["coalesced"])
+            in_flight.add_metric([flights.name], flight_stats["in_flight"])
+        yield calls
+        yield in_flight
+
+        hedge_stats = hedge_policy.stats()
+        hedges = CounterMetricFamily(
+            "genai_hedging_calls",
+            "Deadline-bound calls, hedged calls and hedges that won.",
+            labels=["kind"])
+        hedges.add_metric(["call"], hedge_stats["calls"])
+        hedges.add_metric(["hedge"], hedge_stats["hedges"])
+        hedges.add_metric(["hedge_win"], hedge_stats["hedge_wins"])
+        yield hedges
+
+        startup = GaugeMetricFamily(
+            "genai_startup_seconds",
+            "Time spent importing modules, starting up and building each "
+            "component of the app context.",
+            labels=["component"])
+        for component, seconds in list(get_context().timings.items()):
+            startup.add_metric([component], seconds)
+        yield startup
+
+
+REGISTRY.register(_StatsCollector())
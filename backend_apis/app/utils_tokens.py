@@ -0,0 +1,209 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Local token estimation and token-budgeted prompt construction.
+
+Long inputs such as scraped news articles or BigQuery schema descriptions
+are trimmed to a per-task budget before they are put into a prompt, so we
+do not pay input tokens and latency for text the model does not need.
+"""
+
+import re
+from collections import Counter
+
+from .app_context import load_config
+from .logger import log
+
+
+# Load configuration file
+config = load_config()
+
+# Per-task input budgets, in estimated tokens.
+PROMPT_BUDGETS = config.get("prompt_budgets", {})
+
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+_WORD = re.compile(r"[a-z0-9']+")
+_STOPWORDS = frozenset(
+    "a an and are as at be but by for from has have he her his i in is it its "
+    "of on or she that the their they this to was were will with you".split())
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimates the number of tokens in `text` without calling the API.
+
+    Gemini averages about four characters per token for English text.
+    """
+    if not text:
+        return 0
+    return len(text) // 4 + 1
+
+
+def get_budget(task: str, default: int) -> int:
+    """Returns the input token budget configured for `task`."""
+    return PROMPT_BUDGETS.get(task, default)
+
+
+def _split_sentences(text: str) -> list[str]:
+    return [s for s in _SENTENCE_END.split(text.strip()) if s]
+
+
+def _cut(text: str, max_tokens: int) -> str:
+    return text[:max(max_tokens, 0) * 4]
+
+
+def _lead(text: str, max_tokens: int) -> str:
+    """Keeps leading paragraphs, then leading sentences, within budget."""
+    kept = []
+    used = 0
+    for paragraph in (p.strip() for p in text.split("\n")):
+        if not paragraph:
+            continue
+        tokens = estimate_tokens(paragraph)
+        if used + tokens <= max_tokens:
+            kept.append(paragraph)
+            used += tokens
+            continue
+        for sentence in _split_sentences(paragraph):
+            tokens = estimate_tokens(sentence)
+            if used + tokens > max_tokens:
+                break
+            kept.append(sentence)
+            used += tokens
+        break
+    if not kept:
+        return _cut(text, max_tokens)
+    return "\n".join(kept)
+
+
+def _key_sentences(text: str, max_tokens: int) -> str:
+    """Keeps the highest-scoring sentences within budget, in original order.
+
+    Sentences are scored by the average document frequency of their
+    non-stopword terms. The opening sentence is always preferred because
+    news articles front-load the key facts.
+    """
+    sentences = _split_sentences(text.replace("\n", " "))
+    if not sentences:
+        return _cut(text, max_tokens)
+    words = [
+        [w for w in _WORD.findall(s.lower()) if w not in _STOPWORDS]
+        for s in sentences]
+    frequencies = Counter(w for sentence_words in words for w in sentence_words)
+
+    def score(i: int) -> float:
+        if i == 0:
+            return float("inf")
+        if not words[i]:
+            return 0.0
+        return sum(frequencies[w] for w in words[i]) / len(words[i])
+
+    selected = []
+    used = 0
+    for i in sorted(range(len(sentences)), key=score, reverse=True):
+        tokens = estimate_tokens(sentences[i])
+        if used + tokens <= max_tokens:
+            selected.append(i)
+            used += tokens
+    if not selected:
+        return _cut(text, max_tokens)
+    return " ".join(sentences[i] for i in sorted(selected))
+
+
+def truncate_to_budget(
+        text: str,
+        max_tokens: int,
+        strategy: str="lead"
+    ) -> tuple[str, dict]:
+    """Trims `text` so that it fits in `max_tokens` estimated tokens.
+
+    Args:
+        text:
+            The text to trim.
+        max_tokens:
+            The input token budget.
+        strategy:
+            `lead` keeps the leading paragraphs, `key_sentences` keeps the
+            most representative sentences.
+
+    Returns:
+        A tuple with the trimmed text and a dict of trimming stats.
+    """
+    original_tokens = estimate_tokens(text)
+    if original_tokens <= max_tokens:
+        trimmed = text
+    elif strategy == "key_sentences":
+        trimmed = _key_sentences(text, max_tokens)
+    else:
+        trimmed = _lead(text, max_tokens)
+    kept_tokens = estimate_tokens(trimmed)
+    return trimmed, {
+        "strategy": strategy,
+        "budget": max_tokens,
+        "original_tokens": original_tokens,
+        "kept_tokens": kept_tokens,
+        "trimmed_tokens": original_tokens - kept_tokens,
+    }
+
+
+def fit_sections(
+        sections: list[str],
+        max_tokens: int
+    ) -> tuple[list[str], dict]:
+    """Keeps whole sections in order until `max_tokens` is reached.
+
+    The first section that does not fit is cut at a line boundary and the
+    remaining sections are dropped.
+
+    Returns:
+        A tuple with the kept sections and a dict of trimming stats.
+    """
+    kept = []
+    used = 0
+    for section in sections:
+        tokens = estimate_tokens(section)
+        if used + tokens <= max_tokens:
+            kept.append(section)
+            used += tokens
+            continue
+        lines = []
+        for line in section.splitlines(keepends=True):
+            tokens = estimate_tokens(line)
+            if used + tokens > max_tokens:
+                break
+            lines.append(line)
+            used += tokens
+        if lines:
+            kept.append("".join(lines))
+        break
+    original_tokens = sum(estimate_tokens(s) for s in sections)
+    kept_tokens = sum(estimate_tokens(s) for s in kept)
+    return kept, {
+        "strategy": "sections",
+        "budget": max_tokens,
+        "original_tokens": original_tokens,
+        "kept_tokens": kept_tokens,
+        "trimmed_tokens": original_tokens - kept_tokens,
+        "sections_kept": len(kept),
+        "sections_total": len(sections),
+    }
+
+
+def log_trim_stats(task: str, stats: dict):
+    """Logs how much of a prompt input was trimmed for `task`."""
+    log(f"Prompt budget [{task}]: kept {stats['kept_tokens']} of "
+        f"{stats['original_tokens']} estimated tokens, trimmed "
+        f"{stats['trimmed_tokens']} (budget {stats['budget']}, "
+        f"strategy {stats['strategy']})")
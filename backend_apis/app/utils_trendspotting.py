@@ -27,6 +27,18 @@ from newspaper import ArticleException
 from vertexai.generative_models import GenerativeModel
 import vertexai.preview.generative_models as generative_models
 
+from .utils_models import GENERATION_CONFIGS
+from .utils_ratelimit import RateLimitExceeded, get_limiter
+from .utils_resilience import GenerationUnavailableError, call_with_retry_sync
+from .utils_telemetry import track_call
+from .utils_tokens import (
+    PROMPT_BUDGETS,
+    estimate_tokens,
+    get_budget,
+    log_trim_stats,
+    truncate_to_budget
+)
+
 gdelt_api_url: str = 'https://api.gdeltproject.org/api/v2/doc/doc'
 mode: str = 'ArtList'
 format: str = 'json'
@@ -35,6 +47,13 @@ source_country: str = 'US'
 source_lang: str = 'english'
 tone = 'tone>5'
 
+SUMMARY_SAFETY_SETTINGS = {
+    generative_models.HarmCategory.HARM_CATEGORY_HATE_SPEECH: generative_models.HarmBlockThreshold.BLOCK_ONLY_HIGH,
+    generative_models.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: generative_models.HarmBlockThreshold.BLOCK_ONLY_HIGH,
+    generative_models.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: generative_models.HarmBlockThreshold.BLOCK_ONLY_HIGH,
+    generative_models.HarmCategory.HARM_CATEGORY_HARASSMENT: generative_models.HarmBlockThreshold.BLOCK_ONLY_HIGH,
+}
+
 
 def _get_articles_info(
         keywords: list[str], 
@@ -143,44 +162,54 @@ def get_relevant_documents(
 
 def summarize_news_article(
         page_content: dict,
-        llm: GenerativeModel):
+        llm: GenerativeModel,
+        model_name: str | None = None):
     """Summarizes a news article.
 
+    The article text is trimmed to the `news_summary` input budget from
+    `[prompt_budgets]` in config.toml before it is put into the prompt.
+
     Args:
         document: 
             A dictionary containing the following keys:
                 `page_content`: The text of the news article.
         llm: A language model that can be used to generate summaries.
+        model_name: Name of `llm`, used to pick its rate limiter.
 
     Returns:
         A dictionary containing the following keys:
             `page_content`: The original text of the news article.
             `summary`: A one-sentence summary of the news article.
     """
+    article_text, trim_stats = truncate_to_budget(
+        page_content,
+        get_budget("news_summary", 2000),
+        PROMPT_BUDGETS.get("news_summary_strategy", "lead"))
+    log_trim_stats("news_summary", trim_stats)
     prompt_template = (
         "Write a one sentence summary of the news article below:"
-        f"input: {page_content}"
+        f"input: {article_text}"
         "output:")
 
-    try:
-        summary = llm.generate_content(
-            contents=prompt_template,
-            generation_config={
-                "max_output_tokens": 2048,
-                "temperature": 0.8,
-                "top_p": 0.8,
-            },
-            safety_settings = {
-                generative_models.HarmCategory.HARM_CATEGORY_HATE_SPEECH: generative_models.HarmBlockThreshold.BLOCK_ONLY_HIGH,
-                generative_models.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: generative_models.HarmBlockThreshold.BLOCK_ONLY_HIGH,
-                generative_models.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: generative_models.HarmBlockThreshold.BLOCK_ONLY_HIGH,
-                generative_models.HarmCategory.HARM_CATEGORY_HARASSMENT: generative_models.HarmBlockThreshold.BLOCK_ONLY_HIGH,
-            },
-            stream=False,
-        )
-    except Exception as e:
-        print(e)
-        return ""
+    with track_call(model_name, "news_summary") as call:
+        def attempt():
+            call.queue_wait += get_limiter(model_name).acquire_sync(
+                estimate_tokens(prompt_template))
+            return llm.generate_content(
+                contents=prompt_template,
+                generation_config=GENERATION_CONFIGS["summary"],
+                safety_settings=SUMMARY_SAFETY_SETTINGS,
+                stream=False,
+            )
+
+        try:
+            summary = call_with_retry_sync(attempt, model_name)
+            call.response = summary
+        except (RateLimitExceeded, GenerationUnavailableError):
+            raise
+        except Exception as e:
+            print(e)
+            return ""
 
     if isinstance(summary.text, str):
         return summary.text
@@ -188,7 +217,7 @@ def summarize_news_article(
         return ""
 
 
-def summarize_documents(documents: dict, llm) -> list:
+def summarize_documents(documents: dict, llm, model_name: str | None = None) -> list:
     """Summarizes a list of news articles.
 
     Args:
@@ -197,6 +226,7 @@ def summarize_documents(documents: dict, llm) -> list:
             each of which is a dictionary containing the following keys:
                 `page_content`: The text of the news article.
         llm: A language model that can be used to generate summaries.
+        model_name: Name of `llm`, used to pick its rate limiter.
 
     Returns:
         A list of dictionaries, each of which contains the following keys:
@@ -207,7 +237,7 @@ def summarize_documents(documents: dict, llm) -> list:
 
     for document in documents:
         summaries.append(
-            summarize_news_article(document, llm)
+            summarize_news_article(document, llm, model_name)
         )
 
     return summaries
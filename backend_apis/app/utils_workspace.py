@@ -16,22 +16,18 @@
 
 import io
 import uuid
-import tomllib
 
 from datetime import date
-import google.auth
 from googleapiclient.http import HttpError, MediaIoBaseUpload
 from googleapiclient.http import MediaIoBaseDownload
 from googleapiclient.discovery import build
-
-with open("/app/config.toml", "rb") as f:
-    config = tomllib.load(f)
+from .app_context import get_context
 
 def create_folder_in_folder(
         folder_name: str, 
         parent_folder_id: str
     ):
-    creds, _ = google.auth.default(scopes=config["global"]["workspace_scopes"])
+    creds = get_context().workspace_credentials
     drive_service = build('drive', 'v3', credentials=creds)
 
     file_metadata = {
@@ -48,7 +44,7 @@ def create_folder_in_folder(
 
 def download_file(file_id: str) -> bytes | None:
     try:
-        creds, _ = google.auth.default(scopes=config["global"]["workspace_scopes"])
+        creds = get_context().workspace_credentials
         drive_service = build('drive', 'v3', credentials=creds)
         request = drive_service.files().get_media(fileId=file_id)
         file = io.BytesIO()
@@ -66,7 +62,7 @@ def download_file(file_id: str) -> bytes | None:
 
 def copy_drive_file(drive_file_id: str,parentFolderId: str,copy_title: str):
 
-    creds, _ = google.auth.default(scopes=config["global"]["workspace_scopes"])
+    creds = get_context().workspace_credentials
     drive_service = build('drive', 'v3', credentials=creds)
     body = {
         'name': copy_title,
@@ -82,7 +78,7 @@ def copy_drive_file(drive_file_id: str,parentFolderId: str,copy_title: str):
 
 
 def upload_to_folder(f,folder_id, upload_name, mime_type):
-    creds, _ = google.auth.default(scopes=config["global"]["workspace_scopes"])
+    creds = get_context().workspace_credentials
     drive_service = build('drive', 'v3', credentials=creds)
     """Upload a file to the specified folder and prints file ID, folder ID
     Args: Id of the folder
@@ -107,7 +103,7 @@ def upload_to_folder(f,folder_id, upload_name, mime_type):
 
 def update_doc(document_id: str,campaign_name: str,business_name: str, scenario: str,brand_statement: str, primary_msg: str, comms_channel: str):
 
-    creds, _ = google.auth.default(scopes=config["global"]["workspace_scopes"])
+    creds = get_context().workspace_credentials
     docs_service = build('docs', 'v1', credentials=creds)
     
     requests = [
@@ -165,7 +161,7 @@ def update_doc(document_id: str,campaign_name: str,business_name: str, scenario:
 
 
 def set_permission(file_id: str,domain: str):
-    creds, _ = google.auth.default(scopes=config["global"]["workspace_scopes"])
+    creds = get_context().workspace_credentials
     drive_service = build('drive', 'v3', credentials=creds)
     permission = {'type': 'domain',
                 'domain': domain,
@@ -198,7 +194,7 @@ def merge_slides(presentation_id: str, spreadsheet_id: str,spreadsheet_template_
         'magnitude': 4000000,
         'unit': 'EMU'
     }
-    creds, _ = google.auth.default(scopes=config["global"]["workspace_scopes"])
+    creds = get_context().workspace_credentials
     sheets_service = build('sheets', 'v4', credentials=creds)
     slides_service = build('slides', 'v1', credentials=creds)
     sheet_chart_id_list = get_chart_id(sheets_service,
@@ -254,7 +250,7 @@ def create_sheets_chart(presentation_id: str, page_id: str,spreadsheet_id: str,
         'magnitude': 1000000,
         'unit': 'EMU'
     }
-    creds, _ = google.auth.default(scopes=config["global"]["workspace_scopes"])
+    creds = get_context().workspace_credentials
     slides_service = build('slides', 'v1', credentials=creds)
     presentation_chart_id = 'MyEmbeddedChart'
     requests = [
@@ -292,7 +288,7 @@ def create_sheets_chart(presentation_id: str, page_id: str,spreadsheet_id: str,
     return response
 
 def create_doc(folder_id: str,doc_name: str, text: str):
-    creds, _ = google.auth.default(scopes=config["global"]["workspace_scopes"])
+    creds = get_context().workspace_credentials
     docs_service = build('docs', 'v1', credentials=creds)
     title = doc_name
     body = {
@@ -319,7 +315,7 @@ def create_doc(folder_id: str,doc_name: str, text: str):
     return _id
 
 def move_drive_file(drive_file_id: str,parentFolderId: str,copy_title: str):
-    creds, _ = google.auth.default(scopes=config["global"]["workspace_scopes"])
+    creds = get_context().workspace_credentials
     drive_service = build('drive', 'v3', credentials=creds)
     body = {
         'name': copy_title,
@@ -0,0 +1,130 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Compares sync and async serving of the generation routes under load.
+
+Each simulated request does what `create_campaign` does: three concurrent
+Gemini calls followed by a blocking Workspace/Firestore call. In `sync`
+mode a request runs like a sync FastAPI route, on Starlette's 40-thread
+pool with its own `asyncio.run` loop. In `async` mode it runs on the
+server loop, with the blocking call on the bounded `workspace` executor.
+Reports requests per second and latency percentiles for both.
+
+Meant for the fake backend (`[models] backend = "fake"`), so that only
+the serving model is measured. Run from `backend_apis`:
+
+    python -m benchmarks.async_routes --requests 400 --concurrency 100
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import statistics
+import time
+
+from app import utils_prompt
+from app import utils_ratelimit
+from app.utils_executors import run_blocking
+
+
+prompts = utils_prompt.config["prompts"]
+BRIEF = ("Female", "20-30", "Drive Awareness", "Fashion Forward")
+TEMPLATES = (
+    prompts["prompt_brand_statement_template"],
+    prompts["prompt_primary_msg_template"],
+    prompts["prompt_comms_channel_template"],
+)
+# Size of the threadpool Starlette runs sync routes on.
+SYNC_THREADS = 40
+
+
+async def generate(request_id: int) -> list[str]:
+    # A distinct theme per request so calls are not coalesced.
+    brief = (*BRIEF[:3], f"{BRIEF[3]} {request_id}")
+    return await asyncio.gather(
+        *(utils_prompt.async_predict_text_gemini(
+            template.format(*brief, prompts["prompt_brand_overview"]),
+            max_output_tokens=2048,
+            nocache=True,
+            task="benchmark")
+          for template in TEMPLATES))
+
+
+def sync_route(request_id: int, blocking_seconds: float):
+    asyncio.run(generate(request_id))
+    time.sleep(blocking_seconds)
+
+
+async def async_route(request_id: int, blocking_seconds: float):
+    await generate(request_id)
+    await run_blocking("workspace", time.sleep, blocking_seconds)
+
+
+async def run(mode: str, requests: int, concurrency: int,
+              blocking_seconds: float) -> dict:
+    loop = asyncio.get_running_loop()
+    threadpool = concurrent.futures.ThreadPoolExecutor(SYNC_THREADS)
+    latencies = []
+    next_request = iter(range(requests))
+
+    async def client():
+        for request_id in next_request:
+            start = time.perf_counter()
+            if mode == "sync":
+                await loop.run_in_executor(
+                    threadpool, sync_route, request_id, blocking_seconds)
+            else:
+                await async_route(request_id, blocking_seconds)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    threadpool.shutdown()
+    latencies.sort()
+    return {
+        "rps": requests / elapsed,
+        "p50": statistics.median(latencies),
+        "p99": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))],
+    }
+
+
+async def main(requests: int, concurrency: int, blocking_seconds: float):
+    if utils_prompt.MODEL_BACKEND != "fake":
+        print("Warning: not running on the fake backend, "
+              "model latency and quota will dominate.")
+    # Lift the client-side quota so that it does not cap throughput.
+    for model_name in (utils_prompt.config["models"]["text_model_name"],):
+        utils_ratelimit._limiters[model_name] = (
+            utils_ratelimit.ModelRateLimiter(
+                model_name, rpm=10**9, tpm=10**12))
+
+    print(f"{requests} requests, {concurrency} concurrent clients, "
+          f"{blocking_seconds:.2f}s blocking call per request")
+    print(f"{'mode':<8}{'req/s':>10}{'p50 s':>10}{'p99 s':>10}")
+    for mode in ("sync", "async"):
+        result = await run(mode, requests, concurrency, blocking_seconds)
+        print(f"{mode:<8}{result['rps']:>10.1f}"
+              f"{result['p50']:>10.2f}{result['p99']:>10.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--blocking-seconds", type=float, default=0.2)
+    args = parser.parse_args()
+    asyncio.run(main(args.requests, args.concurrency, args.blocking_seconds))
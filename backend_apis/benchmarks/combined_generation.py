@@ -0,0 +1,154 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Compares per-section and combined (one JSON call) generation.
+
+For the campaign brief and the asset group, runs the prompts used by the
+API in both modes directly against Gemini, bypassing the response cache,
+and reports wall-clock latency and the tokens billed by the API.
+
+Run from `backend_apis` with `/app/config.toml` in place:
+
+    python -m benchmarks.combined_generation --runs 5
+"""
+
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+from app import utils_prompt
+from app.utils_models import (
+    get_async_generative_model,
+    get_generation_config,
+    get_json_generation_config
+)
+
+
+prompts = utils_prompt.config["prompts"]
+model_name = utils_prompt.config["models"]["text_model_name"]
+max_output_tokens = utils_prompt.config.get(
+    "combined_generation", {}).get("max_output_tokens", 4096)
+
+BRAND_OVERVIEW = prompts["prompt_brand_overview"]
+BRIEF = ("Female", "20-30", "Drive Awareness", "Fashion Forward")
+THEME = "Summer collection of sandals and straw totes"
+CONTEXT = "Lightweight, breathable and made with recycled materials."
+
+SCENARIOS = {
+    "campaign_brief": {
+        "separate": [
+            (prompts["prompt_brand_statement_template"].format(
+                *BRIEF, BRAND_OVERVIEW), 2048),
+            (prompts["prompt_primary_msg_template"].format(
+                *BRIEF, BRAND_OVERVIEW), 2048),
+            (prompts["prompt_comms_channel_template"].format(*BRIEF), 2048),
+        ],
+        "combined": prompts["prompt_campaign_brief_combined_template"].format(
+            *BRIEF, BRAND_OVERVIEW),
+        "schema": utils_prompt.CAMPAIGN_BRIEF_SCHEMA,
+    },
+    "asset_group": {
+        "separate": [
+            (prompts["headline_prompt_template"].format(
+                THEME, BRAND_OVERVIEW), 256),
+            (prompts["load_headline_prompt_template"].format(
+                THEME, BRAND_OVERVIEW), 2048),
+            (prompts["description_prompt_template"].format(
+                THEME, BRAND_OVERVIEW, CONTEXT), 2048),
+        ],
+        "combined": prompts["asset_group_combined_prompt_template"].format(
+            THEME, BRAND_OVERVIEW, CONTEXT),
+        "schema": utils_prompt.ASSET_GROUP_SCHEMA,
+    },
+}
+
+
+def usage(response) -> tuple[int, int]:
+    metadata = response.usage_metadata
+    return metadata.prompt_token_count, metadata.candidates_token_count
+
+
+async def run_separate(requests: list[tuple[str, int]]) -> dict:
+    llm = get_async_generative_model(model_name)
+    start = time.perf_counter()
+    responses = await asyncio.gather(
+        *(llm.generate_content_async(
+            prompt,
+            generation_config=get_generation_config(
+                max_output_tokens=max_tokens))
+            for prompt, max_tokens in requests))
+    latency = time.perf_counter() - start
+    counts = [usage(response) for response in responses]
+    return {
+        "latency": latency,
+        "input_tokens": sum(c[0] for c in counts),
+        "output_tokens": sum(c[1] for c in counts),
+        "calls": len(responses),
+    }
+
+
+async def run_combined(prompt: str, schema: dict) -> dict:
+    llm = get_async_generative_model(model_name)
+    start = time.perf_counter()
+    response = await llm.generate_content_async(
+        prompt,
+        generation_config=get_json_generation_config(
+            json.dumps(schema, sort_keys=True),
+            max_output_tokens=max_output_tokens))
+    latency = time.perf_counter() - start
+    json.loads(response.text)
+    input_tokens, output_tokens = usage(response)
+    return {
+        "latency": latency,
+        "input_tokens": input_tokens,
+        "output_tokens": output_tokens,
+        "calls": 1,
+    }
+
+
+def summarize(name: str, mode: str, results: list[dict]):
+    latencies = sorted(r["latency"] for r in results)
+    p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+    print(f"{name:<16}{mode:<10}"
+          f"{statistics.median(latencies):>10.2f}{p95:>10.2f}"
+          f"{statistics.mean(r['input_tokens'] for r in results):>12.0f}"
+          f"{statistics.mean(r['output_tokens'] for r in results):>12.0f}"
+          f"{results[0]['calls']:>7}")
+
+
+async def main(runs: int):
+    print(f"Model {model_name}, {runs} runs per mode")
+    print(f"{'scenario':<16}{'mode':<10}{'p50 s':>10}{'p95 s':>10}"
+          f"{'input tok':>12}{'output tok':>12}{'calls':>7}")
+    for name, scenario in SCENARIOS.items():
+        separate = []
+        combined = []
+        # Interleave the modes so that drift in service latency affects both.
+        for _ in range(runs):
+            separate.append(await run_separate(scenario["separate"]))
+            combined.append(
+                await run_combined(scenario["combined"], scenario["schema"]))
+        summarize(name, "separate", separate)
+        summarize(name, "combined", combined)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+    asyncio.run(main(args.runs))
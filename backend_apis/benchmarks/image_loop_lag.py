@@ -0,0 +1,114 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Measures event-loop lag while post-processing bulk-email images.
+
+Runs the per-email image step (decode, resize to 250x250, PNG re-encode,
+base64) for a batch of Imagen-sized images, once inline in the coroutines
+as bulk email used to, and once through the `utils_image` worker pool.
+Meanwhile a probe task sleeps in short intervals and records how late the
+loop wakes it up, which is the delay every other request on the loop sees.
+
+Run from `backend_apis` with `/app/config.toml` in place:
+
+    python -m benchmarks.image_loop_lag --emails 50
+"""
+
+import argparse
+import asyncio
+import base64
+import io
+import os
+import statistics
+import time
+
+from PIL import Image
+
+from app import utils_image
+
+
+PROBE_INTERVAL = 0.005
+
+
+def make_image(size: int) -> bytes:
+    """Returns a noisy PNG, about as expensive to decode as an Imagen one."""
+    image = Image.frombytes("RGB", (size, size), os.urandom(size * size * 3))
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+async def inline_thumbnail(image_bytes: bytes) -> str:
+    await asyncio.sleep(0)
+    buffer = io.BytesIO()
+    Image.open(io.BytesIO(image_bytes)).resize((250, 250)).save(
+        buffer, format="PNG")
+    return base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+async def pooled_thumbnail(image_bytes: bytes) -> str:
+    thumbnail = await utils_image.resize(image_bytes, (250, 250))
+    return await utils_image.to_base64(thumbnail)
+
+
+async def probe(lags: list[float], stop: asyncio.Event):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(PROBE_INTERVAL)
+        lags.append(time.perf_counter() - start - PROBE_INTERVAL)
+
+
+async def run(mode, image_bytes: bytes, emails: int) -> dict:
+    lags = []
+    stop = asyncio.Event()
+    probe_task = asyncio.create_task(probe(lags, stop))
+    start = time.perf_counter()
+    await asyncio.gather(*(mode(image_bytes) for _ in range(emails)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await probe_task
+    lags.sort()
+    return {
+        "elapsed": elapsed,
+        "p50": statistics.median(lags),
+        "p99": lags[min(len(lags) - 1, int(len(lags) * 0.99))],
+        "max": lags[-1],
+    }
+
+
+async def main(emails: int, size: int):
+    image_bytes = make_image(size)
+    # Start the workers outside the measurement.
+    await pooled_thumbnail(image_bytes)
+    print(f"{emails} emails, {size}x{size} source image "
+          f"({len(image_bytes) / 1e6:.1f} MB), "
+          f"{utils_image.IMAGE_PROCESSING.get('workers', 2)} workers")
+    print(f"{'mode':<10}{'total s':>10}{'lag p50 ms':>12}"
+          f"{'lag p99 ms':>12}{'lag max ms':>12}")
+    for name, mode in (("inline", inline_thumbnail),
+                       ("pool", pooled_thumbnail)):
+        result = await run(mode, image_bytes, emails)
+        print(f"{name:<10}{result['elapsed']:>10.2f}"
+              f"{result['p50'] * 1000:>12.1f}{result['p99'] * 1000:>12.1f}"
+              f"{result['max'] * 1000:>12.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--emails", type=int, default=50)
+    parser.add_argument("--size", type=int, default=1024)
+    args = parser.parse_args()
+    asyncio.run(main(args.emails, args.size))
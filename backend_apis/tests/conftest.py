@@ -0,0 +1,48 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Points the app at a config.toml rendered from the Terraform template.
+
+The modules under test read config.toml when they are imported, so this
+runs before any of them is: Terraform variables are replaced by
+placeholders and the models by the local fakes, so no project or
+credentials are needed.
+"""
+
+import pathlib
+import re
+import sys
+import tempfile
+
+BACKEND_DIR = pathlib.Path(__file__).resolve().parents[1]
+TEMPLATE_PATH = (
+    BACKEND_DIR.parent / "infra" / "templates" / "config.toml.tftpl")
+
+sys.path.insert(0, str(BACKEND_DIR))
+
+from app import app_context  # noqa: E402
+
+
+def _render_config() -> str:
+    rendered = re.sub(r"\$\{[^}]*\}", "test", TEMPLATE_PATH.read_text())
+    rendered = re.sub(
+        r'^backend = "vertex"', 'backend = "fake"', rendered, flags=re.M)
+    config_path = pathlib.Path(tempfile.mkdtemp()) / "config.toml"
+    config_path.write_text(rendered)
+    return str(config_path)
+
+
+app_context.CONFIG_PATH = _render_config()
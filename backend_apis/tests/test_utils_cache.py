@@ -0,0 +1,128 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import asyncio
+import threading
+import time
+
+from app.utils_cache import ResponseCache, make_key
+
+
+class Clock:
+    """Stands in for `time.time` in the cache module."""
+
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def frozen_cache(monkeypatch, **kwargs) -> tuple[ResponseCache, Clock]:
+    clock = Clock()
+    monkeypatch.setattr(time, "time", clock)
+    return ResponseCache(**kwargs), clock
+
+
+def test_make_key_depends_on_every_part():
+    key = make_key("m", "prompt", {"temperature": 0.2})
+
+    assert key == make_key("m", "prompt", {"temperature": 0.2})
+    assert key != make_key("other", "prompt", {"temperature": 0.2})
+    assert key != make_key("m", "prompt ", {"temperature": 0.2})
+    assert key != make_key("m", "prompt", {"temperature": 0.3})
+
+
+def test_entries_expire_after_ttl(monkeypatch):
+    cache, clock = frozen_cache(monkeypatch, ttl_seconds=10)
+    cache.set("k", "v")
+
+    clock.now += 9
+    assert cache.get("k") == "v"
+    clock.now += 2
+    assert cache.get("k") is None
+    assert cache.stats() == {
+        "hits": 1, "misses": 1, "disk_hits": 0, "entries": 0}
+
+
+def test_least_recently_used_entry_is_evicted(monkeypatch):
+    cache, _ = frozen_cache(monkeypatch, max_entries=2)
+    cache.set("a", "1")
+    cache.set("b", "2")
+    cache.get("a")
+
+    cache.set("c", "3")
+
+    assert cache.get("b") is None
+    assert cache.get("a") == "1"
+    assert cache.get("c") == "3"
+
+
+def test_sqlite_tier_serves_evicted_entries(monkeypatch, tmp_path):
+    cache, _ = frozen_cache(
+        monkeypatch, max_entries=1,
+        sqlite_path=str(tmp_path / "cache.sqlite3"))
+    cache.set("a", "1")
+    cache.set("b", "2")
+
+    assert cache.get("a") == "1"
+    assert cache.stats()["disk_hits"] == 1
+
+
+def test_sqlite_tier_is_shared_and_expires(monkeypatch, tmp_path):
+    sqlite_path = str(tmp_path / "cache.sqlite3")
+    writer, clock = frozen_cache(
+        monkeypatch, ttl_seconds=10, sqlite_path=sqlite_path)
+    reader = ResponseCache(ttl_seconds=10, sqlite_path=sqlite_path)
+    writer.set("k", "v")
+
+    assert reader.get("k") == "v"
+    clock.now += 11
+    assert ResponseCache(sqlite_path=sqlite_path).get("k") is None
+
+
+def test_delete_and_clear_drop_every_tier(tmp_path):
+    cache = ResponseCache(sqlite_path=str(tmp_path / "cache.sqlite3"))
+    cache.set("a", "1")
+    cache.set("b", "2")
+
+    cache.delete("a")
+    assert cache.get("a") is None
+    cache.clear()
+    assert cache.get("b") is None
+
+
+def test_async_methods_use_the_sqlite_tier_off_the_loop(monkeypatch, tmp_path):
+    cache = ResponseCache(
+        max_entries=1, sqlite_path=str(tmp_path / "cache.sqlite3"))
+    threads = []
+    set_disk = cache._set_disk
+
+    def recording_set_disk(*args):
+        threads.append(threading.current_thread())
+        set_disk(*args)
+
+    monkeypatch.setattr(cache, "_set_disk", recording_set_disk)
+
+    async def run():
+        await cache.set_async("a", "1")
+        await cache.set_async("b", "2")
+        value = await cache.get_async("a")
+        await cache.delete_async("b")
+        return value, await cache.get_async("b")
+
+    assert asyncio.run(run()) == ("1", None)
+    assert threads and threading.main_thread() not in threads
+    assert cache.stats()["disk_hits"] == 1
@@ -0,0 +1,48 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import pytest
+
+from app import utils_fake_models
+from app.utils_fake_models import FakeImageGenerationModel
+
+
+@pytest.fixture(autouse=True)
+def instant_images(monkeypatch):
+    monkeypatch.setattr(utils_fake_models, "IMAGE", {"size": 32})
+
+
+def image_bytes(response) -> list[bytes]:
+    return [image._image_bytes for image in response.images]
+
+
+def test_calls_without_seed_return_new_images():
+    model = FakeImageGenerationModel("imagen")
+
+    images = [
+        image_bytes(model.generate_images(prompt="a kettle"))[0]
+        for _ in range(4)]
+
+    assert len(set(images)) == 4
+
+
+def test_calls_with_seed_repeat_their_images():
+    model = FakeImageGenerationModel("imagen")
+
+    first = model.generate_images(prompt="a kettle", number_of_images=2, seed=7)
+    second = model.generate_images(prompt="a kettle", number_of_images=2, seed=7)
+
+    assert image_bytes(first) == image_bytes(second)
+    assert len(set(image_bytes(first))) == 2
@@ -0,0 +1,76 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import time
+
+from app.utils_jobs import JobStore
+
+
+def test_job_lifecycle(tmp_path):
+    store = JobStore(str(tmp_path / "jobs.sqlite3"))
+    job_id = store.create("generate_image")
+
+    assert store.get(job_id)["status"] == "pending"
+    store.update(job_id, "running")
+    store.update(job_id, "succeeded", result={"generated_images": []})
+
+    job = store.get(job_id)
+    assert job["kind"] == "generate_image"
+    assert job["status"] == "succeeded"
+    assert job["result"] == {"generated_images": []}
+    assert store.get("unknown") is None
+
+
+def test_failed_job_keeps_status_code(tmp_path):
+    store = JobStore(str(tmp_path / "jobs.sqlite3"))
+    job_id = store.create("edit_image")
+
+    store.update(job_id, "failed", error="Rate limit", status_code=429)
+
+    job = store.get(job_id)
+    assert (job["status"], job["error"], job["status_code"]) == (
+        "failed", "Rate limit", 429)
+
+
+def test_finished_jobs_are_purged_after_ttl(tmp_path):
+    store = JobStore(str(tmp_path / "jobs.sqlite3"), ttl_seconds=0.01)
+    finished = store.create("generate_image")
+    store.update(finished, "succeeded", result={})
+    running = store.create("generate_image")
+    store.update(running, "running")
+    time.sleep(0.02)
+
+    store.create("generate_image")
+
+    assert store.get(finished) is None
+    assert store.get(running)["status"] == "running"
+
+
+def test_stale_jobs_are_failed_as_interrupted(tmp_path):
+    sqlite_path = str(tmp_path / "jobs.sqlite3")
+    store = JobStore(sqlite_path, stale_seconds=0.01)
+    pending = store.create("generate_image")
+    running = store.create("generate_image")
+    store.update(running, "running")
+    time.sleep(0.02)
+
+    # A process starting over the same file fails them.
+    restarted = JobStore(sqlite_path, stale_seconds=0.01)
+
+    for job_id in (pending, running):
+        job = restarted.get(job_id)
+        assert job["status"] == "failed"
+        assert "interrupted" in job["error"]
+        assert job["status_code"] == 500
@@ -0,0 +1,78 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import asyncio
+import math
+
+import pytest
+
+from app.utils_ratelimit import ModelRateLimiter, RateLimitExceeded, TokenBucket
+
+
+def test_bucket_waits_for_its_share_once_empty():
+    bucket = TokenBucket(60)
+
+    assert bucket.reserve(60, now=bucket.updated) == 0.0
+    # 60 per minute refill one token per second.
+    assert bucket.reserve(2, now=bucket.updated) == pytest.approx(2.0)
+
+
+def test_bucket_refills_over_time():
+    bucket = TokenBucket(60)
+    start = bucket.updated
+    bucket.reserve(60, now=start)
+
+    assert bucket.reserve(5, now=start + 5) == 0.0
+
+
+def test_limiter_returns_wait_within_max_wait():
+    limiter = ModelRateLimiter("m", rpm=60, tpm=1000, max_wait_seconds=10)
+
+    assert limiter.reserve(tokens=1000) == 0.0
+    # 1000 tokens per minute refill 50 tokens in 3 seconds.
+    assert limiter.reserve(tokens=50) == pytest.approx(3.0, abs=0.01)
+
+
+def test_limiter_raises_and_refunds_past_max_wait():
+    limiter = ModelRateLimiter("m", rpm=60, tpm=1000, max_wait_seconds=1)
+    limiter.reserve(tokens=1000)
+
+    with pytest.raises(RateLimitExceeded) as raised:
+        limiter.reserve(tokens=1000)
+
+    assert raised.value.model_name == "m"
+    assert raised.value.wait_seconds > 1
+    # The rejected call gave its reservation back.
+    assert limiter.requests.tokens == pytest.approx(59, abs=0.1)
+    assert limiter.tokens.tokens == pytest.approx(0, abs=1)
+
+
+def test_acquire_sleeps_for_the_wait():
+    limiter = ModelRateLimiter("m", rpm=600, tpm=1000, max_wait_seconds=1)
+    for _ in range(600):
+        limiter.reserve()
+
+    waited = asyncio.run(limiter.acquire())
+
+    assert 0 < waited <= 0.2
+
+
+def test_reserve_can_lift_max_wait_for_batch_work():
+    limiter = ModelRateLimiter("m", rpm=60, tpm=1000, max_wait_seconds=1)
+    limiter.reserve(tokens=1000)
+
+    wait = limiter.reserve(tokens=1000, max_wait_seconds=math.inf)
+
+    assert wait == pytest.approx(60.0, abs=0.1)
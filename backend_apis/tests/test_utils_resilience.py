@@ -0,0 +1,178 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import asyncio
+import time
+
+import pytest
+from google.api_core import exceptions
+
+from app import utils_resilience
+from app.utils_resilience import (
+    CircuitBreaker,
+    DeadlineExceeded,
+    GenerationUnavailableError,
+    call_with_deadline,
+    call_with_retry,
+    call_with_retry_sync,
+)
+
+
+@pytest.fixture(autouse=True)
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(utils_resilience.retry_policy, "base_delay", 0.001)
+    monkeypatch.setattr(utils_resilience.retry_policy, "max_delay", 0.002)
+    monkeypatch.setattr(utils_resilience.retry_policy, "max_attempts", 3)
+    monkeypatch.setattr(utils_resilience, "_breakers", {})
+
+
+def failing(error: Exception, calls: list):
+    def fn():
+        calls.append(1)
+        raise error
+    return fn
+
+
+def test_breaker_opens_after_threshold_and_fails_fast():
+    breaker = CircuitBreaker("m", failure_threshold=2, reset_timeout=60)
+
+    breaker.record_failure()
+    breaker.before_call()
+    breaker.record_failure()
+
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(GenerationUnavailableError):
+        breaker.before_call()
+
+
+def test_breaker_success_resets_failures():
+    breaker = CircuitBreaker("m", failure_threshold=2, reset_timeout=60)
+
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_breaker_lets_one_probe_through_after_reset_timeout():
+    breaker = CircuitBreaker("m", failure_threshold=1, reset_timeout=0.01)
+    breaker.record_failure()
+    time.sleep(0.02)
+
+    breaker.before_call()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    with pytest.raises(GenerationUnavailableError):
+        breaker.before_call()
+
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_breaker_failed_probe_opens_again():
+    breaker = CircuitBreaker("m", failure_threshold=3, reset_timeout=0.01)
+    for _ in range(3):
+        breaker.record_failure()
+    time.sleep(0.02)
+
+    breaker.before_call()
+    breaker.record_failure()
+
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(GenerationUnavailableError):
+        breaker.before_call()
+
+
+def test_breaker_released_probe_lets_another_through():
+    breaker = CircuitBreaker("m", failure_threshold=1, reset_timeout=0.01)
+    breaker.record_failure()
+    time.sleep(0.02)
+
+    breaker.before_call()
+    breaker.release_probe()
+    breaker.before_call()
+
+
+def test_retry_counts_one_breaker_failure_per_exhausted_call():
+    calls = []
+
+    with pytest.raises(GenerationUnavailableError):
+        call_with_retry_sync(
+            failing(exceptions.ServiceUnavailable("down"), calls), "m")
+
+    assert len(calls) == 3
+    assert utils_resilience.get_breaker("m").failures == 1
+
+
+def test_retry_returns_first_success():
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        if len(calls) < 2:
+            raise exceptions.TooManyRequests("busy")
+        return "ok"
+
+    assert call_with_retry_sync(flaky, "m") == "ok"
+    assert len(calls) == 2
+    assert utils_resilience.get_breaker("m").failures == 0
+
+
+def test_retry_does_not_retry_or_count_non_retryable_errors():
+    calls = []
+
+    with pytest.raises(exceptions.InvalidArgument):
+        call_with_retry_sync(
+            failing(exceptions.InvalidArgument("bad"), calls), "m")
+
+    assert len(calls) == 1
+    assert utils_resilience.get_breaker("m").failures == 0
+
+
+def test_retry_fails_fast_while_breaker_is_open():
+    breaker = utils_resilience.get_breaker("m")
+    for _ in range(breaker.failure_threshold):
+        breaker.record_failure()
+    calls = []
+
+    with pytest.raises(GenerationUnavailableError):
+        call_with_retry_sync(failing(ValueError(), calls), "m")
+
+    assert calls == []
+
+
+def test_deadline_bounds_all_attempts(monkeypatch):
+    monkeypatch.setitem(utils_resilience.DEADLINES, "test", 0.2)
+    monkeypatch.setattr(utils_resilience.retry_policy, "base_delay", 0.15)
+    monkeypatch.setattr(utils_resilience.retry_policy, "max_delay", 0.15)
+    calls = []
+
+    async def slow():
+        calls.append(1)
+        await asyncio.sleep(1)
+
+    async def attempt():
+        return await call_with_deadline(slow, "m", "test")
+
+    async def run():
+        start = time.monotonic()
+        with pytest.raises(GenerationUnavailableError) as raised:
+            await call_with_retry(attempt, "m")
+        return time.monotonic() - start, raised.value
+
+    elapsed, error = asyncio.run(run())
+    assert isinstance(error.cause, DeadlineExceeded)
+    assert len(calls) == 1
+    assert elapsed < 0.5
@@ -0,0 +1,97 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import asyncio
+
+import pytest
+
+from app.utils_singleflight import SingleFlight
+
+
+def upstream(calls: list, result: str, delay: float=0.05):
+    async def fn():
+        calls.append(result)
+        await asyncio.sleep(delay)
+        return result
+    return fn
+
+
+def test_concurrent_calls_share_one_upstream_call():
+    flights = SingleFlight("test")
+    calls = []
+
+    async def run():
+        return await asyncio.gather(
+            *(flights.do("k", upstream(calls, "r")) for _ in range(5)))
+
+    assert asyncio.run(run()) == ["r"] * 5
+    assert calls == ["r"]
+    assert flights.stats() == {"leaders": 1, "coalesced": 4, "in_flight": 0}
+
+
+def test_follower_takes_over_when_leader_is_cancelled():
+    flights = SingleFlight("test")
+    calls = []
+
+    async def run():
+        leader = asyncio.create_task(
+            flights.do("k", upstream(calls, "leader", delay=10)))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(
+            flights.do("k", upstream(calls, "follower")))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await follower
+
+    assert asyncio.run(run()) == "follower"
+    assert calls == ["leader", "follower"]
+    assert flights.stats()["in_flight"] == 0
+
+
+def test_cancelled_follower_leaves_leader_running():
+    flights = SingleFlight("test")
+    calls = []
+
+    async def run():
+        leader = asyncio.create_task(flights.do("k", upstream(calls, "r")))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(flights.do("k", upstream(calls, "f")))
+        await asyncio.sleep(0.01)
+        follower.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await follower
+        return await leader
+
+    assert asyncio.run(run()) == "r"
+    assert calls == ["r"]
+
+
+def test_leader_error_reaches_followers():
+    flights = SingleFlight("test")
+
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise ValueError("upstream failed")
+
+    async def run():
+        return await asyncio.gather(
+            flights.do("k", fail), flights.do("k", fail),
+            return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert all(isinstance(result, ValueError) for result in results)
+    assert flights.stats()["leaders"] == 1
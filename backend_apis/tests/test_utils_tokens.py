@@ -0,0 +1,69 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from app.utils_tokens import estimate_tokens, fit_sections, truncate_to_budget
+
+
+ARTICLE = (
+    "Acme launches a solar kettle for campers.\n"
+    "The kettle boils water in ten minutes using solar power. "
+    "Campers tested the kettle on three continents.\n"
+    "Unrelated trivia about the weather fills the rest of the page. "
+    "More filler follows here.")
+
+
+def test_text_within_budget_is_kept():
+    trimmed, stats = truncate_to_budget(ARTICLE, 1000)
+
+    assert trimmed == ARTICLE
+    assert stats["trimmed_tokens"] == 0
+
+
+def test_lead_keeps_leading_paragraphs_within_budget():
+    budget = estimate_tokens(ARTICLE) // 2
+
+    trimmed, stats = truncate_to_budget(ARTICLE, budget, "lead")
+
+    assert trimmed.startswith("Acme launches a solar kettle for campers.")
+    assert "filler" not in trimmed
+    assert stats["kept_tokens"] <= budget
+    assert stats["trimmed_tokens"] == (
+        stats["original_tokens"] - stats["kept_tokens"])
+
+
+def test_key_sentences_keeps_opening_sentence_in_order():
+    budget = estimate_tokens(ARTICLE) // 2
+
+    trimmed, stats = truncate_to_budget(ARTICLE, budget, "key_sentences")
+
+    assert trimmed.startswith("Acme launches a solar kettle for campers.")
+    assert stats["kept_tokens"] <= budget
+
+
+def test_unsplittable_text_is_cut():
+    trimmed, _ = truncate_to_budget("x" * 400, 10)
+
+    assert trimmed == "x" * 40
+
+
+def test_fit_sections_keeps_whole_sections_then_cuts_at_a_line():
+    sections = ["a" * 39, "b" * 19 + "\n" + "c" * 40, "d" * 39]
+
+    kept, stats = fit_sections(sections, 20)
+
+    assert kept == ["a" * 39, "b" * 19 + "\n"]
+    assert stats["sections_kept"] == 2
+    assert stats["sections_total"] == 3
+    assert stats["kept_tokens"] <= 20